@@ -0,0 +1,128 @@
+"""
+asyncio counterparts of the `authme.message` classes.
+
+Author: github.com/adoc
+
+"""
+import asyncio
+import functools
+
+import authme.codecs
+import authme.message
+
+
+# Payloads at least this many bytes are signed/encrypted in an executor,
+# smaller ones inline to avoid the thread hop.
+EXECUTOR_THRESHOLD = 64 * 1024
+
+
+def payload_size(value, limit):
+    """Approximate size of `value` in bytes, stopping the walk once it
+    passes `limit`.
+    """
+    size = 0
+    stack = [value]
+    while stack and size < limit:
+        value = stack.pop()
+        if isinstance(value, dict):
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple, set)):
+            stack.extend(value)
+        elif isinstance(value, str) or authme.codecs.is_buffer(value):
+            size += len(value)
+        else:
+            size += 8
+    return size
+
+
+async def run_sized(size, threshold, executor, func, *args):
+    """Run `func` inline when `size` is under `threshold`, otherwise in
+    `executor`.
+    """
+    if size < threshold:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, func, *args)
+
+
+class AsyncMessage(object):
+    """Awaitable `Message`. Produces byte-identical output to the sync
+    class it wraps.
+    """
+    message_cls = authme.message.Message
+
+    def __init__(self, payload=None, signer=None, signing_params=None,
+                 cipher=None, executor=None, threshold=EXECUTOR_THRESHOLD):
+        """
+        executor        obj         `concurrent.futures` executor, None
+                                    for the loop's default executor.
+        threshold       int         payload size (bytes) from which work
+                                    is moved off the event loop.
+        """
+        self.message = self.message_cls(payload=payload, signer=signer,
+                                        signing_params=signing_params,
+                                        cipher=cipher)
+        self.executor = executor
+        self.threshold = threshold
+
+    async def _run(self, size, func, *args):
+        return await run_sized(size, self.threshold, self.executor, func,
+                               *args)
+
+    async def send(self):
+        size = payload_size(self.message._payload, self.threshold)
+        return await self._run(size, self.message.send)
+
+    async def receive(self, body, nonce, signature):
+        return await self._run(len(body), self.message.receive, body, nonce,
+                               signature)
+
+
+class AsyncJsonMessage(AsyncMessage):
+    """Awaitable `JsonMessage`.
+    """
+    message_cls = authme.message.JsonMessage
+
+
+class AsyncAuthApi(object):
+    """Awaitable `AuthApi`. Produces the same packets as the sync class
+    it wraps.
+    """
+    api_cls = authme.message.AuthApi
+
+    def __init__(self, sender_id, remotes={}, expiry=600, executor=None,
+                 threshold=EXECUTOR_THRESHOLD):
+        """
+        executor        obj         `concurrent.futures` executor, None
+                                    for the loop's default executor.
+        threshold       int         payload size (bytes) from which work
+                                    is moved off the event loop.
+        """
+        self.api = self.api_cls(sender_id, remotes=remotes, expiry=expiry)
+        self.executor = executor
+        self.threshold = threshold
+
+    def add_remote(self, id_, vals={}):
+        return self.api.add_remote(id_, vals)
+
+    def remove_remote(self, id_):
+        self.api.remove_remote(id_)
+
+    async def send(self, remote_id, payload, *params):
+        size = payload_size(payload, self.threshold)
+        return await run_sized(size, self.threshold, self.executor,
+                               self.api.send, remote_id, payload, *params)
+
+    async def receive(self, packet, *params, expiry=None):
+        size = payload_size(packet['payload'], self.threshold)
+        return await run_sized(size, self.threshold, self.executor,
+                               functools.partial(self.api.receive,
+                                                 expiry=expiry),
+                               packet, *params)
+
+
+class AsyncJsonAuthApi(AsyncAuthApi):
+    """Awaitable `JsonAuthApi`.
+    """
+    api_cls = authme.message.JsonAuthApi
@@ -0,0 +1,211 @@
+"""
+Micro-benchmarks for the hmac, codecs and message layers.
+
+    python -m authme.bench [--output results.json] [--baseline base.json]
+
+Author: github.com/adoc
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+import authme.hmac
+import authme.codecs
+import authme.message
+
+
+SIZES = (64, 1024, 16 * 1024, 256 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+
+
+def _hmac_cases(data):
+    h = authme.hmac.Hmac(b'12345')
+    sig = h.sign(data)
+    th = authme.hmac.TimedHmac(b'12345')
+    tsig = th.sign(data)
+    return {'hmac.sign': lambda: h.sign(data),
+            'hmac.verify': lambda: h.verify(sig, data),
+            'timedhmac.challenge': lambda: th.challenge(tsig, data)}
+
+
+def _codec_cases(data):
+    value = {b'data': data}
+    b64 = authme.codecs.B64ArgCodec.encode(value)
+    js = authme.codecs.JsonArgCodec.encode(value)
+    binary = authme.codecs.BinaryArgCodec.encode(value)
+    return {'b64codec.encode':
+                lambda: authme.codecs.B64ArgCodec.encode(value),
+            'b64codec.decode':
+                lambda: authme.codecs.B64ArgCodec.decode(*b64),
+            'jsoncodec.encode':
+                lambda: authme.codecs.JsonArgCodec.encode(value),
+            'jsoncodec.decode':
+                lambda: authme.codecs.JsonArgCodec.decode(*js),
+            'binarycodec.encode':
+                lambda: authme.codecs.BinaryArgCodec.encode(value),
+            'binarycodec.decode':
+                lambda: authme.codecs.BinaryArgCodec.decode(*binary)}
+
+
+def _message_cases(data):
+    signer = authme.hmac.Hmac(b'12345')
+    params = (b'signature_namespace',)
+    message = authme.message.Message(payload=data, signer=signer,
+                                     signing_params=params)
+    sent = message.send()
+    json_message = authme.message.JsonMessage(payload={b'data': data},
+                                    signer=signer, signing_params=params)
+    json_sent = json_message.send()
+    return {'message.send': message.send,
+            'message.receive': lambda: message.receive(*sent),
+            'jsonmessage.send': json_message.send,
+            'jsonmessage.receive': lambda: json_message.receive(*json_sent)}
+
+
+CASES = (_hmac_cases, _codec_cases, _message_cases)
+
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1,
+                int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(func, min_time=0.2, min_iterations=5, max_iterations=100000):
+    """Time `func` repeatedly, then once more under `tracemalloc`.
+
+    returns dict        ops/s, latency percentiles (seconds), the peak
+                        bytes allocated by a single call and the number
+                        of blocks it allocated that are still alive when
+                        it returns (its result and anything it caches;
+                        `tracemalloc` can't count blocks freed within the
+                        call).
+    """
+    func()
+    timings = []
+    perf_counter = time.perf_counter
+    start = perf_counter()
+    while (len(timings) < min_iterations or
+            (perf_counter() - start < min_time and
+             len(timings) < max_iterations)):
+        t0 = perf_counter()
+        func()
+        timings.append(perf_counter() - t0)
+    total = sum(timings)
+    timings.sort()
+
+    tracemalloc.start()
+    try:
+        before = _snapshot()
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        after = _snapshot()
+    finally:
+        tracemalloc.stop()
+    del result
+    count = sum(stat.count_diff for stat in after.compare_to(before,
+                                                             'filename')
+                    if stat.count_diff > 0)
+
+    return {'iterations': len(timings),
+            'ops': len(timings) / total if total else float('inf'),
+            'p50': percentile(timings, 50),
+            'p90': percentile(timings, 90),
+            'p99': percentile(timings, 99),
+            'alloc_peak': peak,
+            'alloc_count': count}
+
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(False, tracemalloc.__file__),))
+
+
+def run(sizes=SIZES, match=None, min_time=0.2, out=None):
+    """Run every benchmark for each payload size.
+
+    returns dict        {"<case>/<size>": measure() result}
+    """
+    results = {}
+    for size in sizes:
+        data = os.urandom(size)
+        for cases in CASES:
+            for name, func in sorted(cases(data).items()):
+                key = '%s/%d' % (name, size)
+                if match and match not in key:
+                    continue
+                results[key] = measure(func, min_time=min_time)
+                if out is not None:
+                    out.write(format_result(key, results[key]) + '\n')
+                    out.flush()
+    return results
+
+
+def format_result(key, result):
+    return ('%-32s %12.1f ops/s  p50 %9.1fus  p99 %9.1fus  peak %10d B  '
+            '%6d allocs' %
+            (key, result['ops'], result['p50'] * 1e6, result['p99'] * 1e6,
+             result['alloc_peak'], result['alloc_count']))
+
+
+def compare(results, baseline, threshold=0.1):
+    """Compare ops/s against `baseline`.
+
+    returns list        (key, baseline ops, current ops) for every
+                        benchmark slower than the baseline by more than
+                        `threshold` (a fraction).
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result['ops'] < base['ops'] * (1 - threshold):
+            regressions.append((key, base['ops'], result['ops']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m authme.bench',
+                                     description=__doc__.strip())
+    parser.add_argument('--sizes', type=lambda v: [int(s) for s in
+                                                   v.split(',')],
+                        default=SIZES, help="comma separated payload sizes")
+    parser.add_argument('--match', help="only run benchmarks containing "
+                                        "this string")
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help="seconds to spend on each benchmark")
+    parser.add_argument('--output', help="write results as JSON")
+    parser.add_argument('--baseline', help="JSON results to compare with")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.match, args.min_time, out=sys.stdout)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for key, base, current in regressions:
+            sys.stdout.write('REGRESSION %s: %.1f -> %.1f ops/s (%.0f%%)\n' %
+                             (key, base, current,
+                              (current / base - 1) * 100))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,42 @@
+import re
 import base64
+import struct
+import binascii
+import operator
 import functools
 import collections
+import collections.abc
 import json as _json
 
 
+# Common types exposing the buffer protocol. `is_buffer` also accepts any
+# other buffer (e.g. `mmap`).
+BUFFER_TYPES = (bytes, bytearray, memoryview)
+
+
+def is_buffer(value):
+    """True if `value` supports the buffer protocol and so can be
+    hashed, encoded or sliced without first copying it into `bytes`.
+    """
+    if isinstance(value, BUFFER_TYPES):
+        return True
+    try:
+        with memoryview(value):
+            return True
+    except TypeError:
+        return False
+
+
 def encode_all(data):
     if isinstance(data, bytes):
         return data
     elif isinstance(data, str):
         return data.encode()
-    elif isinstance(data, collections.Mapping):
+    elif is_buffer(data):
+        return data
+    elif isinstance(data, collections.abc.Mapping):
         return dict(map(encode_all, data.items()))
-    elif isinstance(data, collections.Iterable):
+    elif isinstance(data, collections.abc.Iterable):
         return type(data)(map(encode_all, data))
     else:
         return data
@@ -20,9 +45,11 @@ def encode_all(data):
 def decode_all(data):
     if isinstance(data, bytes):
         return data.decode()
-    elif isinstance(data, collections.Mapping):
+    elif isinstance(data, collections.abc.Mapping):
         return dict(map(decode_all, data.items()))
-    elif isinstance(data, collections.Iterable):
+    elif is_buffer(data):
+        return str(data, 'utf-8')
+    elif isinstance(data, collections.abc.Iterable):
         return type(data)(map(decode_all, data))
     else:
         return data
@@ -38,7 +65,7 @@ def b64encode(value):
     elif isinstance(value, (int, float)):
         return value
     else:
-        assert isinstance(value, bytes), "Codec requires bytes value."
+        assert is_buffer(value), "Codec requires bytes value."
         return base64.b64encode(value)
 
 
@@ -50,10 +77,580 @@ def b64decode(value):
     elif isinstance(value, (tuple, list, set)):
         return type(value)([b64decode(v) for v in value])
     else:
-        assert isinstance(value, bytes), "Codec requires bytes value."
+        assert is_buffer(value), "Codec requires bytes value."
         return base64.b64decode(value)
 
 
+def _b64json_scalar(value):
+    """JSON text for a non-container value, as `json.dumps` would emit it
+    after `b64encode` and `decode_all`.
+    """
+    if isinstance(value, bytes):
+        return '"%s"' % binascii.b2a_base64(value, newline=False).decode()
+    elif value is True:
+        return 'true'
+    elif value is False:
+        return 'false'
+    elif isinstance(value, int):
+        return int.__repr__(value)
+    elif isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        elif value == float('inf'):
+            return 'Infinity'
+        elif value == -float('inf'):
+            return '-Infinity'
+        return float.__repr__(value)
+    elif isinstance(value, (set, frozenset)):
+        raise TypeError("Object of type %s is not JSON serializable" %
+                        type(value).__name__)
+    else:
+        assert is_buffer(value), "Codec requires bytes value."
+        return '"%s"' % binascii.b2a_base64(value, newline=False).decode()
+
+
+def _b64json_key(key):
+    text = _b64json_scalar(key)
+    return text if text[0] == '"' else '"%s"' % text
+
+
+def b64json_dumps(value):
+    """Base64 and JSON encode `value` in a single, non-recursive pass.
+
+    Output is identical to `json.dumps(decode_all(b64encode(value)))`.
+    """
+    parts = []
+    append = parts.append
+    stack = []
+    active = set()
+    items, closer, is_dict, first = iter((value,)), '', False, True
+
+    while True:
+        for item in items:
+            if first:
+                first = False
+            else:
+                append(',')
+            if is_dict:
+                key, item = item
+                append(_b64json_key(key))
+                append(':')
+
+            if isinstance(item, dict):
+                opener, child = '{', iter(item.items())
+            elif isinstance(item, (list, tuple)):
+                opener, child = '[', iter(item)
+            else:
+                append(_b64json_scalar(item))
+                continue
+
+            if id(item) in active:
+                raise ValueError("Circular reference detected")
+            active.add(id(item))
+            stack.append((items, closer, is_dict, item))
+            append(opener)
+            items, closer, is_dict, first = (child, ']' if opener == '[' else
+                                             '}', opener == '{', True)
+            break
+        else:
+            append(closer)
+            if not stack:
+                return ''.join(parts)
+            items, closer, is_dict, container = stack.pop()
+            active.discard(id(container))
+            first = False
+
+
+def _b64json_value(value):
+    if isinstance(value, str):
+        return binascii.a2b_base64(value.encode())
+    return value
+
+
+def _b64json_convert(value):
+    """Base64 decode a parsed JSON tree without recursing."""
+    if isinstance(value, dict):
+        result = {}
+    elif isinstance(value, list):
+        result = []
+    else:
+        return _b64json_value(value)
+
+    stack = [(value, result)]
+    while stack:
+        src, dst = stack.pop()
+        if isinstance(src, dict):
+            pairs = ((binascii.a2b_base64(k.encode()), v)
+                        for k, v in src.items())
+        else:
+            pairs = enumerate(src)
+        for key, item in pairs:
+            if isinstance(item, dict):
+                child = {}
+                stack.append((item, child))
+            elif isinstance(item, list):
+                child = []
+                stack.append((item, child))
+            else:
+                child = _b64json_value(item)
+            if isinstance(dst, dict):
+                dst[key] = child
+            else:
+                dst.append(child)
+    return result
+
+
+_ws = re.compile(r'[ \t\n\r]*').match
+_number = _json.scanner.NUMBER_RE.match
+_scanstring = _json.decoder.scanstring
+_constants = (('true', True), ('false', False), ('null', None),
+              ('NaN', float('nan')), ('Infinity', float('inf')),
+              ('-Infinity', float('-inf')))
+
+
+def _b64json_parse(text):
+    """Iterative JSON parser producing base64 decoded values. Only used
+    for documents nested too deep for the `json` C parser.
+    """
+    def error(msg, pos):
+        return _json.decoder.JSONDecodeError(msg, text, pos)
+
+    def parse_key(pos):
+        pos = _ws(text, pos).end()
+        if text[pos:pos+1] != '"':
+            raise error("Expecting property name enclosed in double quotes",
+                        pos)
+        key, pos = _scanstring(text, pos + 1)
+        pos = _ws(text, pos).end()
+        if text[pos:pos+1] != ':':
+            raise error("Expecting ':' delimiter", pos)
+        return binascii.a2b_base64(key.encode()), pos + 1
+
+    stack = []
+    pos = 0
+    while True:
+        # Parse a value, descending into containers as they open.
+        pos = _ws(text, pos).end()
+        char = text[pos:pos+1]
+        if char in ('{', '['):
+            after = _ws(text, pos + 1).end()
+            if text[after:after+1] == ('}' if char == '{' else ']'):
+                value, pos = ({} if char == '{' else []), after + 1
+            elif char == '{':
+                container = {}
+                key, pos = parse_key(pos + 1)
+                stack.append([container, key])
+                continue
+            else:
+                stack.append([[], None])
+                pos += 1
+                continue
+        elif char == '"':
+            value, pos = _scanstring(text, pos + 1)
+            value = binascii.a2b_base64(value.encode())
+        else:
+            match = _number(text, pos)
+            if match is not None:
+                integer, frac, exp = match.groups()
+                if frac or exp:
+                    value = float(integer + (frac or '') + (exp or ''))
+                else:
+                    value = int(integer)
+                pos = match.end()
+            else:
+                for name, value in _constants:
+                    if text.startswith(name, pos):
+                        pos += len(name)
+                        break
+                else:
+                    raise error("Expecting value", pos)
+
+        # Attach the value to its parents, closing finished containers.
+        while True:
+            if not stack:
+                pos = _ws(text, pos).end()
+                if pos != len(text):
+                    raise error("Extra data", pos)
+                return value
+            frame = stack[-1]
+            container = frame[0]
+            if isinstance(container, dict):
+                container[frame[1]] = value
+                closer = '}'
+            else:
+                container.append(value)
+                closer = ']'
+            pos = _ws(text, pos).end()
+            char = text[pos:pos+1]
+            if char == ',':
+                if closer == '}':
+                    frame[1], pos = parse_key(pos + 1)
+                else:
+                    pos += 1
+                break
+            elif char == closer:
+                stack.pop()
+                value, pos = container, pos + 1
+            else:
+                raise error("Expecting ',' delimiter", pos)
+
+
+def b64json_loads(text):
+    """JSON decode and base64 decode `text` in a single conversion pass.
+
+    Returns the same value as `b64decode(encode_all(json.loads(text)))`,
+    but also passes numbers through and has no nesting depth limit.
+    """
+    try:
+        value = _json.loads(text)
+    except RecursionError:
+        return _b64json_parse(text)
+    return _b64json_convert(value)
+
+
+# Binary codec: deterministic CBOR (RFC 8949, section 4.2.1). Every item
+# is a head byte holding the major type and either a small argument or
+# the size of a 1, 2, 4 or 8 byte big-endian argument that follows; the
+# argument is the value of an int, the length of bytes/str or the item
+# count of a list/dict. Heads must use the shortest form, dict items are
+# ordered by their encoded key, ints beyond 64 bits are bignums (tags 2
+# and 3) and floats are always 64 bit with a single NaN, so a value has
+# exactly one encoding.
+_CBOR_UINT, _CBOR_NEGINT, _CBOR_BYTES, _CBOR_TEXT = 0, 1, 2, 3
+_CBOR_ARRAY, _CBOR_MAP, _CBOR_TAG, _CBOR_SIMPLE = 4, 5, 6, 7
+_CBOR_FALSE, _CBOR_TRUE, _CBOR_NULL, _CBOR_FLOAT = 0xf4, 0xf5, 0xf6, 0xfb
+_CBOR_BIGNUM, _CBOR_NEG_BIGNUM = 2, 3
+_CBOR_CONSTANTS = {_CBOR_FALSE: False, _CBOR_TRUE: True, _CBOR_NULL: None}
+_U64_MAX = (1 << 64) - 1
+_f64 = struct.Struct('>d')
+_nan = b'\xfb' + _f64.pack(float('nan'))
+# Argument structs by additional info 24..27, and the smallest argument
+# each may canonically hold.
+_cbor_args = (struct.Struct('>B'), struct.Struct('>H'), struct.Struct('>I'),
+              struct.Struct('>Q'))
+_cbor_arg_min = (24, 1 << 8, 1 << 16, 1 << 32)
+# One byte heads for arguments below 24, by major type.
+_cbor_short = [[bytes((major << 5 | n,)) for n in range(24)]
+               for major in range(8)]
+_bytes_heads = _cbor_short[_CBOR_BYTES]
+_uint_heads = _cbor_short[_CBOR_UINT]
+_array_heads = _cbor_short[_CBOR_ARRAY]
+_map_heads = _cbor_short[_CBOR_MAP]
+
+
+def _cbor_head(major, n):
+    if n < 24:
+        return _cbor_short[major][n]
+    major <<= 5
+    if n < 0x100:
+        return bytes((major | 24, n))
+    elif n < 0x10000:
+        return bytes((major | 25,)) + n.to_bytes(2, 'big')
+    elif n < 0x100000000:
+        return bytes((major | 26,)) + n.to_bytes(4, 'big')
+    return bytes((major | 27,)) + n.to_bytes(8, 'big')
+
+
+def _binary_scalar(value, out):
+    """Append the encoding of a non-container value to bytearray `out`."""
+    if isinstance(value, bytes):
+        out += _cbor_head(_CBOR_BYTES, len(value))
+        out += value
+    elif isinstance(value, str):
+        value = value.encode()
+        out += _cbor_head(_CBOR_TEXT, len(value))
+        out += value
+    elif value is True:
+        out.append(_CBOR_TRUE)
+    elif value is False:
+        out.append(_CBOR_FALSE)
+    elif value is None:
+        out.append(_CBOR_NULL)
+    elif isinstance(value, int):
+        major, n = ((_CBOR_UINT, value) if value >= 0 else
+                    (_CBOR_NEGINT, -1 - value))
+        if n <= _U64_MAX:
+            out += _cbor_head(major, n)
+        else:
+            n = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+            out += _cbor_head(_CBOR_TAG, _CBOR_BIGNUM + major)
+            out += _cbor_head(_CBOR_BYTES, len(n))
+            out += n
+    elif isinstance(value, float):
+        if value != value:
+            out += _nan
+        else:
+            out.append(_CBOR_FLOAT)
+            out += _f64.pack(value)
+    elif not isinstance(value, (set, frozenset)) and is_buffer(value):
+        value = memoryview(value).cast('B')
+        out += _cbor_head(_CBOR_BYTES, len(value))
+        out += value
+    else:
+        raise TypeError("Object of type %s is not binary serializable" %
+                        type(value).__name__)
+
+
+def _encode_key(key):
+    if isinstance(key, (dict, list, tuple)):
+        raise TypeError("Binary dict keys must be scalars.")
+    out = bytearray()
+    _binary_scalar(key, out)
+    return bytes(out)
+
+
+_cached_key = functools.lru_cache(maxsize=4096, typed=True)(_encode_key)
+
+
+def _binary_key(key):
+    # Floats aren't cached: 0.0 and -0.0 are equal but encode differently.
+    if isinstance(key, float):
+        return _encode_key(key)
+    return _cached_key(key)
+
+
+_first = operator.itemgetter(0)
+
+
+# Nesting depth from which `binary_dumps` tracks containers to detect
+# circular references; a cycle always reaches it.
+_BINARY_CYCLE_DEPTH = 32
+
+
+def binary_dumps(value):
+    """Canonical binary encoding of bytes/str/int/float/bool/None and
+    lists, tuples (as lists) and dicts of them, without recursion.
+    """
+    out = bytearray()
+    stack = []
+    active = set()
+    items, is_dict = iter((value,)), False
+
+    while True:
+        for item in items:
+            if is_dict:
+                key, item = item
+                out += key
+
+            kind = type(item)
+            if kind is bytes:
+                n = len(item)
+                out += _bytes_heads[n] if n < 24 else _cbor_head(
+                                                            _CBOR_BYTES, n)
+                out += item
+                continue
+            elif kind is int and 0 <= item < 24:
+                out += _uint_heads[item]
+                continue
+            elif kind is dict or (kind is not list and kind is not tuple and
+                                  isinstance(item, dict)):
+                child = sorted([(_binary_key(k), v) for k, v in item.items()],
+                               key=_first)
+                n = len(child)
+                out += _map_heads[n] if n < 24 else _cbor_head(_CBOR_MAP, n)
+            elif kind is list or kind is tuple or isinstance(item,
+                                                          (list, tuple)):
+                child = item
+                n = len(child)
+                out += _array_heads[n] if n < 24 else _cbor_head(
+                                                            _CBOR_ARRAY, n)
+            else:
+                _binary_scalar(item, out)
+                continue
+
+            if not n:
+                continue
+            if len(stack) >= _BINARY_CYCLE_DEPTH:
+                if id(item) in active:
+                    raise ValueError("Circular reference detected")
+                active.add(id(item))
+            stack.append((items, is_dict, item))
+            items, is_dict = iter(child), child is not item
+            break
+        else:
+            if not stack:
+                return bytes(out)
+            items, is_dict, container = stack.pop()
+            if len(stack) >= _BINARY_CYCLE_DEPTH:
+                active.discard(id(container))
+
+
+def _binary_error(msg, pos):
+    return ValueError("%s at position %d" % (msg, pos))
+
+
+def _binary_head(view, pos, end):
+    """returns tuple    (major type, argument, position after the head)
+                        of the head at `pos`, checking it is canonical.
+    """
+    head = view[pos]
+    major, arg = head >> 5, head & 31
+    pos += 1
+    if arg >= 24:
+        if arg > 27:
+            raise _binary_error("Unsupported head", pos - 1)
+        unpack = _cbor_args[arg - 24]
+        if pos + unpack.size > end:
+            raise _binary_error("Truncated head", pos)
+        minimum = _cbor_arg_min[arg - 24]
+        arg = unpack.unpack_from(view, pos)[0]
+        if arg < minimum:
+            raise _binary_error("Non-canonical head", pos - 1)
+        pos += unpack.size
+    return major, arg, pos
+
+
+def _binary_item(view, data, pos, end):
+    """Decode the item at `pos`. A list or dict is returned empty, with
+    its item count.
+
+    returns tuple       (value, position after it, item count or None)
+    """
+    start = pos
+    head = view[pos]
+    if head >= 0xe0:
+        pos += 1
+        if head == _CBOR_FLOAT:
+            if pos + 8 > end:
+                raise _binary_error("Truncated float", pos)
+            value = _f64.unpack_from(view, pos)[0]
+            pos += 8
+            if value != value and data[start:pos] != _nan:
+                raise _binary_error("Non-canonical NaN", start)
+            return value, pos, None
+        elif head in _CBOR_CONSTANTS:
+            return _CBOR_CONSTANTS[head], pos, None
+        raise _binary_error("Unsupported simple value", start)
+
+    major, arg, pos = _binary_head(view, pos, end)
+    if major == _CBOR_BYTES or major == _CBOR_TEXT:
+        stop = pos + arg
+        if stop > end:
+            raise _binary_error("Truncated value", pos)
+        if major == _CBOR_BYTES:
+            return bytes(data[pos:stop]), stop, None
+        return str(data[pos:stop], 'utf-8'), stop, None
+    elif major == _CBOR_UINT:
+        return arg, pos, None
+    elif major == _CBOR_NEGINT:
+        return -1 - arg, pos, None
+    elif major == _CBOR_ARRAY or major == _CBOR_MAP:
+        if arg > end - pos:
+            raise _binary_error("Item count exceeds data", start)
+        return ({} if major == _CBOR_MAP else []), pos, arg
+    elif arg == _CBOR_BIGNUM or arg == _CBOR_NEG_BIGNUM:
+        if pos >= end or view[pos] >> 5 != _CBOR_BYTES:
+            raise _binary_error("Bignum must be bytes", pos)
+        _, size, pos = _binary_head(view, pos, end)
+        if pos + size > end:
+            raise _binary_error("Truncated value", pos)
+        n = int.from_bytes(data[pos:pos + size], 'big')
+        if n <= _U64_MAX or view[pos] == 0:
+            raise _binary_error("Non-canonical bignum", pos)
+        return (n if arg == _CBOR_BIGNUM else -1 - n), pos + size, None
+    raise _binary_error("Unsupported tag", start)
+
+
+def binary_loads(data):
+    """Decode `binary_dumps` output, without recursion. Only canonical
+    input is accepted: shortest heads and ints, dict keys in order and
+    distinct, and no data after the value.
+    """
+    # Slicing `bytes` makes one copy where a memoryview slice makes two,
+    # so only views of other buffers are sliced and then copied.
+    copy = type(data) is not bytes
+    view = data = memoryview(data).cast('B') if copy else data
+    end = len(view)
+    item = _binary_item
+    try:
+        root, pos, left = item(view, data, 0, end)
+        container, is_dict, last_key = root, type(root) is dict, None
+        stack = []
+        while True:
+            # Short ints, bytes and str are decoded inline, anything else
+            # by `_binary_item`.
+            while left:
+                if is_dict:
+                    start = pos
+                    head = view[pos]
+                    if head < 0x18:
+                        key = head
+                        pos += 1
+                    elif 0x40 <= head < 0x58 or 0x60 <= head < 0x78:
+                        stop = pos + 1 + (head & 31)
+                        if stop > end:
+                            raise _binary_error("Truncated value", pos)
+                        key = data[pos + 1:stop]
+                        if head >= 0x58:
+                            key = str(key, 'utf-8')
+                        elif copy:
+                            key = bytes(key)
+                        pos = stop
+                    else:
+                        key, pos, count = item(view, data, pos, end)
+                        if count is not None:
+                            raise _binary_error("Dict key must be a "
+                                                "scalar", start)
+                    encoded = data[start:pos]
+                    if copy:
+                        encoded = bytes(encoded)
+                    if last_key is not None and encoded <= last_key:
+                        raise _binary_error("Dict keys out of order", start)
+                    if key in container:
+                        # e.g. True and 1, or 1 and 1.0.
+                        raise _binary_error("Duplicate dict key", start)
+                    last_key = encoded
+
+                head = view[pos]
+                count = None
+                if head < 0x18:
+                    value = head
+                    pos += 1
+                elif 0x40 <= head < 0x58 or 0x60 <= head < 0x78:
+                    stop = pos + 1 + (head & 31)
+                    if stop > end:
+                        raise _binary_error("Truncated value", pos)
+                    value = data[pos + 1:stop]
+                    if head >= 0x58:
+                        value = str(value, 'utf-8')
+                    elif copy:
+                        value = bytes(value)
+                    pos = stop
+                elif 0x80 <= head < 0x98 or 0xa0 <= head < 0xb8:
+                    count = head & 31
+                    pos += 1
+                    if count > end - pos:
+                        raise _binary_error("Item count exceeds data",
+                                            pos - 1)
+                    value = [] if head < 0x98 else {}
+                elif head == 0x18:
+                    value = view[pos + 1]
+                    if value < 24:
+                        raise _binary_error("Non-canonical head", pos)
+                    pos += 2
+                else:
+                    value, pos, count = item(view, data, pos, end)
+
+                if is_dict:
+                    container[key] = value
+                else:
+                    container.append(value)
+                left -= 1
+                if count:
+                    stack.append((container, left, is_dict, last_key))
+                    container, left, last_key = value, count, None
+                    is_dict = type(value) is dict
+            else:
+                if not stack:
+                    break
+                container, left, is_dict, last_key = stack.pop()
+    except IndexError:
+        raise _binary_error("Truncated data", end)
+    if pos != end:
+        raise _binary_error("Extra data", pos)
+    return root
+
+
 # http://stackoverflow.com/a/13520518
 class DotDict(dict):
     """
@@ -133,13 +730,28 @@ class JsonArgCodec(B64ArgCodec):
     """
     @classmethod
     def _encode(cls, *args):
-        for arg in B64ArgCodec._encode(*args):
-            yield json.dumps(decode_all(arg))
+        for arg in BaseArgCodec._encode(*args):
+            yield b64json_dumps(arg)
 
     @classmethod
     def _decode(cls, *args):
-        for arg in args:
-            if isinstance(arg, bytes):
-                arg = arg.decode()
-            arg = json.loads(arg)
-            yield from B64ArgCodec._decode(encode_all(arg))
\ No newline at end of file
+        for arg in BaseArgCodec._decode(*args):
+            if not isinstance(arg, str):
+                arg = str(arg, 'utf-8')
+            yield b64json_loads(arg)
+
+
+class BinaryArgCodec(BaseArgCodec):
+    """A message encoded as deterministic CBOR, for peers that don't need
+    JSON. The same value always encodes to the same bytes, which are
+    smaller than `JsonArgCodec`'s as bytes aren't base64 encoded.
+    """
+    @classmethod
+    def _encode(cls, *args):
+        for arg in BaseArgCodec._encode(*args):
+            yield binary_dumps(arg)
+
+    @classmethod
+    def _decode(cls, *args):
+        for arg in BaseArgCodec._decode(*args):
+            yield binary_loads(arg)
@@ -0,0 +1,95 @@
+"""
+Compact, transport independent binary envelope for `Message` output.
+
+    version     u8
+    flags       u8
+    sender id   u16 length + bytes
+    nonce       u16 length + bytes
+    signature   u16 length + bytes
+    body        u32 length + bytes
+
+All integers are big-endian. `FLAG_NONCE`/`FLAG_SIGNATURE` mark a
+present nonce/signature so `None` survives the round trip; the
+remaining flag bits are free for callers.
+
+Author: github.com/adoc
+
+"""
+import struct
+import collections
+
+import authme.exc
+
+
+VERSION = 1
+
+FLAG_NONCE = 0x01
+FLAG_SIGNATURE = 0x02
+
+_header = struct.Struct('>BB')
+_short = struct.Struct('>H')
+_long = struct.Struct('>I')
+
+
+Envelope = collections.namedtuple('Envelope', ('version', 'flags',
+                                  'sender_id', 'body', 'nonce', 'signature'))
+
+
+def pack(sender_id, body, nonce=None, signature=None, flags=0):
+    """Frame a message. Arguments follow `Message.send` order, so
+    `pack(sender_id, *message.send())` works.
+
+    returns     bytes       the envelope.
+    """
+    flags &= ~(FLAG_NONCE | FLAG_SIGNATURE)
+    if nonce is not None:
+        flags |= FLAG_NONCE
+    else:
+        nonce = b''
+    if signature is not None:
+        flags |= FLAG_SIGNATURE
+    else:
+        signature = b''
+
+    try:
+        return b''.join((_header.pack(VERSION, flags),
+                         _short.pack(len(sender_id)), sender_id,
+                         _short.pack(len(nonce)), nonce,
+                         _short.pack(len(signature)), signature,
+                         _long.pack(len(body)), body))
+    except struct.error:
+        raise authme.exc.EnvelopeBad("Envelope field is too long.")
+
+
+def unpack(data):
+    """Parse an envelope without copying.
+
+    returns     Envelope    with `memoryview` slices of `data` for
+                            sender_id, body, nonce and signature.
+    """
+    view = memoryview(data)
+    if len(view) < _header.size:
+        raise authme.exc.EnvelopeBad("Envelope is truncated.")
+    version, flags = _header.unpack_from(view)
+    if version != VERSION:
+        raise authme.exc.EnvelopeBad("Unknown envelope version %s." %
+                                     version)
+
+    pos = _header.size
+    frames = []
+    for prefix in (_short, _short, _short, _long):
+        if len(view) < pos + prefix.size:
+            raise authme.exc.EnvelopeBad("Envelope is truncated.")
+        size, = prefix.unpack_from(view, pos)
+        pos += prefix.size
+        if len(view) < pos + size:
+            raise authme.exc.EnvelopeBad("Envelope is truncated.")
+        frames.append(view[pos:pos+size])
+        pos += size
+    if pos != len(view):
+        raise authme.exc.EnvelopeBad("Trailing data after envelope.")
+
+    sender_id, nonce, signature, body = frames
+    return Envelope(version, flags, sender_id, body,
+                    nonce if flags & FLAG_NONCE else None,
+                    signature if flags & FLAG_SIGNATURE else None)
@@ -14,6 +14,10 @@ class SignatureTimeout(SignatureException):
     pass
 
 
+class SignatureReplayed(SignatureException):
+    pass
+
+
 
 class AuthMessageException(Exception):
     """Base message authentication exception.
@@ -25,3 +29,28 @@ class MessageClientBad(AuthMessageException):
     """Client wasn't found in the data model.
     """
     pass
+
+
+class EnvelopeBad(AuthMessageException):
+    """Binary envelope is malformed or of an unknown version.
+    """
+    pass
+
+
+class RemotesFull(AuthMessageException):
+    """Fixed size remotes table has no free slot.
+    """
+    pass
+
+
+class CipherBad(AuthMessageException):
+    """Cipher failed to decrypt a verified body.
+    """
+    pass
+
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are queued; retry later.
+    """
+    pass
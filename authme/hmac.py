@@ -11,6 +11,8 @@ Location: https://gist.github.com/adoc/8552289
 import time
 import hashlib
 import hmac
+import threading
+import collections
 import authme.exc
 
 
@@ -38,46 +40,257 @@ def bytes_to_int(b):
     return n
 
 
+# `TimedHmac` wire format version. A v1 signature is the version byte,
+# the digest, then the timestamp as an 8 byte big-endian integer. A v2
+# signature adds the signing key id (`KEY_ID` below) after the version.
+TIMED_VERSION = b'\x01'
+TIMED_KEYED_VERSION = b'\x02'
+TIMED_TS_SIZE = 8
+
+
+def key_id_prefix(key_id):
+    """Signature prefix naming the signing key: one length byte and the
+    key id. It is also hashed, binding the signature to the key id.
+    """
+    key_id = key_id.encode() if isinstance(key_id, str) else bytes(key_id)
+    if not 0 < len(key_id) < 256:
+        raise ValueError("Key ids must be 1 to 255 bytes.")
+    return bytes((len(key_id),)) + key_id
+
+
 def rstrip_bytes(b):
-    for i in reversed(range(len(b))):
-        if b[i] != 0:
-            break
-    return b[:i+1]
+    """Strip trailing null bytes; empty or all-null input gives `b''`.
+    """
+    i = len(b)
+    while i and b[i-1] == 0:
+        i -= 1
+    return b[:i]
+
+
+class KeyedContextCache(object):
+    """Size-bounded LRU of pre-keyed HMAC contexts indexed by
+    (secret, hashalg).
+
+    Contexts held here are never updated, only `copy()`'d, so they can
+    safely be shared between signers and threads.
+    """
+    def __init__(self, maxsize=1024):
+        """
+        maxsize         int         maximum number of contexts to keep.
+        """
+        self.maxsize = maxsize
+        self._contexts = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, secret, hashalg):
+        """Return the pre-keyed context for `secret` and `hashalg`,
+        keying a new one on a miss.
+        """
+        key = (bytes(secret), hashalg)
+        with self._lock:
+            context = self._contexts.get(key)
+            if context is not None:
+                self._contexts.move_to_end(key)
+                return context
+
+        context = hmac.new(key[0], None, hashalg)
+
+        with self._lock:
+            self._contexts[key] = context
+            while len(self._contexts) > self.maxsize:
+                self._contexts.popitem(last=False)
+        return context
+
+    def clear(self):
+        with self._lock:
+            self._contexts.clear()
+
+    def __len__(self):
+        return len(self._contexts)
+
+
+# Process-wide cache shared by every `Hmac` instance.
+keyed_contexts = KeyedContextCache()
+
+
+def _call_each(func, argsets):
+    """Call `func` with each tuple in `argsets`, returning the result
+    or the raised exception per item.
+    """
+    results = []
+    for args in argsets:
+        try:
+            results.append(func(*args))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _map_many(func, argsets, executor=None, chunksize=256):
+    """Apply `func` to each argument tuple, optionally fanning chunks
+    out over `executor` (e.g. a `concurrent.futures.ThreadPoolExecutor`).
+
+    Inputs smaller than `chunksize` are always handled inline.
+    """
+    argsets = [tuple(args) for args in argsets]
+    if executor is None or len(argsets) <= chunksize:
+        return _call_each(func, argsets)
+
+    chunks = [argsets[i:i+chunksize]
+                for i in range(0, len(argsets), chunksize)]
+    results = []
+    for chunk in executor.map(lambda c: _call_each(func, c), chunks):
+        results.extend(chunk)
+    return results
+
+
+class HmacStream(object):
+    """Incremental HMAC returned by `Hmac.stream` and
+    `Hmac.verify_stream`.
+
+    Feed leading data with `update`, then call `finalize` with any
+    trailing arguments.
+    """
+    def __init__(self, context, finish):
+        self._context = context
+        self._finish = finish
+
+    def update(self, data):
+        if data is not None:
+            self._context.update(data)
+
+    def finalize(self, *args):
+        """
+        *args       arglist     trailing arguments to be hashed.
+        returns     obj         signature for `stream`, True for
+                                `verify_stream`.
+        """
+        for arg in args:
+            self.update(arg)
+        return self._finish(self._context.digest())
 
 
 class Hmac(object):
     """
+    Given a dict of secrets keyed by key id, signatures are prefixed with
+    the signing key's id and verification selects the secret by the id
+    it carries, so old and new keys both verify during rotation at the
+    cost of one dict lookup.
     """
-    def __init__(self, secret, passes=1, hashalg=hashlib.sha256):
+    def __init__(self, secret, passes=1, hashalg=hashlib.sha256,
+                 key_id=None):
         """Initialize HmacClient object.
 
-        secret          str         hmac secret.
+        secret          str         hmac secret, or dict of secrets keyed
+                                    by key id.
         passes          int         number of hmac update passes to use.
+                                    This is not key stretching; hash
+                                    passwords with `authme.password`.
         hashalg         obj         hash algorythm.
         encoding        str         encoding to use on input variables.
+        key_id          str         id of the secret to sign with, when
+                                    `secret` is a dict.
         """
         self.__secret = secret
         self.__passes = passes
         self.__hashalg = hashalg
+        # Pre-keyed contexts, copied per message to skip key setup.
+        if isinstance(secret, dict):
+            if key_id not in secret:
+                raise ValueError("`key_id` must name one of the secrets.")
+            # Key id prefix -> context.
+            self._contexts = {key_id_prefix(id_): keyed_contexts.get(s,
+                                                                  hashalg)
+                              for id_, s in secret.items()}
+            self._key_prefix = key_id_prefix(key_id)
+            self._context = self._contexts[self._key_prefix]
+        else:
+            self._contexts = None
+            self._key_prefix = b''
+            self._context = keyed_contexts.get(secret, hashalg)
 
-    def sign(self, *args):
-        # Rely on the alg for key stretching. Not in this scope.
-        """HMAC that uses multiple passes for key stretching.
+    @property
+    def digest_size(self):
+        return self._context.digest_size
 
-        *args       arglist     arguments to be hashed
-        returns     bstr        bytestring digest hash.
-        """
-        h = hmac.new(self.__secret, None, self.__hashalg)
+    @property
+    def keyed(self):
+        return self._contexts is not None
+
+    def _digest(self, context, *args):
+        # Rely on the alg for key stretching. Not in this scope.
+        h = context.copy()
 
         for _ in range(self.__passes):
             for arg in args:
-                if arg:
+                if arg is not None:
                     h.update(arg)
 
         return h.digest()
 
+    def _context_for(self, key_prefix):
+        """Pre-keyed context for a signature's key id prefix."""
+        context = self._contexts.get(bytes(key_prefix))
+        if context is None:
+            raise authme.exc.SignatureBad("Unknown signing key.")
+        return context
+
+    def _split_key(self, sig):
+        """returns tuple    (context, key id prefix, digest) of `sig`."""
+        if self._contexts is None:
+            return self._context, b'', sig
+        end = 1 + sig[0] if len(sig) else 0
+        return self._context_for(sig[:end]), sig[:end], sig[end:]
+
+    def sign(self, *args):
+        """HMAC that uses multiple passes for key stretching.
+
+        *args       arglist     arguments to be hashed
+        returns     bstr        bytestring digest hash, prefixed with the
+                                key id if keyed.
+        """
+        return self._key_prefix + self._digest(self._context,
+                                               self._key_prefix, *args)
+
+    def _stream_context(self, context, *prefix):
+        if self.__passes != 1:
+            raise ValueError("Streaming requires a single pass signer.")
+        h = context.copy()
+        for arg in prefix:
+            if arg is not None:
+                h.update(arg)
+        return h
+
+    def stream(self):
+        """Incremental equivalent of `sign`.
+
+        returns     HmacStream  finalize() returns the signature.
+        """
+        key_prefix = self._key_prefix
+        return HmacStream(self._stream_context(self._context, key_prefix),
+                          lambda digest: key_prefix + digest)
+
+    def verify_stream(self, sig):
+        """Incremental equivalent of `verify`.
+
+        sig         bstr        bytestring challenge signature.
+        returns     HmacStream  finalize() returns True or raises
+                                SignatureBad.
+        """
+        context, key_prefix, sig = self._split_key(sig)
+
+        def finish(digest):
+            if sig == digest:
+                return True
+            raise authme.exc.SignatureBad("Incorrect HMAC challenge.")
+        return HmacStream(self._stream_context(context, key_prefix), finish)
+
     def challenge(self, challenge, *args):
-        return challenge == self.sign(*args)
+        try:
+            context, key_prefix, sig = self._split_key(challenge)
+        except authme.exc.SignatureBad:
+            return False
+        return sig == self._digest(context, key_prefix, *args)
 
     def verify(self, sig, *args):
         """Verifies HMAC signature by rehashing *args.
@@ -92,45 +305,166 @@ class Hmac(object):
         else:
             raise authme.exc.SignatureBad("Incorrect HMAC challenge.")
 
+    def sign_many(self, argsets, executor=None, chunksize=256):
+        """Sign many messages at once.
+
+        argsets     iterable    tuples of arguments to be hashed.
+        executor    obj         optional `concurrent.futures` executor
+                                used to sign large inputs in parallel.
+        chunksize   int         number of items per executor task.
+
+        returns     list        digest or raised exception per item.
+        """
+        return _map_many(self.sign, argsets, executor=executor,
+                         chunksize=chunksize)
+
+    def verify_many(self, items, executor=None, chunksize=256):
+        """Verify many signatures at once without raising on the
+        first failure.
+
+        items       iterable    tuples of (sig, *args).
+        executor    obj         optional `concurrent.futures` executor
+                                used to verify large inputs in parallel.
+        chunksize   int         number of items per executor task.
+
+        returns     list        True or raised exception per item.
+        """
+        return _map_many(self.verify, items, executor=executor,
+                         chunksize=chunksize)
+
 
 class TimedHmac(Hmac):
     """
     """
     def __init__(self, secret, passes=1, hashalg=hashlib.sha256,
-                    expiry=60, time_provider=time_provider):
+                    expiry=60, time_provider=time_provider,
+                    accept_legacy=True, replay_cache=None, key_id=None):
         """Initialize TimedHmac object.
 
-        secret          str         hmac secret.
+        secret          str         hmac secret, or dict of secrets keyed
+                                    by key id. Keyed signers sign and
+                                    verify only the v2 format, which
+                                    carries the key id.
         passes          int         number of hmac update passes to use.
         hashalg         obj         hash algorythm.
         expiry          int         number of seconds to expire signature.
         time_provider   func        function to get current integer time.
-        encoding        str         encoding to use on input variables.
+        accept_legacy   bool        also verify the old ASCII timestamp
+                                    format (digest + 10 digit timestamp).
+                                    Ignored by keyed signers.
+        replay_cache    obj         optional `authme.replay.ReplayCache`
+                                    rejecting signatures already seen.
+        key_id          str         id of the secret to sign with, when
+                                    `secret` is a dict.
         """
-        Hmac.__init__(self, secret, passes, hashalg)
+        Hmac.__init__(self, secret, passes, hashalg, key_id)
         self._expiry = expiry
         self._time_provider = time_provider
+        self._accept_legacy = accept_legacy
+        self._replay_cache = replay_cache
+        self._signature_size = 1 + self.digest_size + TIMED_TS_SIZE
+        # Version and key id: what precedes the digest.
+        if self.keyed:
+            self._header = TIMED_KEYED_VERSION + self._key_prefix
+        else:
+            self._header = TIMED_VERSION
 
     def sign(self, *args):
         """HMAC that hashes the timestamp and multiple
         passes for key stretching.
 
         *args   arglist     arguments to be hashed.
+        returns bstr        version (+ key id) + digest + 8 byte
+                            timestamp.
         """
-        ts = str(self._time_provider()).encode()
-        digest = Hmac.sign(self, ts, *args)
-        return digest + ts
+        ts = self._time_provider().to_bytes(TIMED_TS_SIZE, 'big')
+        digest = self._digest(self._context, self._header, ts, *args)
+        return self._header + digest + ts
 
-    def challenge(self, challenge, *args):
-        """
+    def _parse_legacy(self, challenge):
+        """Parse an old style `digest + ASCII timestamp` signature.
+
+        returns tuple       (digest, timestamp, signed timestamp bytes)
         """
         challenge = rstrip_bytes(challenge)
-        sig, ts = challenge[:-10], int(challenge[-10:].decode())
+        if len(challenge) < self.digest_size + 10:
+            raise authme.exc.SignatureBad("Signature is too short.")
+        try:
+            ts = int(bytes(challenge[-10:]).decode())
+        except ValueError:
+            raise authme.exc.SignatureBad("Malformed signature timestamp.")
+        return challenge[:-10], ts, (str(ts).encode(),)
+
+    def _parse(self, challenge):
+        """Split a signature and check its timestamp.
+
+        returns tuple       (context, digest, timestamp, signed prefix
+                            args)
+        """
+        context = self._context
+        if self.keyed and challenge[:1] == TIMED_KEYED_VERSION:
+            header_size = 2 + challenge[1] if len(challenge) > 1 else 1
+        elif challenge[:1] == TIMED_VERSION and not self.keyed:
+            header_size = 1
+        else:
+            header_size = None
+
+        if (header_size is not None and len(challenge) ==
+                self._signature_size - 1 + header_size):
+            header = challenge[:header_size]
+            if header_size > 1:
+                context = self._context_for(header[1:])
+            ts_bytes = challenge[-TIMED_TS_SIZE:]
+            sig = challenge[header_size:-TIMED_TS_SIZE]
+            ts = int.from_bytes(ts_bytes, 'big')
+            prefix = (header, ts_bytes)
+        elif self._accept_legacy and not self.keyed:
+            sig, ts, prefix = self._parse_legacy(challenge)
+        else:
+            raise authme.exc.SignatureBad("Unsupported signature format.")
+
         now = self._time_provider()
         delta = now - ts
 
         if abs(delta) > self._expiry:
             raise authme.exc.SignatureTimeout("Signature it too old.")
 
-        chal = Hmac.sign(self, str(ts).encode(), *args)
-        return sig == chal
\ No newline at end of file
+        return context, sig, ts, prefix
+
+    def _accept(self, sig, ts):
+        # Only record signatures that verified, so forgeries can't
+        # poison the cache.
+        if (self._replay_cache is not None and
+                self._replay_cache.seen(sig, ts)):
+            raise authme.exc.SignatureReplayed("Signature was already used.")
+        return True
+
+    def stream(self):
+        """Incremental equivalent of `sign`.
+        """
+        ts = self._time_provider().to_bytes(TIMED_TS_SIZE, 'big')
+        header = self._header
+        return HmacStream(self._stream_context(self._context, header, ts),
+                          lambda digest: header + digest + ts)
+
+    def verify_stream(self, challenge):
+        """Incremental equivalent of `verify`. The timestamp is checked
+        up front, before any data is hashed.
+        """
+        context, sig, ts, prefix = self._parse(challenge)
+
+        def finish(digest):
+            if sig == digest:
+                return self._accept(sig, ts)
+            raise authme.exc.SignatureBad("Incorrect HMAC challenge.")
+        return HmacStream(self._stream_context(context, *prefix), finish)
+
+    def challenge(self, challenge, *args):
+        """
+        """
+        context, sig, ts, prefix = self._parse(challenge)
+
+        chal = self._digest(context, *(prefix + args))
+        if sig != chal:
+            return False
+        return self._accept(sig, ts)
@@ -5,8 +5,15 @@ Author: github.com/adoc
 
 """
 import os
+import base64
+import binascii
 
+import time
 import uuid
+import tempfile
+import threading
+import functools
+import collections
 
 import authme.hmac
 import authme.exc
@@ -16,11 +23,32 @@ import authme.codecs
 random_func = None
 try:
     import cryptu.random
-except NameError:
+except ImportError:
     pass
 else:
     random_func = cryptu.random.read
 
+aead = None
+try:
+    import cryptography.exceptions
+    import cryptography.hazmat.primitives.ciphers.aead as aead
+except ImportError:
+    pass
+
+
+# Default read size for file-like stream sources and the size a received
+# stream may reach before it is spooled to disk.
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_SPOOL_SIZE = 1024 * 1024
+
+
+def iter_chunks(source, size=STREAM_CHUNK_SIZE):
+    """Iterate bytes chunks from an iterable or a file-like object.
+    """
+    if hasattr(source, 'read'):
+        return iter(functools.partial(source.read, size), b'')
+    return iter(source)
+
 
 class Remotes(object):
     """
@@ -28,45 +56,159 @@ class Remotes(object):
     get
     update
     remove
+
+    A remote may hold several `secrets` keyed by key id, with `key_id`
+    naming the one to sign with, for `authme.hmac` key rotation.
+
+    Remotes given to the constructor are permanent. Remotes added later
+    can expire `ttl` seconds after their last use and are evicted least
+    recently used first once there are more than `maxsize` of them.
     """
     # more or less a "defaultdict"? refactor?
     __default_remote = {'secret': None,
                         'key': None,
                         'tight': False}
 
-    def __init__(self, remotes={}, random_id_func=uuid.uuid4):
+    def __init__(self, remotes={}, random_id_func=uuid.uuid4, ttl=None,
+                 maxsize=None, time_provider=time.monotonic, on_evict=None):
+        """
+        remotes         dict        permanent remotes keyed by id.
+        random_id_func  func        generates ids for `add`.
+        ttl             int         seconds an unused remote is kept.
+        maxsize         int         maximum number of non-permanent
+                                    remotes.
+        time_provider   func        function to get the current time.
+        on_evict        func        called with (id, remote, reason) when
+                                    a remote expires or is evicted.
+        """
         self.random_id_func = random_id_func
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.stats = collections.Counter()
+        self._time_provider = time_provider
+        self._tracked = ttl is not None or maxsize is not None
+        # Non-permanent remote ids -> deadline, least recently used first.
+        # With a single ttl this is also earliest deadline first, so
+        # expiry only ever looks at the front.
+        self._deadlines = collections.OrderedDict()
+        self._lock = threading.RLock()
 
         self._remotes = {}
+        self._pinned = set(remotes)
         for k, v in remotes.items():
             self.update(k, v)
 
+    def _touch(self, id_):
+        deadline = None
+        if self.ttl is not None:
+            deadline = self._time_provider() + self.ttl
+        with self._lock:
+            self._deadlines[id_] = deadline
+            self._deadlines.move_to_end(id_)
+            self._evict()
+
+    def _evict(self):
+        with self._lock:
+            if self.ttl is not None:
+                now = self._time_provider()
+                while self._deadlines:
+                    id_, deadline = next(iter(self._deadlines.items()))
+                    if deadline > now:
+                        break
+                    self._drop(id_, 'expired')
+            if self.maxsize is not None:
+                while len(self._deadlines) > self.maxsize:
+                    self._drop(next(iter(self._deadlines)), 'evicted')
+
+    def _drop(self, id_, reason):
+        del self._deadlines[id_]
+        remote = self._remotes.pop(id_, None)
+        self.stats[reason] += 1
+        if self.on_evict is not None:
+            self.on_evict(id_, remote, reason)
+
     def add(self, id=None, vals={}):
         if not id:
             id = self.random_id_func()
         return id, self.update(id, vals)
 
     def get(self, id_):
-        if not id_ in self._remotes:
+        if self._tracked:
+            self._evict()
+        remote = self._remotes.get(id_)
+        if remote is None:
             raise authme.exc.MessageClientBad("Remote id %s is not a valid "
                                               "client." % id_)
-        return self._remotes[id_]
+        if self._tracked and id_ not in self._pinned:
+            self._touch(id_)
+        return remote
 
-    def update(self, id_, val):
+    def _new_remote(self, val):
         remote = self.__default_remote.copy()
         remote.update(val)
-        self._remotes.update({id_: remote})
+        return remote
+
+    def update(self, id_, val):
+        remote = self._new_remote(val)
+        with self._lock:
+            self._remotes[id_] = remote
+            if self._tracked and id_ not in self._pinned:
+                self._touch(id_)
         return remote
 
     def remove(self, id_):
         if not id_ in self._remotes:
             raise authme.exc.MessageClientBad("Remote id %s is not a valid "
                                               "client." % id_)
-        del self._remotes[id_]
+        with self._lock:
+            del self._remotes[id_]
+            self._deadlines.pop(id_, None)
+            self._pinned.discard(id_)
 
     def __contains__(self, id_):
+        if self._tracked:
+            self._evict()
         return id_ in self._remotes
 
+    def is_permanent(self, id_):
+        """returns bool     True if `id_` was given to the constructor,
+                            so it never expires.
+        """
+        return id_ in self._pinned
+
+    def __len__(self):
+        return len(self._remotes)
+
+
+class PassStream:
+    """Stream that passes data through and finalizes to a fixed result.
+    """
+    def __init__(self, result=b''):
+        self._result = result
+
+    def update(self, data):
+        return data
+
+    def finalize(self, *args):
+        return self._result
+
+
+class BufferedStream:
+    """Adapts a whole-value `encrypt`/`decrypt` to the stream protocol for
+    ciphers without `encryptor`/`decryptor`.
+    """
+    def __init__(self, func):
+        self._func = func
+        self._chunks = []
+
+    def update(self, data):
+        self._chunks.append(data)
+        return b''
+
+    def finalize(self):
+        return self._func(b''.join(self._chunks))
+
 
 class PassSigner:
     @classmethod
@@ -77,6 +219,14 @@ class PassSigner:
     def verify(cls, val, *args):
         return True
 
+    @classmethod
+    def stream(cls):
+        return PassStream(None)
+
+    @classmethod
+    def verify_stream(cls, val):
+        return PassStream(True)
+
 
 class PassCipher:
     iv = None
@@ -91,6 +241,14 @@ class PassCipher:
     def decrypt(cls, val):
         return val
 
+    @classmethod
+    def encryptor(cls):
+        return PassStream()
+
+    @classmethod
+    def decryptor(cls):
+        return PassStream()
+
 
 class PassWrapper:
     @classmethod
@@ -110,6 +268,151 @@ class PassWrapper:
         return payload
 
 
+class PooledCipher(object):
+    """One message's view of a pooled cipher context: the context's
+    `encrypt`/`decrypt` bound to a single nonce, exposed as `iv` like a
+    conventional cipher so `Message`, `MessagePipeline` and the streams
+    take it unchanged.
+    """
+    __slots__ = ('context', 'iv')
+
+    def __init__(self, context, nonce):
+        self.context = context
+        self.iv = nonce
+
+    def encrypt(self, val):
+        if isinstance(val, str):
+            val = val.encode()
+        return self.context.encrypt(val, self.iv)
+
+    def decrypt(self, val):
+        return self.context.decrypt(val, self.iv)
+
+    def encryptor(self):
+        if hasattr(self.context, 'encryptor'):
+            return self.context.encryptor(self.iv)
+        return BufferedStream(self.encrypt)
+
+    def decryptor(self):
+        if hasattr(self.context, 'decryptor'):
+            return self.context.decryptor(self.iv)
+        return BufferedStream(self.decrypt)
+
+
+class CipherPool(object):
+    """Initialized cipher contexts keyed by remote id, so each remote's
+    key schedule is computed once rather than per message.
+
+    `context_factory(key)` is called with the remote's `key` and returns
+    a context with `encrypt(val, nonce)` and `decrypt(val, nonce)`, and
+    optionally `encryptor(nonce)`/`decryptor(nonce)` streams. A context
+    must be safe to use from several threads at once. Every message sent
+    gets a fresh random nonce.
+
+    A remote whose `key` changes gets a new context on next use. Only the
+    `maxsize` most recently used contexts are kept. Contexts are built
+    outside the pool's lock, so a slow key schedule only holds up the
+    messages of its own remote.
+    """
+    def __init__(self, context_factory, remotes, nonce_size=None,
+                 maxsize=1024, random_func=random_func or os.urandom):
+        """
+        context_factory func        builds a context from a key, e.g.
+                                    `AesGcmContext`.
+        remotes         Remotes     remotes holding each `key`.
+        nonce_size      int         bytes of nonce per message, default
+                                    the factory's `nonce_size` or 16.
+        maxsize         int         maximum number of contexts kept.
+        random_func     func        returns n random bytes.
+        """
+        if nonce_size is None:
+            nonce_size = getattr(context_factory, 'nonce_size', 16)
+        self.context_factory = context_factory
+        self.remotes = remotes
+        self.nonce_size = nonce_size
+        self.maxsize = maxsize
+        self.random_func = random_func
+        self.stats = collections.Counter()
+        # id -> (key, context), least recently used first.
+        self._contexts = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def context(self, id_):
+        """returns obj      the cipher context for remote `id_`.
+        """
+        key = self.remotes.get(id_)['key']
+        with self._lock:
+            entry = self._contexts.get(id_)
+            if entry is not None and entry[0] == key:
+                self._contexts.move_to_end(id_)
+                self.stats['hits'] += 1
+                return entry[1]
+            self.stats['misses'] += 1
+        context = self.context_factory(key)
+        with self._lock:
+            entry = self._contexts.get(id_)
+            if entry is not None and entry[0] == key:
+                # Built meanwhile by another thread; share theirs.
+                self._contexts.move_to_end(id_)
+                return entry[1]
+            self._contexts[id_] = key, context
+            self._contexts.move_to_end(id_)
+            while len(self._contexts) > self.maxsize:
+                self._contexts.popitem(last=False)
+        return context
+
+    def encrypting(self, id_):
+        """returns PooledCipher     cipher for one message to `id_`, with
+                                    a new nonce.
+        """
+        return PooledCipher(self.context(id_),
+                            self.random_func(self.nonce_size))
+
+    def decrypting(self, id_, nonce):
+        """returns PooledCipher     cipher for one message from `id_`
+                                    sent with `nonce`.
+        """
+        return PooledCipher(self.context(id_), nonce)
+
+    def discard(self, id_):
+        """Drop the context of `id_`, e.g. from `Remotes.on_evict`."""
+        with self._lock:
+            self._contexts.pop(id_, None)
+
+    def clear(self):
+        with self._lock:
+            self._contexts.clear()
+
+    def __len__(self):
+        return len(self._contexts)
+
+
+class AesGcmContext(object):
+    """AES-GCM `CipherPool` context from the `cryptography` package.
+
+    The key (16, 24 or 32 bytes) is expanded once per context; each
+    message is encrypted and authenticated under its own 12 byte nonce.
+    """
+    nonce_size = 12
+
+    def __init__(self, key):
+        """
+        key             bytes       remote's AES key.
+        """
+        if aead is None:
+            raise ImportError("AesGcmContext requires `cryptography`.")
+        self._aead = aead.AESGCM(key)
+
+    def encrypt(self, val, nonce):
+        return self._aead.encrypt(nonce, val, None)
+
+    def decrypt(self, val, nonce):
+        try:
+            return self._aead.decrypt(nonce, val, None)
+        except (cryptography.exceptions.InvalidTag, ValueError):
+            raise authme.exc.CipherBad("Cipher failed to decrypt body.")
+
+
 class Message:
     """Message state object.
     """
@@ -121,12 +424,6 @@ class Message:
         self._signing_params = signing_params or ()
         self._cipher = cipher or PassCipher
 
-        setattr(self.__class__, 'payload', property(self.__class__.get_payload,
-                                                    self.__class__.set_payload))
-        setattr(self.__class__, 'signing_params', property(
-                                                    self.__class__.get_signing_params,
-                                                    self.__class__.set_signing_params))
-
     def get_payload(self):
         """
         """
@@ -135,7 +432,7 @@ class Message:
     def set_payload(self, value):
         """
         """
-        assert isinstance(value, bytes), "`payload` requires bytes."
+        assert authme.codecs.is_buffer(value), "`payload` requires bytes."
         self._payload = value
 
     def get_signing_params(self):
@@ -145,6 +442,13 @@ class Message:
         assert isinstance(value, tuple), "`signing_params` requires a tuple value."
         self._signing_params = value
 
+    # Dispatch through the accessors so subclasses only override those.
+    payload = property(lambda self: self.get_payload(),
+                       lambda self, value: self.set_payload(value))
+    signing_params = property(lambda self: self.get_signing_params(),
+                              lambda self, value:
+                                    self.set_signing_params(value))
+
     def send(self):
         body = self._cipher.encrypt(self.payload)
         signature = self._signer.sign(body, self._cipher.iv, *tuple(self.signing_params))
@@ -158,10 +462,94 @@ class Message:
                 self.payload = payload
                 return self._payload
             else:
-                raise NotImplementedError('Cipher failed to decrypt body.')
+                raise authme.exc.CipherBad('Cipher failed to decrypt body.')
         else:
-            raise NotImplementedError('Signature failed but signer didnt throw'
-                                        'an error.')
+            raise authme.exc.SignatureBad('Signature failed but signer '
+                                          "didn't throw an error.")
+
+
+    def send_stream(self, chunks):
+        """Streaming `send` for large payloads.
+
+        chunks      obj         iterable or file-like of bytes chunks.
+        returns     SendStream  iterate for ciphertext chunks, then read
+                                `signature`.
+        """
+        return SendStream(iter_chunks(chunks), self._signer, self._cipher,
+                          tuple(self.signing_params))
+
+    def receive_stream(self, chunks, nonce, signature,
+                       spool_size=STREAM_SPOOL_SIZE):
+        """Streaming `receive` for large payloads. The whole body is
+        verified (spooling to disk past `spool_size`) before any
+        plaintext is released.
+
+        chunks      obj         iterable or file-like of ciphertext.
+        returns     generator   plaintext chunks.
+        """
+        verifier = self._signer.verify_stream(signature)
+        spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        try:
+            for chunk in iter_chunks(chunks):
+                verifier.update(chunk)
+                spool.write(chunk)
+            verified = verifier.finalize(nonce, *self.signing_params)
+        except:
+            spool.close()
+            raise
+
+        if verified is not True:
+            spool.close()
+            raise authme.exc.SignatureBad('Signature failed but signer '
+                                          "didn't throw an error.")
+        spool.seek(0)
+        return self._release(spool)
+
+    def _release(self, spool):
+        try:
+            decryptor = _stream_for(self._cipher, 'decryptor', 'decrypt')
+            for chunk in iter_chunks(spool):
+                payload = decryptor.update(chunk)
+                if payload:
+                    yield payload
+            payload = decryptor.finalize()
+            if payload:
+                yield payload
+        finally:
+            spool.close()
+
+
+def _stream_for(cipher, stream_attr, func_attr):
+    if hasattr(cipher, stream_attr):
+        return getattr(cipher, stream_attr)()
+    return BufferedStream(getattr(cipher, func_attr))
+
+
+class SendStream:
+    """Iterating yields ciphertext chunks. `nonce` is known up front and
+    `signature` is set once the stream is exhausted.
+    """
+    def __init__(self, chunks, signer, cipher, signing_params):
+        self.nonce = cipher.iv
+        self.signature = None
+        self._chunks = chunks
+        self._signer = signer
+        self._cipher = cipher
+        self._signing_params = signing_params
+
+    def __iter__(self):
+        encryptor = _stream_for(self._cipher, 'encryptor', 'encrypt')
+        signer = self._signer.stream()
+        for chunk in self._chunks:
+            body = encryptor.update(chunk)
+            if body:
+                signer.update(body)
+                yield body
+        body = encryptor.finalize()
+        if body:
+            signer.update(body)
+            yield body
+        self.signature = signer.finalize(self.nonce, *self._signing_params)
 
 
 class JsonMessage(Message):
@@ -173,4 +561,178 @@ class JsonMessage(Message):
 
     def get_signing_params(self):
         return authme.codecs.encode_all(
-                    authme.codecs.JsonArgCodec.encode(*self._signing_params))
\ No newline at end of file
+                    authme.codecs.JsonArgCodec.encode(*self._signing_params))
+
+
+class MessagePipeline(object):
+    """Stateless, reusable equivalent of `Message`/`JsonMessage`.
+
+    Configure one per signer/cipher/codec combination and share it
+    between requests and threads; output is identical to the matching
+    `Message` class. The signer and cipher must themselves be safe to
+    share (`authme.hmac` signers are).
+    """
+    __slots__ = ('signer', 'cipher', 'codec')
+
+    def __init__(self, signer=None, cipher=None, codec=None):
+        """
+        signer      obj         `authme.hmac` signer, default PassSigner.
+        cipher      obj         cipher, default PassCipher.
+        codec       obj         `authme.codecs` arg codec applied to the
+                                payload and signing params, e.g.
+                                JsonArgCodec. None sends raw bytes.
+        """
+        self.signer = signer or PassSigner
+        self.cipher = cipher or PassCipher
+        self.codec = codec
+
+    def _params(self, params):
+        if self.codec is None:
+            return tuple(params)
+        return authme.codecs.encode_all(self.codec.encode(*params))
+
+    def send(self, payload, params=(), cipher=None):
+        """
+        cipher      obj         cipher for this message only, e.g.
+                                `CipherPool.encrypting(remote_id)`.
+        returns     tuple       (ctext, nonce, signature)
+        """
+        cipher = cipher or self.cipher
+        if self.codec is not None:
+            payload = authme.codecs.encode_all(self.codec.encode(payload))[0]
+        body = cipher.encrypt(payload)
+        signature = self.signer.sign(body, cipher.iv, *self._params(params))
+        return body, cipher.iv, signature
+
+    def receive(self, body, nonce, signature, params=(), cipher=None):
+        """
+        cipher      obj         cipher for this message only, e.g.
+                                `CipherPool.decrypting(remote_id, nonce)`.
+        returns     obj         the verified, decrypted and decoded payload.
+        """
+        if self.signer.verify(signature, body, nonce,
+                              *self._params(params)) is not True:
+            raise authme.exc.SignatureBad('Signature failed but signer '
+                                          "didn't throw an error.")
+        payload = (cipher or self.cipher).decrypt(body)
+        if not payload:
+            raise authme.exc.CipherBad('Cipher failed to decrypt body.')
+        if self.codec is not None:
+            payload = self.codec.decode(payload)[0]
+        return payload
+
+
+def b64decode(value):
+    """Strict base64 decode of a signature or nonce received from a
+    remote; malformed input raises SignatureBad.
+    """
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        raise authme.exc.SignatureBad("Malformed base64 value.")
+
+
+class AuthApi(object):
+    """Signs payloads for, and verifies payloads from, remotes by id.
+
+    A packet is a dict of the `payload`, its base64 `signature` and
+    `nonce`, and the `sender_id`. Signatures are `TimedHmac`s of the
+    remote's `secret` (or its `secrets` and `key_id` during key rotation)
+    over the payload bytes, the nonce and any extra signing params, in
+    `Message` order.
+    """
+    message_cls = Message
+    time_provider = staticmethod(authme.hmac.time_provider)
+
+    def __init__(self, sender_id, remotes={}, expiry=600):
+        """
+        sender_id       bytes       id remotes know this side by.
+        remotes         dict        permanent remotes keyed by id, or a
+                                    ready `Remotes` instance.
+        expiry          int         seconds a signature is valid for.
+        """
+        if isinstance(sender_id, str):
+            sender_id = sender_id.encode()
+        self.sender_id = sender_id
+        if not isinstance(remotes, Remotes):
+            remotes = Remotes(remotes)
+        self.remotes = remotes
+        self.expiry = expiry
+
+    @staticmethod
+    def remote_id(id_):
+        """Remote ids are stored as bytes."""
+        return id_.encode() if isinstance(id_, str) else id_
+
+    def add_remote(self, id_, vals={}):
+        return self.remotes.update(self.remote_id(id_), vals)
+
+    def remove_remote(self, id_):
+        self.remotes.remove(self.remote_id(id_))
+
+    def lookup(self, id_):
+        """returns dict     the remote `id_`, or raises MessageClientBad.
+        """
+        return self.remotes.get(self.remote_id(id_))
+
+    def signer(self, remote, expiry=None):
+        """returns TimedHmac    signer for the `remote` dict.
+        """
+        expiry = self.expiry if expiry is None else expiry
+        if remote.get('secrets'):
+            return authme.hmac.TimedHmac(remote['secrets'], expiry=expiry,
+                                         time_provider=self.time_provider,
+                                         key_id=remote['key_id'])
+        return authme.hmac.TimedHmac(remote['secret'], expiry=expiry,
+                                     time_provider=self.time_provider)
+
+    def encode_payload(self, payload):
+        """returns bytes    what is signed for `payload`."""
+        return payload
+
+    def send(self, remote_id, payload, *params):
+        """returns dict     packet for `remote_id`.
+        """
+        return self.pack(self.signer(self.lookup(remote_id)), payload,
+                         *params)
+
+    def pack(self, signer, payload, *params):
+        """returns dict     packet of `payload` signed with `signer`.
+        """
+        message = self.message_cls(payload=self.encode_payload(payload),
+                                   signer=signer, signing_params=params)
+        body, nonce, signature = message.send()
+        return {'payload': payload,
+                'signature': base64.b64encode(signature),
+                'nonce': base64.b64encode(nonce or b''),
+                'sender_id': self.sender_id}
+
+    def verify(self, signer, packet, *params):
+        """Verify `packet` with `signer`.
+
+        returns bool        True or raises a SignatureException.
+        """
+        if not packet.get('signature'):
+            raise authme.exc.SignatureBad("Missing signature.")
+        signature = b64decode(packet['signature'])
+        nonce = b64decode(packet['nonce'] or b'') or None
+        body = self.encode_payload(packet['payload'])
+        return signer.verify(signature, body, nonce, *params)
+
+    def receive(self, packet, *params, expiry=None):
+        """Verify a packet from its `sender_id`.
+
+        params      arglist     extra signed values, e.g. the client
+                                address for tight verification.
+        returns     obj         the verified payload.
+        """
+        signer = self.signer(self.lookup(packet['sender_id']), expiry)
+        self.verify(signer, packet, *params)
+        return packet['payload']
+
+
+class JsonAuthApi(AuthApi):
+    """`AuthApi` for JSON payloads, signed as `codecs.json.dumps` text.
+    """
+    def encode_payload(self, payload):
+        return authme.codecs.json.dumps(payload).encode()
@@ -0,0 +1,132 @@
+"""
+Timing and counter instrumentation for the auth pipeline.
+
+Author: github.com/adoc
+
+"""
+import time
+import bisect
+import threading
+
+
+# Histogram bucket upper bounds in seconds (Prometheus defaults, plus
+# finer buckets for sub-millisecond stages).
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+           0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Timer(object):
+    __slots__ = ('sink', 'stage', 'start')
+
+    def __init__(self, sink, stage):
+        self.sink = sink
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.sink.observe(self.stage, time.perf_counter() - self.start)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+class NullSink(object):
+    """Sink that records nothing. The default.
+    """
+    def observe(self, stage, seconds):
+        pass
+
+    def incr(self, name, value=1):
+        pass
+
+    def timer(self, stage):
+        return _null_timer
+
+
+null_sink = NullSink()
+
+
+class Sink(NullSink):
+    """Base class for recording sinks. Subclasses implement `observe`
+    and `incr`.
+    """
+    def timer(self, stage):
+        """Context manager observing the duration of its block as `stage`.
+        """
+        return _Timer(self, stage)
+
+
+class Registry(Sink):
+    """In-process sink keeping a histogram per stage and counters,
+    rendered in the Prometheus text format.
+    """
+    def __init__(self, prefix='authme', buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                # Per-bucket counts (last is +Inf), sum.
+                histogram = self._histograms[stage] = [
+                                        [0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def count(self, name):
+        return self._counters.get(name, 0)
+
+    def histogram(self, stage):
+        """returns tuple        (observation count, sum of seconds)"""
+        with self._lock:
+            counts, total = self._histograms.get(stage, ((), 0.0))
+            return sum(counts), total
+
+    def render(self):
+        """Prometheus text exposition format."""
+        with self._lock:
+            histograms = {stage: (list(counts), total) for stage, (counts,
+                          total) in self._histograms.items()}
+            counters = dict(self._counters)
+
+        name = '%s_stage_seconds' % self.prefix
+        lines = ['# HELP %s Auth pipeline stage durations.' % name,
+                 '# TYPE %s histogram' % name]
+        bounds = ['%r' % bound for bound in self.buckets] + ['+Inf']
+        for stage, (counts, total) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append('%s_bucket{stage="%s",le="%s"} %d' %
+                             (name, stage, bound, cumulative))
+            lines.append('%s_sum{stage="%s"} %r' % (name, stage, total))
+            lines.append('%s_count{stage="%s"} %d' % (name, stage,
+                                                       cumulative))
+
+        for counter, value in sorted(counters.items()):
+            counter = '%s_%s_total' % (self.prefix, counter)
+            lines.append('# TYPE %s counter' % counter)
+            lines.append('%s %d' % (counter, value))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,197 @@
+"""
+Password hashing with PBKDF2 or scrypt, calibrated to a target latency
+and run in a bounded worker pool.
+
+Author: github.com/adoc
+
+"""
+import os
+import hmac
+import time
+import base64
+import hashlib
+import threading
+import concurrent.futures
+
+import authme.exc
+
+
+PBKDF2 = 'pbkdf2-sha256'
+SCRYPT = 'scrypt'
+
+SALT_SIZE = 16
+HASH_SIZE = 32
+
+# Lower bounds whatever the calibration measures.
+MIN_ITERATIONS = 100000
+MIN_SCRYPT_LOG_N = 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _scrypt(password, salt, log_n, r, p):
+    n = 1 << log_n
+    return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                          maxmem=2 * 128 * r * n + (1 << 20),
+                          dklen=HASH_SIZE)
+
+
+def _derive(algorithm, password, salt, cost):
+    if algorithm == PBKDF2:
+        return hashlib.pbkdf2_hmac('sha256', password, salt, cost, HASH_SIZE)
+    elif algorithm == SCRYPT:
+        return _scrypt(password, salt, cost, SCRYPT_R, SCRYPT_P)
+    raise ValueError("Unknown password hash algorithm %r." % algorithm)
+
+
+def _timed(func, *args):
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def calibrate(algorithm=PBKDF2, target=0.1):
+    """Cost for one hash to take about `target` seconds on this host.
+
+    returns int         PBKDF2 iterations or scrypt log2(N).
+    """
+    if algorithm == PBKDF2:
+        probe = 10000
+        elapsed = _timed(hashlib.pbkdf2_hmac, 'sha256', b'password',
+                         b'salt' * 4, probe)
+        return max(MIN_ITERATIONS, int(probe * target / elapsed))
+    elif algorithm == SCRYPT:
+        # Cost is linear in N, which must be a power of two.
+        log_n = 10
+        elapsed = _timed(_scrypt, b'password', b'salt' * 4, log_n, SCRYPT_R,
+                         SCRYPT_P)
+        while elapsed * 2 <= target:
+            log_n += 1
+            elapsed *= 2
+        return max(MIN_SCRYPT_LOG_N, log_n)
+    raise ValueError("Unknown password hash algorithm %r." % algorithm)
+
+
+def _check(password, encoded):
+    algorithm, cost, salt, digest = parse(encoded)
+    return hmac.compare_digest(_derive(algorithm, password, salt, cost),
+                               digest)
+
+
+def parse(encoded):
+    """returns tuple    (algorithm, cost, salt, hash) of an encoded hash.
+    """
+    try:
+        _, algorithm, cost, salt, digest = encoded.split('$')
+        if algorithm == SCRYPT:
+            params = dict(item.split('=') for item in cost.split(','))
+            if (int(params['r']), int(params['p'])) != (SCRYPT_R, SCRYPT_P):
+                raise ValueError
+            cost = int(params['ln'])
+        else:
+            cost = int(cost)
+        return algorithm, cost, _b64decode(salt), _b64decode(digest)
+    except (ValueError, KeyError):
+        raise ValueError("Malformed password hash.")
+
+
+class PasswordHasher(object):
+    """Hashes and verifies passwords in a bounded pool of threads
+    (`hashlib` releases the GIL while hashing), so a burst of logins
+    queues behind `max_workers` hashes instead of occupying every request
+    thread. Callers beyond `max_workers + max_queue` in flight get
+    `PasswordHasherBusy` rather than waiting.
+
+    Encoded hashes look like `$pbkdf2-sha256$<iterations>$<salt>$<hash>`
+    or `$scrypt$ln=<log2 N>,r=8,p=1$<salt>$<hash>`.
+    """
+    def __init__(self, algorithm=PBKDF2, cost=None, target=0.1,
+                 max_workers=None, max_queue=64, executor=None):
+        """
+        algorithm       str         `PBKDF2` or `SCRYPT`.
+        cost            int         PBKDF2 iterations or scrypt log2(N),
+                                    None to calibrate to `target`.
+        target          float       seconds one hash should take.
+        max_workers     int         hashing threads, defaults to the CPU
+                                    count.
+        max_queue       int         hashes allowed to wait for a worker.
+        executor        obj         `concurrent.futures` executor to use
+                                    instead of an own thread pool, e.g. a
+                                    `ProcessPoolExecutor`.
+        """
+        if algorithm not in (PBKDF2, SCRYPT):
+            raise ValueError("Unknown password hash algorithm %r." %
+                             algorithm)
+        self.algorithm = algorithm
+        self.cost = cost if cost is not None else calibrate(algorithm,
+                                                            target)
+        max_workers = max_workers or os.cpu_count() or 1
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(
+                                    max_workers, thread_name_prefix='authme')
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        # Verified against for unknown users, so they take as long.
+        salt = os.urandom(SALT_SIZE)
+        self._dummy = self._encode(salt, _derive(algorithm, b'', salt,
+                                                 self.cost))
+
+    def _encode(self, salt, digest):
+        if self.algorithm == SCRYPT:
+            cost = 'ln=%d,r=%d,p=%d' % (self.cost, SCRYPT_R, SCRYPT_P)
+        else:
+            cost = str(self.cost)
+        return '$'.join(('', self.algorithm, cost, _b64encode(salt),
+                         _b64encode(digest)))
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise authme.exc.PasswordHasherBusy("Too many password hashes "
+                                                "in progress.")
+        try:
+            return self.executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _encode_password(password):
+        return password.encode() if isinstance(password, str) else password
+
+    def hash(self, password):
+        """returns str      encoded hash of `password` with a new salt.
+        """
+        salt = os.urandom(SALT_SIZE)
+        return self._encode(salt, self._run(_derive, self.algorithm,
+                                            self._encode_password(password),
+                                            salt, self.cost))
+
+    def verify(self, password, encoded=None):
+        """Check `password` against an encoded hash. Without `encoded`
+        (e.g. for an unknown user) a dummy hash is checked so the call
+        takes the same time, and False is returned.
+
+        returns boolean
+        """
+        password = self._encode_password(password)
+        if encoded is None:
+            self._run(_check, password, self._dummy)
+            return False
+        return self._run(_check, password, encoded)
+
+    def needs_rehash(self, encoded):
+        """True if `encoded` uses another algorithm or a lower cost."""
+        algorithm, cost, _, _ = parse(encoded)
+        return algorithm != self.algorithm or cost < self.cost
+
+    def close(self):
+        self.executor.shutdown()
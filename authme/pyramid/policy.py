@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 
 
+import logging
+
 import pyramid.authentication
 
 
@@ -10,6 +12,10 @@ except NameError:
     pass # P1y3 already.
 
 
+# Set up logging.
+logger = logging.getLogger(__name__)
+
+
 try:
     import cryptu.hash
     hashalg = cryptu.hash.shash
@@ -17,32 +23,41 @@ try:
 except ImportError:
     logger.warning("`cryptu` is unavailable. Using less secure hash "
                    "function.")
-    import hashlib
-    hashalg = hashlib.sha512
+    # Pyramid takes the hashlib algorithm name.
+    hashalg = 'sha512'
 
 
 class TktAuthnPolicy(pyramid.authentication.AuthTktAuthenticationPolicy):
     """
     """
 
-    def __init__(self, secret, **kwa):
+    def __init__(self, secret, principals=None, **kwa):
         """(secret, callback=None, cookie_name='auth_tkt', secure=False,
             include_ip=False, timeout=None, reissue_time=None, max_age=None,
             path='/', http_only=False, wild_domain=True, debug=False,
             hashalg=<object object at 0x7f5fb68f1bc0>, parent_domain=False,
             domain=None)
+
+        principals      obj         `authme.sqlalchemy.PrincipalIndex`
+                                    (or any object with `get(userid)`)
+                                    the callback serves principals from.
         """
+        self.principals = principals
         kwa['callback'] = self._policy_callback
         kwa['hashalg'] = kwa.get('hashalg', hashalg)
-        pyramid.authentication.AuthTktAuthenticationPolicy.__init__(secret, kwa)
+        pyramid.authentication.AuthTktAuthenticationPolicy.__init__(self,
+                                                            secret, **kwa)
 
-    def _policy_callback(self, userid):
+    def _policy_callback(self, userid, request):
         # Check if the user exists.
-        pass
+        if self.principals is None:
+            return []
+        principals = self.principals.get(userid)
+        if principals is None:
+            return None
+        return sorted(principals)
 
     def remember(self, request, principal, **kwa):
         # Do stuffs.
         return pyramid.authentication.AuthTktAuthenticationPolicy.remember(
-            request, principal, **kwa)
-
-    
\ No newline at end of file
+            self, request, principal, **kwa)
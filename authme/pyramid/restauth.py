@@ -8,8 +8,15 @@ import pyramid.security
 import pyramid.httpexceptions
 
 import authme.exc
+import authme.hmac
+import authme.codecs
+import authme.message
+import authme.metrics
 
-from message import json, JsonAuthApi, Remotes, AuthException, ClientBad
+from authme.codecs import json
+from authme.message import JsonAuthApi, Remotes
+from authme.exc import AuthMessageException as AuthException
+from authme.exc import MessageClientBad as ClientBad
 
 # Set up logging.
 log = logging.getLogger(__name__)
@@ -51,12 +58,85 @@ def logout_view(request):
 class PyramidAuthApi(JsonAuthApi):
     """
     """
-    def __init__(self, sender_id, remotes={}, expiry=600, tight_expiry=5):
+    def __init__(self, sender_id, remotes={}, expiry=600, tight_expiry=5,
+                 remote_ttl=None, max_remotes=None, raw_body=False,
+                 metrics=None, rate_limiter=None, failure_cost=5,
+                 address_limiter=None):
         """
+        remotes         dict        permanent remotes keyed by id, or a
+                                    ready `Remotes` instance such as
+                                    `authme.shared.SharedRemotes`.
+        remote_ttl      int         seconds an unused remembered remote
+                                    is kept.
+        max_remotes     int         maximum number of remembered remotes,
+                                    least recently used are evicted.
+        raw_body        bool        sign and verify the exact request and
+                                    response body bytes instead of the
+                                    re-serialized JSON payload. Views
+                                    parse the body themselves.
+        metrics         obj         `authme.metrics` sink recording stage
+                                    timings and auth result counters.
+        rate_limiter    obj         `authme.ratelimit.RateLimiter` keyed
+                                    by (sender id, client address),
+                                    checked before any parsing or crypto.
+        failure_cost    int         extra tokens a sender loses for each
+                                    request that fails verification.
+        address_limiter obj         `authme.ratelimit.RateLimiter` keyed
+                                    by client address alone, so rotating
+                                    sender ids doesn't escape the limit.
+                                    Clients behind one NAT share it, so
+                                    size it for them. None (default)
+                                    for no per-address limit.
         """
-        JsonAuthApi.__init__(self, sender_id, remotes=Remotes(remotes))
-        self.expiry = expiry
+        if isinstance(remotes, dict):
+            remotes = Remotes(remotes, ttl=remote_ttl, maxsize=max_remotes,
+                              on_evict=self.remote_evicted)
+        JsonAuthApi.__init__(self, sender_id, remotes=remotes,
+                             expiry=expiry)
         self.tight_expiry = tight_expiry
+        self.raw_body = raw_body
+        self.metrics = metrics or authme.metrics.null_sink
+        self.rate_limiter = rate_limiter
+        self.failure_cost = failure_cost
+        self.address_limiter = address_limiter
+
+    def rate_limit_key(self, request):
+        return (request.headers.get('X-Restauth-Sender-Id', ''),
+                request.client_addr)
+
+    def rate_limits(self, request):
+        """returns list     (limiter, key) pairs `request` is charged
+                            to: its sender at its address, and its
+                            address.
+        """
+        limits = []
+        if self.rate_limiter is not None:
+            limits.append((self.rate_limiter, self.rate_limit_key(request)))
+        if self.address_limiter is not None:
+            limits.append((self.address_limiter, request.client_addr))
+        return limits
+
+    def admit(self, request):
+        """Charge `request` to its sender's and address's rate limits.
+
+        Raises HTTPTooManyRequests if either is over its limit.
+        """
+        for limiter, key in self.rate_limits(request):
+            if not limiter.allow(key):
+                self.metrics.incr('auth_rate_limited')
+                raise pyramid.httpexceptions.HTTPTooManyRequests()
+
+    def penalize(self, request):
+        """Charge a failed verification to the sender's and address's
+        rate limits.
+        """
+        for limiter, key in self.rate_limits(request):
+            limiter.penalize(key, self.failure_cost)
+
+    def remote_evicted(self, remote_id, remote, reason):
+        """Called when a remote expires or is evicted from `remotes`.
+        """
+        log.debug("Remote %s %s." % (remote_id, reason))
 
     def build_client_defaults(self):
         if b'guest' in self.remotes:
@@ -89,24 +169,78 @@ class PyramidAuthApi(JsonAuthApi):
     def set_nonce(self, response, nonce):
         response.headers['X-Restauth-Signature-Nonce'] = nonce.decode()
 
+    def remote_signer(self, remote_id, expiry):
+        """Signer using `remote_id`'s secret, or its `secrets` by key id
+        (signing with `key_id`) during key rotation. The remote lookup is
+        timed as the `lookup` stage.
+        """
+        with self.metrics.timer('lookup'):
+            remote = self.lookup(remote_id)
+        return self.signer(remote, expiry)
+
+    def send_raw(self, request, response):
+        """Sign the response body bytes as they are. Arguments are signed
+        in `Message` order (body, nonce) with no nonce.
+        """
+        body = response.body
+        if body:
+            remote_id, tight = self.parse_sender_id(request)
+            try:
+                signer = self.remote_signer(remote_id.encode(), self.expiry)
+            except ClientBad:
+                signer = self.remote_signer(b'guest', self.expiry)
+
+            with self.metrics.timer('sign'):
+                signature = signer.sign(body, None)
+            self.set_signature(response, base64.b64encode(signature))
+            self.set_nonce(response, b'')
+            self.set_sender_id(response, self.sender_id)
+
+    def receive_raw(self, request):
+        """Verify the request body bytes as they are, without parsing them.
+        """
+        signature = self.parse_signature(request)
+        if not signature:
+            raise authme.exc.SignatureBad("Missing signature.")
+        signature = authme.message.b64decode(signature)
+        nonce = authme.message.b64decode(self.parse_nonce(request))
+        remote_id, tight = self.parse_sender_id(request)
+
+        if tight:
+            signer = self.remote_signer(remote_id.encode(), self.tight_expiry)
+            with self.metrics.timer('verify'):
+                signer.verify(signature, request.body, nonce,
+                              request.client_addr.encode())
+        else:
+            signer = self.remote_signer(remote_id.encode(), self.expiry)
+            with self.metrics.timer('verify'):
+                signer.verify(signature, request.body, nonce)
+
     def send(self, request, response):
         """
         """
+        if self.raw_body:
+            return self.send_raw(request, response)
+
         body = response.body.decode('utf-8')
         if body:
             # Prepare some data for signing.
             remote_id, tight = self.parse_sender_id(request)
 
-            try:
-                payload = json.loads(body)
-            except ValueError:
-                payload = {}
+            with self.metrics.timer('parse'):
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    payload = {}
 
-            # Invoke the Api.
             try:
-                packet = JsonAuthApi.send(self, remote_id.encode(), payload)
+                signer = self.remote_signer(remote_id.encode(), self.expiry)
             except ClientBad: # Make sure we want this here...
-                packet = JsonAuthApi.send(self, b'guest', payload)
+                signer = self.remote_signer(b'guest', self.expiry)
+
+            # Invoke the Api.
+            with self.metrics.timer('sign'):
+                packet = self.pack(signer, payload)
 
             # Add HTTP Headers.
             response.headers['X-Restauth-Signature'] = packet['signature'].decode()
@@ -114,15 +248,38 @@ class PyramidAuthApi(JsonAuthApi):
             response.headers['X-Restauth-Sender-Id'] = packet['sender_id'].decode()
 
     def receive(self, request, default_type=collections.OrderedDict):
+        """Verify `request`, counting the outcome in `metrics`.
         """
+        try:
+            if self.raw_body:
+                self.receive_raw(request)
+            else:
+                self.receive_json(request, default_type)
+        except authme.exc.SignatureTimeout:
+            self.metrics.incr('auth_timeout')
+            raise
+        except authme.exc.SignatureException:
+            self.metrics.incr('auth_bad_signature')
+            raise
+        except (AuthException, ClientBad):
+            self.metrics.incr('auth_unknown_client')
+            raise
+        else:
+            self.metrics.incr('auth_success')
+
+    def receive_json(self, request, default_type=collections.OrderedDict):
+        """Verify the JSON payload of `request`, timing the `parse`,
+        `lookup` and `verify` stages. Bodies are signed, not encrypted, so
+        there is no decryption to time.
         """
         # Get or construct a new payload.
-        try:
-            payload = json.loads(request.body.decode('utf-8'))
-        except ValueError:
-            if default_type is dict:
-                default_type = collections.OrderedDict
-            payload = default_type()
+        with self.metrics.timer('parse'):
+            try:
+                payload = json.loads(request.body.decode('utf-8'))
+            except ValueError:
+                if default_type is dict:
+                    default_type = collections.OrderedDict
+                payload = default_type()
 
         # Prepare some data for unsigning.
         ip_addr = request.client_addr.encode()
@@ -132,32 +289,84 @@ class PyramidAuthApi(JsonAuthApi):
         auth_packet = {'payload': payload, 'signature': signature, 'nonce': nonce, 'sender_id': remote_id}
 
         if tight:
-            print ("tight")
-            # Invoke the Api.
-            JsonAuthApi.receive(self, auth_packet,
-                                ip_addr, expiry=self.tight_expiry)            
+            signer = self.remote_signer(remote_id, self.tight_expiry)
+            params = (ip_addr,)
         else:
-            print ("loose")
             # Try loose receive since tight is not required.
-            JsonAuthApi.receive(self, auth_packet, expiry=self.expiry)
+            signer = self.remote_signer(remote_id, self.expiry)
+            params = ()
+
+        # Invoke the Api.
+        with self.metrics.timer('verify'):
+            self.verify(signer, auth_packet, *params)
+
+
+class SharedAuthenticated(object):
+    """`RestAuthnPolicy.authenticated` for remotes shared between
+    processes. Every non permanent remote was remembered by one of them,
+    and carries the remembered userid.
+    """
+    def __init__(self, remotes):
+        self.remotes = remotes
+
+    def __contains__(self, remote_id):
+        remote_id = JsonAuthApi.remote_id(remote_id)
+        return (not self.remotes.is_permanent(remote_id) and
+                remote_id in self.remotes)
+
+    def get(self, remote_id, default=None):
+        remote_id = JsonAuthApi.remote_id(remote_id)
+        if self.remotes.is_permanent(remote_id):
+            return default
+        try:
+            return self.remotes.get(remote_id).get('userid', default)
+        except ClientBad:
+            return default
+
+    def __setitem__(self, remote_id, userid):
+        # Stored with the remote by `remember`.
+        pass
+
+    def __delitem__(self, remote_id):
+        # `forget` removes the remote itself.
+        pass
+
+    def pop(self, remote_id, default=None):
+        return default
 
 
 class RestAuthnPolicy(PyramidAuthApi):
     """ """
 
     def __init__(self, *args, **kwa):
-        self.authenticated = set()
+        """
+        principals      obj         `authme.sqlalchemy.PrincipalIndex`
+                                    (or any object with `get(userid)`)
+                                    serving the principals of the user
+                                    given to `remember`.
+        """
+        # Remembered remote id -> userid (None if not given).
+        self.authenticated = {}
+        self.principals = kwa.pop('principals', None)
         PyramidAuthApi.__init__(self, *args, **kwa)
+        if getattr(self.remotes, 'shared', False):
+            self.authenticated = SharedAuthenticated(self.remotes)
 
     def remember(self, request, *args):
         """ """
         principal = str(uuid.uuid4())
         secret = base64.b64encode(os.urandom(64))
         
-        self.add_remote(principal, {'secret': secret,
-                                    'key': None,
-                                    'tight': True})
-        self.authenticated.add(principal)
+        remote = {'secret': secret, 'key': None, 'tight': True}
+        if args:
+            remote['userid'] = args[0]
+        try:
+            self.add_remote(principal, remote)
+        except authme.exc.RemotesFull as e:
+            log.error("Can't remember %s: %s", principal, e)
+            raise pyramid.httpexceptions.HTTPServiceUnavailable(
+                                            "Too many remembered remotes.")
+        self.authenticated[principal] = args[0] if args else None
 
         ping_data = ping_view(request)
         ping_data.update({'remotes': {
@@ -166,15 +375,28 @@ class RestAuthnPolicy(PyramidAuthApi):
                                 'secret': secret.decode()}}})
         return ping_data
 
+    def remote_evicted(self, remote_id, remote, reason):
+        PyramidAuthApi.remote_evicted(self, remote_id, remote, reason)
+        self.authenticated.pop(remote_id, None)
+
     def forget(self, request):
         principal = self.authenticated_userid(request)
 
         if principal:
             self.remove_remote(principal)
-            self.authenticated.remove(principal)
+            del self.authenticated[principal]
         else:
             raise ClientBad("Remote %s doesn't exist so can't be forgotten")
 
+    def user_principals(self, remote_id):
+        """Principals of the user remembered for `remote_id`, served from
+        `principals`.
+        """
+        userid = self.authenticated.get(remote_id)
+        if userid is None or self.principals is None:
+            return []
+        return sorted(self.principals.get(userid) or ())
+
     def unauthenticated_userid(self, request):
         return self.parse_sender_id(request)[0]
 
@@ -184,19 +406,37 @@ class RestAuthnPolicy(PyramidAuthApi):
             return userid
 
     def effective_principals(self, request):
+        """Principals for `request`. The request is verified and the
+        response callback registered once; later calls for the same
+        request are served from `request.restauth_principals`.
+        """
+        principals = getattr(request, 'restauth_principals', None)
+        if principals is None:
+            principals = self._effective_principals(request)
+            request.restauth_principals = principals
+        return list(principals)
+
+    def _effective_principals(self, request):
         request.set_property(lambda t: self, 'auth_api')
         remote_id, tight = self.parse_sender_id(request)
 
         principals = [pyramid.security.Everyone]
+        self.admit(request)
         request.add_response_callback(self.send)
 
+        if not self.parse_signature(request):
+            # Unsigned: not a failed attempt, just no authentication.
+            return principals
+
         try:
             self.receive(request)
         except authme.exc.SignatureException as e:
             log.warn("Tight: Signature failed to verify.")
+            self.penalize(request)
             return principals + [Guest]
         except AuthException:
             log.warn("Tight: Sender was not authorized.")
+            self.penalize(request)
             pass
         else:
             if remote_id == 'guest':
@@ -205,7 +445,8 @@ class RestAuthnPolicy(PyramidAuthApi):
             else:
                 log.info("Tight Authenticated!")
                 return principals + [pyramid.security.Authenticated, 
-                                'u:%s' % remote_id]
+                                'u:%s' % remote_id] + self.user_principals(
+                                                                remote_id)
 
         return principals
 
@@ -0,0 +1,102 @@
+"""
+Per-sender rate limiting.
+
+Author: github.com/adoc
+
+"""
+import time
+import threading
+import collections
+
+
+class RateLimiter(object):
+    """Token bucket per key, e.g. (sender id, client address).
+
+    Each key may spend `burst` tokens at once, refilled at `rate` tokens
+    per second. Only the `maxsize` most recently seen keys are tracked.
+    A key pushed out while in debt (after `penalize`) leaves its debt in
+    a fixed size count-min sketch, decaying at `rate`, and comes back
+    owing it; other keys pushed out start again with a full bucket.
+    """
+    # Count-min sketch rows.
+    _debt_rows = 2
+
+    def __init__(self, rate=10, burst=20, maxsize=100000,
+                 time_provider=time.monotonic, debt_slots=4096):
+        """
+        rate            float       tokens added per second.
+        burst           float       bucket size.
+        maxsize         int         maximum number of keys tracked.
+        time_provider   func        function to get the current time.
+        debt_slots      int         cells per sketch row keeping the debt
+                                    of keys pushed out. Keys sharing
+                                    cells may inherit each other's debt.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._time_provider = time_provider
+        # key -> [tokens, last refill], least recently seen first.
+        self._buckets = collections.OrderedDict()
+        # [debt, time] cells.
+        self._debts = [[[0.0, 0.0] for _ in range(debt_slots)]
+                       for _ in range(self._debt_rows)]
+        self._lock = threading.Lock()
+
+    def _debt_cells(self, key):
+        for row, cells in enumerate(self._debts):
+            yield cells[hash((row, key)) % len(cells)]
+
+    def _decayed(self, cell, now):
+        return max(0.0, cell[0] - (now - cell[1]) * self.rate)
+
+    def _debt(self, key, now):
+        return min(self._decayed(cell, now) for cell in self._debt_cells(key))
+
+    def _add_debt(self, key, debt, now):
+        for cell in self._debt_cells(key):
+            cell[0] = self._decayed(cell, now) + debt
+            cell[1] = now
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            debt = self._debt(key, now)
+            bucket = self._buckets[key] = [-debt if debt else self.burst,
+                                           now]
+            while len(self._buckets) > self.maxsize:
+                old_key, (tokens, last) = self._buckets.popitem(last=False)
+                tokens += (now - last) * self.rate
+                if tokens < 0:
+                    self._add_debt(old_key, -tokens, now)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst,
+                            bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def allow(self, key, cost=1):
+        """Spend `cost` tokens of `key`'s bucket.
+
+        returns boolean     False (spending nothing) if there aren't
+                            enough.
+        """
+        now = self._time_provider()
+        with self._lock:
+            bucket = self._bucket(key, now)
+            if bucket[0] < cost:
+                return False
+            bucket[0] -= cost
+            return True
+
+    def penalize(self, key, cost):
+        """Take `cost` more tokens from `key`, e.g. after a failed
+        signature, allowing the bucket to go negative.
+        """
+        now = self._time_provider()
+        with self._lock:
+            self._bucket(key, now)[0] -= cost
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,80 @@
+"""
+Replay protection for timed signatures.
+
+Author: github.com/adoc
+
+"""
+
+import threading
+
+
+class _Shard(object):
+    """A single lock protected timer wheel.
+
+    Each slot holds the bucket id it was last used for and the set of
+    signatures seen in that bucket. A slot belonging to an older bucket
+    is simply replaced, so eviction never scans.
+    """
+    __slots__ = ('lock', 'slots')
+
+    def __init__(self, nslots):
+        self.lock = threading.Lock()
+        self.slots = [(None, None)] * nslots
+
+
+class ReplayCache(object):
+    """Remembers verified signatures until their timestamp expires.
+
+    Signatures are bucketed by their own timestamp, so a lookup only
+    ever touches one set, and memory is bounded by
+    throughput x (2 * expiry) since `TimedHmac` accepts timestamps
+    `expiry` seconds either side of now.
+    """
+    def __init__(self, expiry=600, resolution=1, shards=16):
+        """
+        expiry          int         seconds a signature stays valid. Must
+                                    be at least the signer's expiry.
+        resolution      int         seconds covered by each bucket.
+        shards          int         number of independently locked wheels.
+        """
+        self.expiry = expiry
+        self.resolution = resolution
+        # Enough slots that every bucket in [now-expiry, now+expiry] has
+        # its own slot.
+        self._nslots = 2 * (-(-expiry // resolution)) + 2
+        self._shards = [_Shard(self._nslots) for _ in range(shards)]
+
+    def seen(self, sig, ts):
+        """Record `sig` signed at `ts`.
+
+        sig     bstr        signature digest.
+        ts      int         signature timestamp.
+
+        returns boolean     True if `sig` was already recorded.
+        """
+        sig = bytes(sig)
+        bucket = ts // self.resolution
+        index = bucket % self._nslots
+        shard = self._shards[hash(sig) % len(self._shards)]
+
+        with shard.lock:
+            slot_bucket, sigs = shard.slots[index]
+            if slot_bucket != bucket:
+                sigs = set()
+                shard.slots[index] = (bucket, sigs)
+            elif sig in sigs:
+                return True
+            sigs.add(sig)
+            return False
+
+    def clear(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.slots = [(None, None)] * self._nslots
+
+    def __len__(self):
+        count = 0
+        for shard in self._shards:
+            with shard.lock:
+                count += sum(len(sigs) for _, sigs in shard.slots if sigs)
+        return count
@@ -0,0 +1,420 @@
+"""
+`Remotes` shared by every process on a host through a memory mapped
+file, e.g. the workers of a pre-forking server.
+
+Author: github.com/adoc
+
+"""
+import os
+import time
+import uuid
+import mmap
+import fcntl
+import struct
+import hashlib
+
+import authme.exc
+import authme.message
+
+
+MAGIC = b'AUTHMERT'
+VERSION = 2
+
+# Maximum field sizes in bytes.
+ID_SIZE = 64
+SECRET_SIZE = 128
+KEY_SIZE = 64
+USERID_SIZE = 64
+
+# magic, version, slot count, used slot count, tombstone count.
+_header = struct.Struct('<8sIIII')
+# Table sequence number, odd while the table is compacted.
+_GENERATION = 32
+HEADER_SIZE = 64
+
+# seq, state, flags, id/secret/key/userid lengths, deadline (0 for none).
+_slot = struct.Struct('<IBBBBBBd')
+_seq = struct.Struct('<I')
+_deadline = struct.Struct('<d')
+_DEADLINE = 10
+_ID = 24
+_SECRET = _ID + ID_SIZE
+_KEY = _SECRET + SECRET_SIZE
+_USERID = _KEY + KEY_SIZE
+SLOT_SIZE = _USERID + USERID_SIZE
+
+EMPTY, USED, DELETED = 0, 1, 2
+
+FLAG_TIGHT = 1
+FLAG_SECRET = 2
+FLAG_KEY = 4
+FLAG_USERID = 8
+FLAG_STR_ID = 16
+FLAG_STR_USERID = 32
+FLAG_INT_USERID = 64
+
+
+def _encode_id(id_):
+    """returns tuple    (id bytes, flags) keeping bytes and str ids
+                        distinct, as they are in a dict.
+    """
+    if isinstance(id_, str):
+        return id_.encode(), FLAG_STR_ID
+    return bytes(id_), 0
+
+
+def _slot_hash(encoded, flags):
+    digest = hashlib.blake2b(encoded, digest_size=8,
+                             person=b'%d' % (flags & FLAG_STR_ID)).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def _field(value, size, name):
+    if value is None:
+        return b''
+    value = bytes(value)
+    if len(value) > size:
+        raise ValueError("Remote %s is longer than %d bytes." % (name, size))
+    return value
+
+
+class SharedRemotes(authme.message.Remotes):
+    """`Remotes` in a fixed size open addressing hash table in a shared
+    memory mapped file.
+
+    Reads take no lock: every slot carries a sequence number that writers
+    make odd while they change it, and readers retry until they see the
+    same even number before and after copying the slot. Writers from all
+    processes are serialized with `flock` on the file.
+
+    Remotes hold `secret`, `key`, `tight` and an optional `userid`.
+    Removed slots become tombstones that later inserts reuse. Once more
+    than `compact_ratio` of the slots are tombstones the writer rehashes
+    the table in place, bumping a table wide sequence number that readers
+    also check. Remotes not used for `ttl` seconds expire and their slots
+    are reused; a use rewrites the deadline once half of it has passed.
+    Permanent remotes never expire. There is no `maxsize`: a table with
+    no free or expired slot raises `RemotesFull`.
+    """
+    shared = True
+
+    def __init__(self, path, remotes={}, slots=65536,
+                 random_id_func=lambda: str(uuid.uuid4()), ttl=None,
+                 compact_ratio=0.25, time_provider=time.time):
+        """
+        path            str         file backing the table, created if
+                                    missing. Every process opens the same
+                                    path.
+        remotes         dict        permanent remotes keyed by id.
+        slots           int         table capacity, used when creating the
+                                    file.
+        random_id_func  func        generates ids for `add`.
+        ttl             int         seconds an unused remote is kept,
+                                    None to keep it until removed.
+        compact_ratio   float       share of tombstone slots that
+                                    triggers a rehash.
+        time_provider   func        wall clock, shared by the processes.
+        """
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self._pid = None
+        self._open(slots)
+        authme.message.Remotes.__init__(self, remotes,
+                                        random_id_func=random_id_func,
+                                        ttl=ttl, time_provider=time_provider)
+
+    def _open(self, slots):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < HEADER_SIZE:
+                    os.ftruncate(fd, HEADER_SIZE + slots * SLOT_SIZE)
+                    os.pwrite(fd, _header.pack(MAGIC, VERSION, slots, 0, 0),
+                              0)
+                magic, version, slots, _, _ = _header.unpack(
+                                                os.pread(fd, _header.size, 0))
+                if magic != MAGIC or version != VERSION:
+                    raise ValueError("%s is not a shared remotes table." %
+                                     self.path)
+                self._mmap = mmap.mmap(fd, HEADER_SIZE + slots * SLOT_SIZE)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+        self._slots = slots
+
+    def _writer(self):
+        # flock is held per open file description, which a forked child
+        # shares with its parent, so each process opens its own.
+        if self._pid != os.getpid():
+            self._lock_fd = os.open(self.path, os.O_RDWR)
+            self._pid = os.getpid()
+        return _FileLock(self._lock_fd)
+
+    def close(self):
+        self._mmap.close()
+        if self._pid == os.getpid():
+            os.close(self._lock_fd)
+            self._pid = None
+
+    def _read(self, index):
+        """Consistent copy of slot `index`."""
+        offset = HEADER_SIZE + index * SLOT_SIZE
+        buf = self._mmap
+        while True:
+            seq, = _seq.unpack_from(buf, offset)
+            if not seq & 1:
+                data = buf[offset:offset + SLOT_SIZE]
+                if _seq.unpack_from(buf, offset)[0] == seq:
+                    return data
+            os.sched_yield()
+
+    def _find(self, encoded, flags):
+        """returns tuple    (slot index, slot data), slot data being None
+                            if `encoded` isn't in the table.
+        """
+        buf = self._mmap
+        while True:
+            generation, = _seq.unpack_from(buf, _GENERATION)
+            if not generation & 1:
+                found = self._probe(encoded, flags)
+                if _seq.unpack_from(buf, _GENERATION)[0] == generation:
+                    return found
+            os.sched_yield()
+
+    def _probe(self, encoded, flags):
+        index = _slot_hash(encoded, flags) % self._slots
+        for _ in range(self._slots):
+            data = self._read(index)
+            _, state, slot_flags, id_len = _slot.unpack_from(data)[:4]
+            if state == EMPTY:
+                break
+            if (state == USED and
+                    slot_flags & FLAG_STR_ID == flags & FLAG_STR_ID and
+                    data[_ID:_ID + id_len] == encoded):
+                return index, data
+            index = (index + 1) % self._slots
+        return None, None
+
+    def _write(self, index, state, flags=0, fields=(b'', b'', b'', b''),
+               deadline=0):
+        offset = HEADER_SIZE + index * SLOT_SIZE
+        buf = self._mmap
+        seq, = _seq.unpack_from(buf, offset)
+        _seq.pack_into(buf, offset, seq + 1)
+        buf[offset + 4:offset + SLOT_SIZE] = bytes(SLOT_SIZE - 4)
+        for start, value in zip((_ID, _SECRET, _KEY, _USERID), fields):
+            buf[offset + start:offset + start + len(value)] = value
+        _slot.pack_into(buf, offset, seq + 1, state, flags,
+                        *(len(value) for value in fields), deadline)
+        _seq.pack_into(buf, offset, seq + 2)
+
+    def _set_deadline(self, index, deadline):
+        offset = HEADER_SIZE + index * SLOT_SIZE
+        buf = self._mmap
+        seq, = _seq.unpack_from(buf, offset)
+        _seq.pack_into(buf, offset, seq + 1)
+        _deadline.pack_into(buf, offset + _DEADLINE, deadline)
+        _seq.pack_into(buf, offset, seq + 2)
+
+    def _add_counts(self, used=0, tombstones=0):
+        header = list(_header.unpack_from(self._mmap))
+        header[3] += used
+        header[4] += tombstones
+        _header.pack_into(self._mmap, 0, *header)
+
+    def _expired(self, data, now):
+        deadline, = _deadline.unpack_from(data, _DEADLINE)
+        return 0 < deadline <= now
+
+    def _live(self, id_):
+        """returns bytes    slot data of `id_`, None if it isn't in the
+                            table or expired.
+        """
+        encoded, flags = _encode_id(id_)
+        data = self._find(encoded, flags)[1]
+        if data is None:
+            return None
+        deadline, = _deadline.unpack_from(data, _DEADLINE)
+        if deadline:
+            now = self._time_provider()
+            if deadline <= now:
+                return None
+            if self.ttl is not None and deadline - now < self.ttl / 2:
+                self._touch(encoded, flags, now + self.ttl)
+        return data
+
+    def _touch(self, encoded, flags, deadline):
+        with self._writer():
+            index, data = self._find(encoded, flags)
+            if index is not None and _deadline.unpack_from(
+                                                data, _DEADLINE)[0]:
+                self._set_deadline(index, deadline)
+
+    def get(self, id_):
+        data = self._live(id_)
+        if data is None:
+            raise authme.exc.MessageClientBad("Remote id %s is not a valid "
+                                              "client." % id_)
+        _, _, flags, id_len, secret_len, key_len, userid_len, _ = \
+            _slot.unpack_from(data)
+        remote = {'secret': (data[_SECRET:_SECRET + secret_len]
+                             if flags & FLAG_SECRET else None),
+                  'key': data[_KEY:_KEY + key_len] if flags & FLAG_KEY
+                            else None,
+                  'tight': bool(flags & FLAG_TIGHT)}
+        if flags & FLAG_USERID:
+            userid = data[_USERID:_USERID + userid_len]
+            if flags & FLAG_INT_USERID:
+                userid = int(userid)
+            elif flags & FLAG_STR_USERID:
+                userid = userid.decode()
+            remote['userid'] = userid
+        return remote
+
+    def update(self, id_, val):
+        remote = self._new_remote(val)
+        unknown = set(remote) - {'secret', 'key', 'tight', 'userid'}
+        if unknown:
+            raise TypeError("Shared remotes can't store %s." %
+                            ', '.join(sorted(unknown)))
+        encoded, flags = _encode_id(id_)
+        if len(encoded) > ID_SIZE:
+            raise ValueError("Remote id is longer than %d bytes." % ID_SIZE)
+
+        userid = remote.get('userid')
+        if isinstance(userid, int):
+            userid = b'%d' % userid
+            flags |= FLAG_INT_USERID
+        elif isinstance(userid, str):
+            userid = userid.encode()
+            flags |= FLAG_STR_USERID
+        fields = (encoded,
+                  _field(remote['secret'], SECRET_SIZE, 'secret'),
+                  _field(remote['key'], KEY_SIZE, 'key'),
+                  _field(userid, USERID_SIZE, 'userid'))
+        for flag, value in ((FLAG_SECRET, remote['secret']),
+                            (FLAG_KEY, remote['key']),
+                            (FLAG_USERID, userid)):
+            if value is not None:
+                flags |= flag
+        if remote['tight']:
+            flags |= FLAG_TIGHT
+        deadline = 0
+        if self.ttl is not None and id_ not in self._pinned:
+            deadline = self._time_provider() + self.ttl
+
+        with self._writer():
+            index, data = self._find(encoded, flags)
+            if index is None:
+                index = self._free_slot(_slot_hash(encoded, flags))
+            self._write(index, USED, flags, fields, deadline)
+        return remote
+
+    def _free_slot(self, hashed):
+        """Claim the first empty, tombstone or expired slot from
+        `hashed`.
+        """
+        now = self._time_provider()
+        for probe in range(self._slots):
+            index = (hashed + probe) % self._slots
+            data = self._read(index)
+            state = data[4]
+            if state == EMPTY:
+                self._add_counts(used=1)
+                return index
+            if state == DELETED:
+                self._add_counts(used=1, tombstones=-1)
+                return index
+            if self._expired(data, now):
+                self.stats['expired'] += 1
+                return index
+        raise authme.exc.RemotesFull("Shared remotes table %s is full." %
+                                     self.path)
+
+    def remove(self, id_):
+        encoded, flags = _encode_id(id_)
+        with self._writer():
+            index, data = self._find(encoded, flags)
+            if index is None or self._expired(data, self._time_provider()):
+                raise authme.exc.MessageClientBad("Remote id %s is not a "
+                                                  "valid client." % id_)
+            self._write(index, DELETED)
+            self._add_counts(used=-1, tombstones=1)
+            self._trim(index)
+            if (_header.unpack_from(self._mmap)[4] >
+                    self._slots * self.compact_ratio):
+                self._compact()
+        self._pinned.discard(id_)
+
+    def _trim(self, index):
+        """Empty the tombstones ending at `index` if the next slot is
+        empty, as no probe can pass them.
+        """
+        if self._read((index + 1) % self._slots)[4] != EMPTY:
+            return
+        for _ in range(self._slots):
+            if self._read(index)[4] != DELETED:
+                break
+            self._write(index, EMPTY)
+            self._add_counts(tombstones=-1)
+            index = (index - 1) % self._slots
+
+    def compact(self):
+        """Rehash the live remotes in place, dropping tombstones and
+        expired remotes. Readers wait until it is done.
+
+        returns int         number of live remotes.
+        """
+        with self._writer():
+            return self._compact()
+
+    def _compact(self):
+        buf = self._mmap
+        now = self._time_provider()
+        generation, = _seq.unpack_from(buf, _GENERATION)
+        _seq.pack_into(buf, _GENERATION, generation + 1)
+        try:
+            live = []
+            for index in range(self._slots):
+                offset = HEADER_SIZE + index * SLOT_SIZE
+                data = buf[offset:offset + SLOT_SIZE]
+                if data[4] == USED and not self._expired(data, now):
+                    live.append(data)
+            buf[HEADER_SIZE:] = bytes(self._slots * SLOT_SIZE)
+            for data in live:
+                flags, id_len = data[5], data[6]
+                index = _slot_hash(data[_ID:_ID + id_len],
+                                   flags) % self._slots
+                while buf[HEADER_SIZE + index * SLOT_SIZE + 4] != EMPTY:
+                    index = (index + 1) % self._slots
+                offset = HEADER_SIZE + index * SLOT_SIZE
+                buf[offset:offset + SLOT_SIZE] = data
+                _seq.pack_into(buf, offset, 0)
+            header = list(_header.unpack_from(buf))
+            header[3:5] = len(live), 0
+            _header.pack_into(buf, 0, *header)
+        finally:
+            _seq.pack_into(buf, _GENERATION, generation + 2)
+        return len(live)
+
+    def __contains__(self, id_):
+        return self._live(id_) is not None
+
+    def __len__(self):
+        return _header.unpack_from(self._mmap)[3]
+
+
+class _FileLock(object):
+    __slots__ = ('fd',)
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __enter__(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
@@ -1,9 +1,52 @@
 from __future__ import absolute_import
 
+import time
+import logging
+import threading
+import collections
+import concurrent.futures
+
+import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.orm
+import sqlalchemy.orm.attributes
 import sqlalchemy.orm.exc
 
+import authme.exc
+import authme.message
+
+
+__all__ = ('result_or_none', 'refresh_executor', 'IdentityCache',
+           'UserAdapter', 'PrincipalIndex', 'RemotesAdapter')
+
+
+log = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
 
-__all__ = ('result_or_none', 'UserAdapter')
+def refresh_executor(max_workers=2):
+    """Executor shared by the `IdentityCache`s created without one, so
+    refreshes run on a few threads however many keys go stale.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers, thread_name_prefix='authme-refresh')
+        return _executor
+
+
+def session_bind(Session, Model=None):
+    """Engine or connection `Session` (a `sessionmaker` or
+    `scoped_session`) binds `Model` to.
+    """
+    factory = getattr(Session, 'session_factory', Session)
+    bind = getattr(factory, 'kw', {}).get('bind')
+    if bind is None:
+        bind = Session().get_bind(mapper=Model)
+    return bind
 
 
 def result_or_none(query):
@@ -13,21 +56,831 @@ def result_or_none(query):
         return None
 
 
+class IdentityCache(object):
+    """LRU cache whose entries are fresh for `ttl` seconds, then served
+    stale for up to `stale_ttl` more seconds while a single background
+    refresh reloads them.
+    """
+    def __init__(self, ttl, maxsize=1024, stale_ttl=0, executor=None,
+                 time_provider=time.monotonic):
+        """
+        ttl             int         seconds an entry is fresh.
+        maxsize         int         maximum number of entries.
+        stale_ttl       int         seconds past `ttl` an entry is still
+                                    served while it is refreshed.
+        executor        obj         `concurrent.futures` executor for
+                                    refreshes, None for the shared
+                                    `refresh_executor()`.
+        time_provider   func        function to get the current time.
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.stale_ttl = stale_ttl
+        self.executor = executor
+        self.stats = collections.Counter()
+        self._time_provider = time_provider
+        # key -> (value, fresh until), least recently used first.
+        self._entries = collections.OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """Cached value for `key`, calling `load(key)` on a miss. None
+        results are not cached.
+        """
+        now = self._time_provider()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, fresh_until = entry
+                if now < fresh_until:
+                    self._entries.move_to_end(key)
+                    self.stats['hit'] += 1
+                    return value
+                if now < fresh_until + self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self.stats['stale'] += 1
+                    refresh = key not in self._refreshing
+                    self._refreshing.add(key)
+                else:
+                    del self._entries[key]
+                    entry = None
+        if entry is not None:
+            if refresh:
+                self._submit(key, load)
+            return value
+
+        self.stats['miss'] += 1
+        value = load(key)
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def _submit(self, key, load):
+        executor = self.executor
+        if executor is None:
+            executor = refresh_executor()
+        executor.submit(self._refresh, key, load)
+
+    def _refresh(self, key, load):
+        try:
+            value = load(key)
+        except Exception:
+            log.exception("Refreshing %r failed, serving stale value.", key)
+            value = None
+        else:
+            if value is None:
+                self.invalidate(key)
+            else:
+                self.put(key, value)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, self._time_provider() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats['evicted'] += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_values(self, predicate):
+        """Drop every entry whose value satisfies `predicate`."""
+        with self._lock:
+            for key in [key for key, (value, _) in self._entries.items()
+                            if predicate(value)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def detached_copy(instance):
+    """Detached copy of the loaded column attributes of a persistent ORM
+    `instance`, safe to keep across sessions and threads.
+    """
+    state = sqlalchemy.inspect(instance)
+    copy = state.mapper.class_manager.new_instance()
+    for attr in state.mapper.column_attrs:
+        if attr.key in state.dict:
+            sqlalchemy.orm.attributes.set_committed_value(
+                                        copy, attr.key, state.dict[attr.key])
+    sqlalchemy.orm.make_transient_to_detached(copy)
+    return copy
+
+
 class UserAdapter(object):
-    """ """
-    def __init__(self, Session, UserModel, GroupModel, username_attr="name"):
+    """
+    With `cache_ttl` set, users are cached by id and by name. Cached
+    users are loaded through a private session, so only committed rows
+    are cached, and are attached to the caller's session without a
+    query; updates and deletes flushed through the ORM invalidate them,
+    again once the flushing session commits, so a user reloaded from the
+    old row meanwhile isn't kept. `close` removes the adapter's ORM event
+    listeners.
+    """
+    user_principal = 'u:%s'
+    group_principal = 'g:%s'
+    permission_principal = 'p:%s'
+
+    def __init__(self, Session, UserModel, GroupModel, username_attr="name",
+                 cache_ttl=None, cache_maxsize=1024, stale_ttl=0,
+                 executor=None, time_provider=time.monotonic,
+                 groups_attr="groups", permissions_attr="permissions",
+                 name_attr="name", password_hasher=None,
+                 password_attr="password", active_attr="active",
+                 bind=None):
+        """
+        cache_ttl       int         seconds a cached user is fresh, None
+                                    to query on every lookup.
+        cache_maxsize   int         maximum users cached by id (and by
+                                    name).
+        stale_ttl       int         seconds past `cache_ttl` a user is
+                                    still served while one background
+                                    query refreshes it.
+        executor        obj         `concurrent.futures` executor for
+                                    refreshes, default the shared
+                                    `refresh_executor()`.
+        time_provider   func        function to get the current time.
+        groups_attr     str         user relationship to their groups.
+        permissions_attr str        group relationship to its
+                                    permissions, None if groups have none.
+        name_attr       str         group and permission name column.
+        password_hasher obj         `authme.password.PasswordHasher` for
+                                    `verify_credentials`.
+        password_attr   str         user column holding the encoded
+                                    password hash.
+        active_attr     str         user and group flag; inactive users
+                                    have no principals and inactive
+                                    groups grant none. None to ignore.
+        bind            obj         engine or connection cache loads
+                                    use, default `Session`'s bind.
+        """
         self.Session = Session
         self.UserModel = UserModel
         self.GroupModel = GroupModel
         self._username_attr = username_attr
+        self._groups_attr = groups_attr
+        self._permissions_attr = permissions_attr
+        self._name_attr = name_attr
+        self.password_hasher = password_hasher
+        self._password_attr = password_attr
+        self._active_attr = active_attr
+        self._bind = bind
+        self._by_id = self._by_name = None
+        self._listeners = []
+        if cache_ttl is not None:
+            self._by_id = IdentityCache(cache_ttl, cache_maxsize,
+                                        stale_ttl, executor, time_provider)
+            self._by_name = IdentityCache(cache_ttl, cache_maxsize,
+                                          stale_ttl, executor, time_provider)
+            for event in ('after_update', 'after_delete'):
+                self._listen(UserModel, event, self._on_change)
+            for event in ('after_commit', 'after_soft_rollback'):
+                self._listen(Session, event, self._settle)
 
-    def get_user_by_id(self, userid):
+    def _listen(self, target, event, func):
+        sqlalchemy.event.listen(target, event, func)
+        self._listeners.append((target, event, func))
+
+    def close(self):
+        """Remove the ORM event listeners; cached users are no longer
+        invalidated by changes.
+        """
+        while self._listeners:
+            sqlalchemy.event.remove(*self._listeners.pop())
+
+    def _session(self):
+        if self._bind is None:
+            self._bind = session_bind(self.Session, self.UserModel)
+        return sqlalchemy.orm.Session(bind=self._bind)
+
+    def _query_user_by_id(self, userid, session=None):
+        session = self.Session if session is None else session
         return result_or_none(lambda:
-                self.Session.query(self.UserModel).get(userid))
+                session.query(self.UserModel).get(userid))
 
-    def get_user_by_name(self, username):
+    def _query_user_by_name(self, username, session=None):
+        session = self.Session if session is None else session
         attr = getattr(self.UserModel, self._username_attr)
         return result_or_none(lambda:
-                (self.Session.query(self.UserModel)
+                (session.query(self.UserModel)
                         .filter(attr == username).one()))
 
+    def _cached(self, cache, query, key):
+        def load(key):
+            # Refreshes run on other threads: never touch `self.Session`.
+            with self._session() as session:
+                user = query(key, session)
+                return None if user is None else detached_copy(user)
+        user = cache.get(key, load)
+        if user is None:
+            return None
+        # Prefer the session's own instance (it may have local changes).
+        existing = self.Session.identity_map.get(
+                                        sqlalchemy.inspect(user).key)
+        if existing is not None:
+            return existing
+        return self.Session.merge(user, load=False)
+
+    def get_user_by_id(self, userid):
+        if self._by_id is None:
+            return self._query_user_by_id(userid)
+        return self._cached(self._by_id, self._query_user_by_id, userid)
+
+    def get_user_by_name(self, username):
+        if self._by_name is None:
+            return self._query_user_by_name(username)
+        return self._cached(self._by_name, self._query_user_by_name,
+                            username)
+
+    def _get_users_by(self, column, keys, by_name):
+        keys = list(set(keys))
+        if not keys:
+            return {}
+        users = {}
+        for user in self.Session.query(self.UserModel).filter(
+                                                    column.in_(keys)):
+            userid = sqlalchemy.inspect(user).identity[0]
+            username = getattr(user, self._username_attr)
+            users[username if by_name else userid] = user
+            if self._by_id is not None:
+                # Warm the cache for the single user lookups.
+                copy = detached_copy(user)
+                self._by_id.put(userid, copy)
+                self._by_name.put(username, copy)
+        return users
+
+    def get_users_by_ids(self, userids):
+        """Users for `userids` in one query.
+
+        returns dict        {userid: user} for the users that exist.
+        """
+        return self._get_users_by(
+                    sqlalchemy.inspect(self.UserModel).primary_key[0],
+                    userids, False)
+
+    def get_users_by_names(self, usernames):
+        """Users for `usernames` in one query.
+
+        returns dict        {username: user} for the users that exist.
+        """
+        return self._get_users_by(
+                    getattr(self.UserModel, self._username_attr), usernames,
+                    True)
+
+    def _active(self, obj):
+        return (self._active_attr is None or
+                bool(getattr(obj, self._active_attr, True)))
+
+    def _query_principals(self, *criterion):
+        """Active users matching `criterion` with their groups and the
+        groups' permissions eager loaded in the same query.
+        """
+        groups = getattr(self.UserModel, self._groups_attr)
+        load = sqlalchemy.orm.joinedload(groups)
+        if self._permissions_attr is not None:
+            load = load.joinedload(getattr(self.GroupModel,
+                                           self._permissions_attr))
+        active = getattr(self.UserModel, self._active_attr or '', None)
+        if active is not None:
+            criterion += (active == sqlalchemy.true(),)
+        return (self.Session.query(self.UserModel).options(load)
+                        .filter(*criterion).all())
+
+    def principals_of(self, user):
+        """returns list     user, group and permission principals of an
+                            ORM `user`, empty if it is inactive.
+        """
+        if not self._active(user):
+            return []
+        principals = [self.user_principal %
+                      sqlalchemy.inspect(user).identity[0]]
+        permissions = set()
+        for group in getattr(user, self._groups_attr):
+            if not self._active(group):
+                continue
+            principals.append(self.group_principal %
+                              getattr(group, self._name_attr))
+            if self._permissions_attr is not None:
+                permissions.update(getattr(permission, self._name_attr)
+                                   for permission in
+                                   getattr(group, self._permissions_attr))
+        principals.extend(self.permission_principal % permission
+                          for permission in sorted(permissions))
+        return principals
+
+    def get_principals(self, userid):
+        """Load the user, their groups and the groups' permissions in one
+        eager loaded query.
+
+        returns list        user, group and permission principals, or
+                            None if there is no such active user.
+        """
+        pk = sqlalchemy.inspect(self.UserModel).primary_key[0]
+        users = self._query_principals(pk == userid)
+        if not users:
+            return None
+        return self.principals_of(users[0])
+
+    def set_password(self, user, password):
+        """Store a new hash of `password` on `user`. The caller commits.
+        """
+        setattr(user, self._password_attr,
+                self.password_hasher.hash(password))
+
+    def verify_credentials(self, username, password):
+        """Check a username and password. Unknown users cost as much as
+        known ones. Hashes made with an older algorithm or a lower cost
+        are upgraded on `user` (the caller commits).
+
+        returns obj         the user, or None if the credentials are
+                            wrong or the user is inactive.
+        """
+        user = self.get_user_by_name(username)
+        encoded = None
+        if user is not None:
+            encoded = getattr(user, self._password_attr)
+        if not self.password_hasher.verify(password, encoded):
+            return None
+        if not self._active(user):
+            return None
+        if self.password_hasher.needs_rehash(encoded):
+            self.set_password(user, password)
+        return user
+
+    def invalidate(self, userid=None, username=None):
+        """Drop a user from the cache, by id and/or name, or every user
+        when neither is given.
+        """
+        if self._by_id is None:
+            return
+        if userid is None and username is None:
+            self._by_id.clear()
+            self._by_name.clear()
+            return
+        if username is not None:
+            self._by_name.invalidate(username)
+        if userid is not None:
+            self._by_id.invalidate(userid)
+            self._by_name.discard_values(lambda user:
+                        sqlalchemy.inspect(user).identity == (userid,))
+
+    def _on_change(self, mapper, connection, target):
+        state = sqlalchemy.inspect(target)
+        # Both the current and, if it was renamed, the previous name.
+        history = state.attrs[self._username_attr].history
+        changes = {(None, username) for username in (history.deleted or ())}
+        userid = state.identity[0] if len(state.identity) == 1 else None
+        changes.add((userid, getattr(target, self._username_attr)))
+        # Per session: (userid, username) changed in its uncommitted
+        # transaction.
+        session = sqlalchemy.orm.object_session(target)
+        if session is not None:
+            session.info.setdefault(self, set()).update(changes)
+        for userid, username in changes:
+            self.invalidate(userid, username)
+
+    def _settle(self, session, *args):
+        for userid, username in session.info.pop(self, ()):
+            self.invalidate(userid, username)
+
+
+class PrincipalIndex(object):
+    """Materialized userid -> frozenset of principals, built from a
+    `UserAdapter`'s users, groups and permissions.
+
+    Lookups are one dict lookup once a user is indexed; at most `maxsize`
+    users (and unknown or inactive userids) are kept, least recently used
+    dropped first. Group membership, group permission, group and user
+    update, user insert and user delete changes made through the ORM drop
+    the affected users, who are reloaded on next lookup. Changes made
+    outside the ORM need `invalidate`/`invalidate_group`. `close` removes
+    the index's ORM event listeners.
+    """
+    def __init__(self, users, maxsize=100000):
+        """
+        users           obj         `UserAdapter`.
+        maxsize         int         maximum userids indexed.
+        """
+        self.users = users
+        self.maxsize = maxsize
+        # userid -> (principals or None, group identities), least
+        # recently used first.
+        self._principals = collections.OrderedDict()
+        # group identity -> userids indexed as its members.
+        self._members = collections.defaultdict(set)
+        self._lock = threading.RLock()
+        self._listeners = []
+
+        UserModel, GroupModel = users.UserModel, users.GroupModel
+        groups = getattr(UserModel, users._groups_attr)
+        for event in ('append', 'remove'):
+            self._listen(groups, event, self._user_changed)
+            if users._permissions_attr is not None:
+                self._listen(getattr(GroupModel, users._permissions_attr),
+                             event, self._group_changed)
+        for event in ('after_insert', 'after_update', 'after_delete'):
+            self._listen(UserModel, event, self._user_flushed)
+        for event in ('after_update', 'after_delete'):
+            self._listen(GroupModel, event, self._group_flushed)
+        # Drop again once the change is visible to other sessions, in case
+        # a concurrent lookup reindexed the old rows in between.
+        for event in ('after_commit', 'after_soft_rollback'):
+            self._listen(users.Session, event, self._settle)
+
+    def _listen(self, target, event, func):
+        sqlalchemy.event.listen(target, event, func)
+        self._listeners.append((target, event, func))
+
+    def close(self):
+        """Remove the ORM event listeners; the index is no longer
+        invalidated by changes.
+        """
+        while self._listeners:
+            sqlalchemy.event.remove(*self._listeners.pop())
+
+    def get(self, userid):
+        """returns frozenset    principals of `userid`, or None if there
+                                is no such active user.
+        """
+        with self._lock:
+            entry = self._principals.get(userid)
+            if entry is not None:
+                self._principals.move_to_end(userid)
+                return entry[0]
+        pk = sqlalchemy.inspect(self.users.UserModel).primary_key[0]
+        principals = self._index(self.users._query_principals(
+                                                    pk == userid)).get(userid)
+        if principals is None:
+            self._put(userid, None, ())
+        return principals
+
+    def build(self, userids=None):
+        """Index `userids`, or every active user, in one query.
+
+        returns int         number of users indexed.
+        """
+        criterion = ()
+        if userids is not None:
+            pk = sqlalchemy.inspect(self.users.UserModel).primary_key[0]
+            criterion = (pk.in_(list(userids)),)
+        return len(self._index(self.users._query_principals(*criterion)))
+
+    def _index(self, users):
+        indexed = {}
+        for user in users:
+            userid = sqlalchemy.inspect(user).identity[0]
+            groups = [sqlalchemy.inspect(group).identity for group in
+                      getattr(user, self.users._groups_attr)]
+            indexed[userid] = frozenset(self.users.principals_of(user))
+            self._put(userid, indexed[userid], groups)
+        return indexed
+
+    def _put(self, userid, principals, groups):
+        with self._lock:
+            self._drop(userid)
+            self._principals[userid] = (principals, groups)
+            for group in groups:
+                self._members[group].add(userid)
+            while len(self._principals) > self.maxsize:
+                self._drop(next(iter(self._principals)))
+
+    def _drop(self, userid):
+        entry = self._principals.pop(userid, None)
+        if entry is not None:
+            for group in entry[1]:
+                members = self._members.get(group)
+                if members is not None:
+                    members.discard(userid)
+                    if not members:
+                        del self._members[group]
+
+    def invalidate(self, userid=None):
+        """Drop one user, or every user, from the index."""
+        with self._lock:
+            if userid is None:
+                self._principals.clear()
+                self._members.clear()
+            else:
+                self._drop(userid)
+
+    def invalidate_group(self, group_id):
+        """Drop every indexed member of a group, by its primary key."""
+        if not isinstance(group_id, tuple):
+            group_id = (group_id,)
+        with self._lock:
+            for userid in list(self._members.get(group_id, ())):
+                self._drop(userid)
+
+    def __contains__(self, userid):
+        return userid in self._principals
+
+    def __len__(self):
+        return len(self._principals)
+
+    def _changed(self, target, kind, identity):
+        # Per session: ('user' | 'group', identity) changed in its
+        # uncommitted transaction.
+        session = sqlalchemy.orm.object_session(target)
+        if session is not None:
+            session.info.setdefault(self, set()).add((kind, identity))
+
+    def _user_changed(self, target, value, initiator):
+        identity = sqlalchemy.inspect(target).identity
+        if identity is not None:
+            self._changed(target, 'user', identity[0])
+            self.invalidate(identity[0])
+
+    def _group_changed(self, target, value, initiator):
+        identity = sqlalchemy.inspect(target).identity
+        if identity is not None:
+            self._changed(target, 'group', identity)
+            self.invalidate_group(identity)
+
+    def _user_flushed(self, mapper, connection, target):
+        # Inserted users have no identity yet.
+        userid = mapper.primary_key_from_instance(target)[0]
+        self._changed(target, 'user', userid)
+        self.invalidate(userid)
+
+    def _group_flushed(self, mapper, connection, target):
+        self._group_changed(target, None, None)
+
+    def _settle(self, session, *args):
+        for kind, identity in session.info.pop(self, ()):
+            if kind == 'user':
+                self.invalidate(identity)
+            else:
+                self.invalidate_group(identity)
+
+
+class RemotesAdapter(authme.message.Remotes):
+    """`Remotes` stored in a database table with a read-through cache.
+
+    Lookups are served from the cache and fall back to one primary key
+    query; misses are not cached. Cached remotes expire `ttl` seconds
+    after their last use and are evicted least recently used first once
+    there are more than `maxsize` of them, so removals by other
+    processes sharing the table are seen within `ttl` seconds.
+
+    Writes go to the cache immediately and are queued, coalesced per
+    remote, and written in one batch by a background timer, at the
+    latest `flush_interval` seconds after the first queued write, or as
+    soon as `batch_size` writes are pending.
+
+    The adapter reads and writes through its own sessions bound to
+    `Session`'s engine, so flushing never commits or rolls back the
+    application's work.
+    """
+    _fields = ('secret', 'key', 'tight')
+    # Stored only if `RemoteModel` has a column for them.
+    _optional_fields = ('userid', 'secrets', 'key_id')
+
+    def __init__(self, Session, RemoteModel, remotes={}, id_attr="remote_id",
+                 batch_size=100, flush_interval=1.0, ttl=60, maxsize=10000,
+                 time_provider=time.monotonic, bind=None, **kwa):
+        """
+        Session         obj         session factory or `scoped_session`
+                                    whose bind the adapter uses.
+        RemoteModel     obj         mapped class with `id_attr` and the
+                                    `secret`, `key` and `tight` columns,
+                                    and optionally `userid`, `secrets`
+                                    and `key_id` columns.
+        batch_size      int         pending writes that trigger a flush.
+        flush_interval  float       seconds a queued write may wait for
+                                    its flush, None to flush only on
+                                    `batch_size` or `close`.
+        ttl             int         seconds an unused remote stays
+                                    cached, None to cache until evicted.
+        maxsize         int         maximum number of cached remotes,
+                                    None for no limit.
+        bind            obj         engine or connection for the
+                                    adapter's sessions, default
+                                    `Session`'s bind.
+        """
+        self.Session = Session
+        self.RemoteModel = RemoteModel
+        self._id_attr = id_attr
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._bind = (bind if bind is not None else
+                      session_bind(Session, RemoteModel))
+        columns = sqlalchemy.inspect(RemoteModel).column_attrs.keys()
+        self._stored = self._fields + tuple(field for field in
+                        self._optional_fields if field in columns)
+        # remote id -> remote dict, or None for a pending delete.
+        self._pending = {}
+        # Bumped on every write, so a lookup racing one doesn't cache
+        # what it read from the database.
+        self._writes = 0
+        self._last_flush = time_provider()
+        self._timer = None
+        self._timer_delay = None
+        self._flush_lock = threading.Lock()
+        authme.message.Remotes.__init__(self, ttl=ttl, maxsize=maxsize,
+                                        time_provider=time_provider, **kwa)
+        self._pinned = {self._key(id_) for id_ in remotes}
+        for id_, val in remotes.items():
+            self.update(id_, val)
+
+    @staticmethod
+    def _key(id_):
+        """Normalize remote ids (bytes, str or UUID) to the stored str."""
+        if isinstance(id_, bytes):
+            return id_.decode()
+        return str(id_)
+
+    def _session(self):
+        return sqlalchemy.orm.Session(bind=self._bind)
+
+    def _load(self, key):
+        with self._session() as session:
+            row = session.query(self.RemoteModel).get(key)
+            if row is None:
+                return None
+            return self._new_remote({field: getattr(row, field)
+                                     for field in self._stored
+                                     if field in self._fields or
+                                        getattr(row, field) is not None})
+
+    def _cache(self, key, remote):
+        with self._lock:
+            self._remotes[key] = remote
+            if self._tracked and key not in self._pinned:
+                self._touch(key)
+
+    def _lookup(self, key):
+        with self._lock:
+            if self._tracked:
+                self._evict()
+            if key in self._remotes:
+                if self._tracked and key not in self._pinned:
+                    self._touch(key)
+                return self._remotes[key]
+            if key in self._pending:
+                # Queued upsert, or None for a queued delete.
+                return self._pending[key]
+            writes = self._writes
+        remote = self._load(key)
+        if remote is not None:
+            with self._lock:
+                if self._writes == writes and key not in self._remotes:
+                    self._cache(key, remote)
+        return remote
+
+    def get(self, id_):
+        remote = self._lookup(self._key(id_))
+        if remote is None:
+            raise authme.exc.MessageClientBad("Remote id %s is not a valid "
+                                              "client." % id_)
+        return remote
+
+    def update(self, id_, val):
+        key = self._key(id_)
+        remote = self._new_remote(val)
+        unknown = set(remote) - set(self._stored)
+        if unknown:
+            raise TypeError("%s can't store %s." % (
+                            self.RemoteModel.__name__,
+                            ', '.join(sorted(unknown))))
+        with self._lock:
+            self._writes += 1
+            self._cache(key, remote)
+            self._pending[key] = remote
+        self._maybe_flush()
+        return remote
+
+    def remove(self, id_):
+        key = self._key(id_)
+        if self._lookup(key) is None:
+            raise authme.exc.MessageClientBad("Remote id %s is not a valid "
+                                              "client." % id_)
+        with self._lock:
+            self._writes += 1
+            self._remotes.pop(key, None)
+            self._deadlines.pop(key, None)
+            self._pinned.discard(key)
+            self._pending[key] = None
+        self._maybe_flush()
+
+    def __contains__(self, id_):
+        return self._lookup(self._key(id_)) is not None
+
+    def is_permanent(self, id_):
+        return self._key(id_) in self._pinned
+
+    def invalidate(self, id_=None):
+        """Drop one remote (or all remotes) from the cache so the next
+        lookup reads the database. Pending writes are kept.
+        """
+        with self._lock:
+            self._writes += 1
+            if id_ is None:
+                self._remotes.clear()
+                self._deadlines.clear()
+            else:
+                self._remotes.pop(self._key(id_), None)
+                self._deadlines.pop(self._key(id_), None)
+
+    def _maybe_flush(self):
+        if (len(self._pending) >= self.batch_size or
+                (self.flush_interval is not None and
+                 self._time_provider() - self._last_flush >=
+                    self.flush_interval)):
+            self._schedule(0)
+        else:
+            self._schedule(self.flush_interval)
+
+    def _schedule(self, delay):
+        """Start the timer flushing queued writes in `delay` seconds,
+        unless one already runs as soon.
+        """
+        if delay is None:
+            return
+        with self._lock:
+            if not self._pending:
+                return
+            if self._timer is not None:
+                if self._timer_delay <= delay:
+                    return
+                self._timer.cancel()
+            timer = threading.Timer(delay, self._timed_flush)
+            timer.args = (timer,)
+            timer.daemon = True
+            self._timer, self._timer_delay = timer, delay
+            timer.start()
+
+    def _timed_flush(self, timer):
+        with self._lock:
+            if self._timer is timer:
+                self._timer = None
+        try:
+            self.flush()
+        except Exception:
+            log.exception("Flushing remotes failed, retrying in %s "
+                          "seconds.", self.flush_interval)
+            self._schedule(self.flush_interval)
+
+    def flush(self):
+        """Write all pending changes in one transaction.
+
+        returns     int         number of remotes written or deleted.
+        """
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = self._time_provider()
+        if not pending:
+            return 0
+
+        Model = self.RemoteModel
+        id_col = getattr(Model, self._id_attr)
+        deletes = [key for key, remote in pending.items() if remote is None]
+        upserts = {key: remote for key, remote in pending.items()
+                        if remote is not None}
+        try:
+            with self._session() as session, session.begin():
+                if deletes:
+                    (session.query(Model).filter(id_col.in_(deletes))
+                            .delete(synchronize_session=False))
+                if upserts:
+                    rows = {getattr(row, self._id_attr): row for row in
+                            session.query(Model)
+                                    .filter(id_col.in_(list(upserts)))}
+                    for key, remote in upserts.items():
+                        row = rows.get(key)
+                        if row is None:
+                            row = Model(**{self._id_attr: key})
+                            session.add(row)
+                        for field in self._stored:
+                            setattr(row, field, remote.get(field))
+        except:
+            # Requeue anything not superseded by a newer write.
+            with self._lock:
+                for key, remote in pending.items():
+                    self._pending.setdefault(key, remote)
+            raise
+        return len(pending)
+
+    def close(self):
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        self.flush()
@@ -3,6 +3,8 @@ requires `apothecary`
 """
 
 
+import sqlalchemy as sa
+
 import apothecary.modelmix.auth
 import apothecary.modelmix.sec
 
@@ -32,3 +34,13 @@ class PermissionMix(IdMix, apothecary.modelmix.auth.permission_mix()):
     """ """
     pass
 
+
+
+class RemoteMix(object):
+    """Remote (client) credentials used by
+    `authme.sqlalchemy.RemotesAdapter`.
+    """
+    remote_id = sa.Column(sa.String(255), primary_key=True)
+    secret = sa.Column(sa.LargeBinary, nullable=True)
+    key = sa.Column(sa.LargeBinary, nullable=True)
+    tight = sa.Column(sa.Boolean, nullable=False, default=False)
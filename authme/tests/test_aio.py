@@ -0,0 +1,112 @@
+""" """
+import asyncio
+import threading
+import unittest
+import unittest.mock
+
+import authme.aio
+import authme.exc
+import authme.hmac
+import authme.message
+
+
+class TestAsyncMessage(unittest.TestCase):
+    """ """
+
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+    def test_send_identical(self):
+        for payload in (b'payload', b'x' * 100000):
+            expected = authme.message.Message(payload=payload,
+                            signer=authme.hmac.Hmac(b'12345'),
+                            signing_params=(b'signature_namespace',)).send()
+            message = authme.aio.AsyncMessage(payload=payload,
+                            signer=authme.hmac.Hmac(b'12345'),
+                            signing_params=(b'signature_namespace',))
+            self.assertEqual(self.run_async(message.send()), expected)
+
+    def test_json_roundtrip(self):
+        payload = {b'foo': [b'bar', 1]}
+        expected = authme.message.JsonMessage(payload=payload,
+                            signer=authme.hmac.Hmac(b'12345')).send()
+        message = authme.aio.AsyncJsonMessage(payload=payload,
+                            signer=authme.hmac.Hmac(b'12345'))
+        sent = self.run_async(message.send())
+        self.assertEqual(sent, expected)
+
+        message = authme.aio.AsyncJsonMessage(
+                            signer=authme.hmac.Hmac(b'12345'))
+        self.assertEqual(self.run_async(message.receive(*sent)), payload)
+
+    def test_threshold(self):
+        threads = []
+
+        class Signer:
+            @classmethod
+            def sign(cls, *args):
+                threads.append(threading.current_thread())
+
+        message = authme.aio.AsyncMessage(payload=b'small', signer=Signer,
+                                          threshold=10)
+        self.run_async(message.send())
+        message = authme.aio.AsyncMessage(payload=b'x' * 10, signer=Signer,
+                                          threshold=10)
+        self.run_async(message.send())
+        self.assertIs(threads[0], threading.main_thread())
+        self.assertIsNot(threads[1], threading.main_thread())
+
+    def test_payload_size(self):
+        self.assertEqual(authme.aio.payload_size(b'1234', 100), 4)
+        self.assertEqual(authme.aio.payload_size({b'ab': [b'cd', 'ef']},
+                                                 100), 6)
+        self.assertLess(authme.aio.payload_size([b'x'] * 1000, 10), 20)
+
+
+class TestAsyncAuthApi(unittest.TestCase):
+    """ """
+
+    def setUp(self):
+        self.time_provider = unittest.mock.patch.object(
+                                authme.message.AuthApi, 'time_provider',
+                                staticmethod(lambda: 1400000000))
+        self.time_provider.start()
+        self.addCleanup(self.time_provider.stop)
+
+    def test_send_identical(self):
+        for payload in (b'payload', b'x' * 100000):
+            expected = authme.message.AuthApi(b'server',
+                            {b'client': {'secret': b'12345'}})
+            api = authme.aio.AsyncAuthApi(b'server',
+                            {b'client': {'secret': b'12345'}})
+            with unittest.mock.patch('os.urandom', return_value=b'n' * 16):
+                packet = asyncio.run(api.send(b'client', payload))
+                self.assertEqual(packet, expected.send(b'client', payload))
+
+    def test_json_roundtrip(self):
+        server = authme.aio.AsyncJsonAuthApi(b'server',
+                            {b'client': {'secret': b'12345'}})
+        client = authme.message.JsonAuthApi(b'client',
+                            {b'server': {'secret': b'12345'}})
+        payload = {'foo': ['bar', 1]}
+        packet = client.send(b'server', payload, b'127.0.0.1')
+        self.assertEqual(asyncio.run(server.receive(packet, b'127.0.0.1')),
+                         payload)
+        packet['payload'] = {'foo': ['baz', 1]}
+        self.assertRaises(authme.exc.SignatureBad, asyncio.run,
+                          server.receive(packet, b'127.0.0.1'))
+
+    def test_threshold(self):
+        threads = []
+        api = authme.aio.AsyncAuthApi(b'server',
+                            {b'client': {'secret': b'12345'}}, threshold=10)
+        send = api.api.send
+
+        def record(*args):
+            threads.append(threading.current_thread())
+            return send(*args)
+        api.api.send = record
+        asyncio.run(api.send(b'client', b'small'))
+        asyncio.run(api.send(b'client', b'x' * 10))
+        self.assertIs(threads[0], threading.main_thread())
+        self.assertIsNot(threads[1], threading.main_thread())
@@ -0,0 +1,29 @@
+""" """
+import io
+import unittest
+
+import authme.bench
+
+
+class TestBench(unittest.TestCase):
+    """ """
+
+    def test_run(self):
+        out = io.StringIO()
+        results = authme.bench.run(sizes=(64,), min_time=0, out=out)
+        self.assertIn('hmac.sign/64', results)
+        self.assertIn('jsonmessage.receive/64', results)
+        for result in results.values():
+            self.assertGreater(result['ops'], 0)
+            self.assertLessEqual(result['p50'], result['p99'])
+            self.assertGreaterEqual(result['alloc_count'], 0)
+        # The signature it returns, at least.
+        self.assertGreater(results['hmac.sign/64']['alloc_count'], 0)
+        self.assertEqual(len(out.getvalue().splitlines()), len(results))
+
+    def test_compare(self):
+        baseline = {'a/64': {'ops': 100.0}, 'b/64': {'ops': 100.0}}
+        results = {'a/64': {'ops': 95.0}, 'b/64': {'ops': 80.0},
+                   'c/64': {'ops': 1.0}}
+        self.assertEqual(authme.bench.compare(results, baseline, 0.1),
+                         [('b/64', 100.0, 80.0)])
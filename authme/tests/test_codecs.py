@@ -1,3 +1,4 @@
+import math
 import types
 
 import unittest
@@ -112,4 +113,154 @@ class TestJsonArgCodec(unittest.TestCase):
         self.assertEqual(tuple(gen), ({b'foo': b'bar'},))
 
         gen = authme.codecs.JsonArgCodec._decode('"MTIz"', '"NDU2"', '"Nzg5"')
-        self.assertEqual(tuple(gen), (b'123', b'456', b'789'))
\ No newline at end of file
+        self.assertEqual(tuple(gen), (b'123', b'456', b'789'))
+
+class TestB64Json(unittest.TestCase):
+    """
+    """
+    samples = (b'', b'123', 1, 1.5, True, float('inf'),
+               [b'a', (b'b', b'c'), []], {},
+               {b'foo': {b'bar': [1, 2, {b'baz': b'boo'}]}, 1: b'v'})
+
+    def test_dumps_matches_multi_pass(self):
+        for value in self.samples:
+            self.assertEqual(authme.codecs.b64json_dumps(value),
+                             authme.codecs.json.dumps(
+                                authme.codecs.decode_all(
+                                    authme.codecs.b64encode(value))))
+
+    def test_loads_matches_multi_pass(self):
+        for value in (b'123', [b'a', [b'b']], {b'foo': {b'bar': [b'baz']}}):
+            text = authme.codecs.b64json_dumps(value)
+            self.assertEqual(authme.codecs.b64json_loads(text),
+                             authme.codecs.b64decode(
+                                authme.codecs.encode_all(
+                                    authme.codecs.json.loads(text))))
+
+    def test_deep_nesting(self):
+        value = b'foo'
+        for _ in range(10000):
+            value = [value]
+        text = authme.codecs.b64json_dumps(value)
+        self.assertEqual(text, '[' * 10000 + '"Zm9v"' + ']' * 10000)
+        decoded = authme.codecs.b64json_loads(text)
+        for _ in range(10000):
+            decoded = decoded[0]
+        self.assertEqual(decoded, b'foo')
+
+    def test_parse(self):
+        text = ' [1, 2.5e3, true, null, "Zm9v", {"Zm9v" : []}] '
+        self.assertEqual(authme.codecs._b64json_parse(text),
+                         [1, 2500.0, True, None, b'foo', {b'foo': []}])
+        for bad in ('[1,]', '{"Zm9v":1,}', '[1 2]', '', '[1]x'):
+            self.assertRaises(ValueError, authme.codecs._b64json_parse, bad)
+
+    def test_circular(self):
+        value = []
+        value.append(value)
+        self.assertRaises(ValueError, authme.codecs.b64json_dumps, value)
+
+
+class TestBinaryArgCodec(unittest.TestCase):
+    """ """
+    samples = (b'', b'123', 'text', 0, -1, 255, 2 ** 70, 1.5, True, False,
+               None, [b'a', [b'b', []], {}],
+               {b'foo': {b'bar': [1, 2, {b'baz': b'boo'}]}, 1: b'v', 'k': 0})
+
+    def test_round_trip(self):
+        for value in self.samples:
+            encoded = authme.codecs.BinaryArgCodec.encode(value, value)
+            self.assertEqual(authme.codecs.BinaryArgCodec.decode(*encoded),
+                             (value, value))
+        self.assertEqual(authme.codecs.BinaryArgCodec.decode(
+                            *authme.codecs.BinaryArgCodec.encode(
+                                (b'a', bytearray(b'b')))),
+                         ([b'a', b'b'],))
+
+    def test_deterministic(self):
+        a = {b'b': 1, b'a': {'y': 2, 'x': 3}}
+        b = {b'a': {'x': 3, 'y': 2}, b'b': 1}
+        self.assertEqual(authme.codecs.binary_dumps(a),
+                         authme.codecs.binary_dumps(b))
+        self.assertEqual(authme.codecs.binary_dumps(float('nan')),
+                         authme.codecs.binary_dumps(-float('nan')))
+
+    def test_signed_zero_keys(self):
+        positive = authme.codecs.binary_dumps({0.0: 1})
+        negative = authme.codecs.binary_dumps({-0.0: 1})
+        self.assertNotEqual(positive, negative)
+        self.assertEqual(negative[1:-1], authme.codecs.binary_dumps(-0.0))
+        key, = authme.codecs.binary_loads(negative)
+        self.assertEqual(math.copysign(1, key), -1)
+
+    def test_smaller_than_json(self):
+        value = {b'data': bytes(range(256)) * 16}
+        self.assertLess(len(authme.codecs.BinaryArgCodec.encode(value)[0]),
+                        len(authme.codecs.JsonArgCodec.encode(value)[0]))
+
+    def test_deep_nesting(self):
+        value = b'foo'
+        for _ in range(10000):
+            value = [value]
+        decoded = authme.codecs.binary_loads(
+                        authme.codecs.binary_dumps(value))
+        for _ in range(10000):
+            decoded = decoded[0]
+        self.assertEqual(decoded, b'foo')
+
+    def test_rfc8949_vectors(self):
+        # RFC 8949, appendix A, in deterministic encoding.
+        for value, encoded in ((0, '00'), (23, '17'), (24, '1818'),
+                               (100, '1864'), (1000, '1903e8'),
+                               (1000000, '1a000f4240'),
+                               (1000000000000, '1b000000e8d4a51000'),
+                               (2 ** 64 - 1, '1bffffffffffffffff'),
+                               (2 ** 64, 'c249010000000000000000'),
+                               (-2 ** 64, '3bffffffffffffffff'),
+                               (-2 ** 64 - 1, 'c349010000000000000000'),
+                               (-1, '20'), (-1000, '3903e7'),
+                               (1.1, 'fb3ff199999999999a'),
+                               (False, 'f4'), (True, 'f5'), (None, 'f6'),
+                               (b'', '40'), (b'\x01\x02\x03\x04',
+                                             '4401020304'),
+                               ('', '60'), ('IETF', '6449455446'),
+                               ([], '80'), ([1, [2, 3]], '8201820203'),
+                               ({}, 'a0'), ({3: 4, 1: 2}, 'a201020304'),
+                               ({'b': [2, 3], 'a': 1},
+                                'a26161016162820203')):
+            encoded = bytes.fromhex(encoded)
+            self.assertEqual(authme.codecs.binary_dumps(value), encoded)
+            self.assertEqual(authme.codecs.binary_loads(encoded), value)
+            self.assertEqual(authme.codecs.binary_loads(
+                                bytearray(encoded)), value)
+
+    def test_errors(self):
+        value = []
+        value.append(value)
+        self.assertRaises(ValueError, authme.codecs.binary_dumps, value)
+        # A cycle deeper than where tracking starts.
+        value = inner = {}
+        for _ in range(100):
+            value = [value]
+        inner[b'a'] = value
+        self.assertRaises(ValueError, authme.codecs.binary_dumps, value)
+        self.assertRaises(TypeError, authme.codecs.binary_dumps, {1, 2})
+        self.assertRaises(TypeError, authme.codecs.binary_dumps, {(1,): 2})
+
+        encoded = authme.codecs.binary_dumps(self.samples[-1])
+        for bad in (encoded[:-1], encoded + b'\xf6', b'', b'\xf7', b'\x1c',
+                    b'\x82\xf6', b'\x9f\xf6\xff', b'\x5a\x00\x00\x00',
+                    # Non-canonical ints, lengths and bignums.
+                    b'\x18\x05', b'\x19\x00\x05', b'\x38\x05',
+                    b'\x1b\x00\x00\x00\x00\xff\xff\xff\xff',
+                    b'\x58\x01a', b'\xc2\x41\x05',
+                    b'\xc2\x4a\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00',
+                    b'\xc2\xf6', b'\xc4\x41\x05',
+                    # Other floats and NaNs than the encoder emits.
+                    b'\xf9\x3c\x00', b'\xfb\x7f\xf8\x00\x00\x00\x00\x00\x01',
+                    # Unsorted, duplicate, colliding and container keys.
+                    b'\xa2\xf5\xf6\xf4\xf6', b'\xa2\xf6\xf6\xf6\xf6',
+                    b'\xa2\x01\x02\xf5\x02',
+                    b'\xa2\x01\x02\xfb\x3f\xf0\x00\x00\x00\x00\x00\x00\x02',
+                    b'\xa1\x80\xf6'):
+            self.assertRaises(ValueError, authme.codecs.binary_loads, bad)
@@ -0,0 +1,53 @@
+""" """
+import unittest
+
+import authme.envelope
+import authme.exc
+import authme.hmac
+import authme.message
+
+
+class TestEnvelope(unittest.TestCase):
+    """ """
+
+    def test_roundtrip(self):
+        data = authme.envelope.pack(b'client', b'body', b'nonce', b'sig')
+        self.assertEqual(data, b'\x01\x03\x00\x06client\x00\x05nonce'
+                               b'\x00\x03sig\x00\x00\x00\x04body')
+        envelope = authme.envelope.unpack(data)
+        self.assertEqual(envelope.version, authme.envelope.VERSION)
+        self.assertEqual(envelope.sender_id, b'client')
+        self.assertEqual(envelope.body, b'body')
+        self.assertEqual(envelope.nonce, b'nonce')
+        self.assertEqual(envelope.signature, b'sig')
+
+    def test_zero_copy(self):
+        data = authme.envelope.pack(b'client', b'x' * 1000, None, b'sig')
+        envelope = authme.envelope.unpack(data)
+        self.assertIsInstance(envelope.body, memoryview)
+        self.assertIs(envelope.body.obj, data)
+        self.assertIsNone(envelope.nonce)
+
+    def test_flags(self):
+        data = authme.envelope.pack(b'', b'', flags=0x80)
+        envelope = authme.envelope.unpack(data)
+        self.assertEqual(envelope.flags, 0x80)
+        self.assertIsNone(envelope.nonce)
+        self.assertIsNone(envelope.signature)
+
+    def test_bad(self):
+        data = authme.envelope.pack(b'client', b'body', b'nonce', b'sig')
+        for bad in (b'', data[:-1], data + b'x', b'\x02' + data[1:]):
+            self.assertRaises(authme.exc.EnvelopeBad,
+                              authme.envelope.unpack, bad)
+        self.assertRaises(authme.exc.EnvelopeBad, authme.envelope.pack,
+                          b'x' * 70000, b'')
+
+    def test_message(self):
+        signer = authme.hmac.Hmac(b'12345')
+        message = authme.message.Message(payload=b'payload', signer=signer)
+        data = authme.envelope.pack(b'client', *message.send())
+        envelope = authme.envelope.unpack(data)
+        message = authme.message.Message(signer=signer)
+        self.assertEqual(message.receive(envelope.body, envelope.nonce,
+                                         envelope.signature), b'payload')
@@ -1,4 +1,5 @@
 import unittest
+import authme.exc
 import authme.hmac
 
 class HmacTests(unittest.TestCase):
@@ -11,4 +12,202 @@ class HmacTests(unittest.TestCase):
 
         h = authme.hmac.TimedHmac(b'12345', expiry=1)
         a = h.sign(b'1', b'2', b'3')
-        self.assertTrue(h.verify(a, b'1', b'2', b'3'))
\ No newline at end of file
+        self.assertTrue(h.verify(a, b'1', b'2', b'3'))
+
+class KeyedContextCacheTests(unittest.TestCase):
+    """
+    """
+    def test_shared_context(self):
+        cache = authme.hmac.KeyedContextCache()
+        a = cache.get(b'12345', authme.hmac.hashlib.sha256)
+        b = cache.get(b'12345', authme.hmac.hashlib.sha256)
+        self.assertIs(a, b)
+        self.assertIsNot(a, cache.get(b'12345', authme.hmac.hashlib.sha512))
+        self.assertEqual(len(cache), 2)
+
+    def test_lru_bound(self):
+        cache = authme.hmac.KeyedContextCache(maxsize=2)
+        a = cache.get(b'a', authme.hmac.hashlib.sha256)
+        cache.get(b'b', authme.hmac.hashlib.sha256)
+        cache.get(b'a', authme.hmac.hashlib.sha256)
+        cache.get(b'c', authme.hmac.hashlib.sha256)
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get(b'a', authme.hmac.hashlib.sha256), a)
+
+    def test_sign_matches_hmac_new(self):
+        h = authme.hmac.Hmac(b'12345')
+        expected = authme.hmac.hmac.new(b'12345', b'123',
+                                        authme.hmac.hashlib.sha256).digest()
+        self.assertEqual(h.sign(b'1', b'2', b'3'), expected)
+        # Signing again must not be affected by the previous message.
+        self.assertEqual(h.sign(b'1', b'2', b'3'), expected)
+
+
+class BatchTests(unittest.TestCase):
+    """
+    """
+    def test_sign_many(self):
+        h = authme.hmac.Hmac(b'12345')
+        argsets = [(b'1', b'2'), (b'3',), (None,)]
+        self.assertEqual(h.sign_many(argsets),
+                         [h.sign(*args) for args in argsets])
+
+    def test_verify_many(self):
+        h = authme.hmac.Hmac(b'12345')
+        good = h.sign(b'1', b'2')
+        results = h.verify_many([(good, b'1', b'2'), (good, b'x'),
+                                 (good, 1)])
+        self.assertIs(results[0], True)
+        self.assertIsInstance(results[1], authme.exc.SignatureBad)
+        self.assertIsInstance(results[2], TypeError)
+
+    def test_verify_many_timed(self):
+        h = authme.hmac.TimedHmac(b'12345', expiry=1)
+        sig = h.sign(b'1')
+        self.assertEqual(h.verify_many([(sig, b'1')]), [True])
+
+    def test_verify_many_executor(self):
+        import concurrent.futures
+        h = authme.hmac.Hmac(b'12345')
+        items = [(h.sign(str(i).encode()), str(i).encode())
+                    for i in range(100)]
+        items.append((b'bad', b'0'))
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            results = h.verify_many(items, executor=executor, chunksize=8)
+        self.assertEqual(results[:100], [True] * 100)
+        self.assertIsInstance(results[100], authme.exc.SignatureBad)
+
+
+class TimedHmacTests(unittest.TestCase):
+    """
+    """
+    def test_wire_format(self):
+        h = authme.hmac.TimedHmac(b'12345', time_provider=lambda: 1400000000)
+        sig = h.sign(b'1', b'2')
+        self.assertEqual(len(sig), 1 + 32 + 8)
+        self.assertEqual(sig[:1], authme.hmac.TIMED_VERSION)
+        self.assertEqual(int.from_bytes(sig[-8:], 'big'), 1400000000)
+        self.assertTrue(h.verify(sig, b'1', b'2'))
+        self.assertRaises(authme.exc.SignatureBad, h.verify, sig, b'1')
+
+    def test_legacy_format(self):
+        ts = b'1400000000'
+        legacy = authme.hmac.hmac.new(b'12345', ts + b'12',
+                            authme.hmac.hashlib.sha256).digest() + ts
+        h = authme.hmac.TimedHmac(b'12345', time_provider=lambda: 1400000000)
+        self.assertTrue(h.verify(legacy, b'1', b'2'))
+        self.assertTrue(h.verify(legacy + b'\x00\x00', b'1', b'2'))
+
+        h = authme.hmac.TimedHmac(b'12345', time_provider=lambda: 1400000000,
+                                  accept_legacy=False)
+        self.assertRaises(authme.exc.SignatureBad, h.verify, legacy, b'1', b'2')
+
+    def test_short_signature(self):
+        h = authme.hmac.TimedHmac(b'12345', time_provider=lambda: 1400000000)
+        sig = h.sign(b'1')
+        for bad in (b'', b'\x00', sig[:1], sig[:-1], sig[:20] + b'1400000000'):
+            self.assertRaises(authme.exc.SignatureBad, h.verify, bad, b'1')
+            self.assertRaises(authme.exc.SignatureBad, h.verify_stream, bad)
+        self.assertEqual(authme.hmac.rstrip_bytes(b''), b'')
+        self.assertEqual(authme.hmac.rstrip_bytes(b'\x00\x00'), b'')
+
+    def test_expiry(self):
+        now = [1400000000]
+        h = authme.hmac.TimedHmac(b'12345', expiry=5,
+                                  time_provider=lambda: now[0])
+        sig = h.sign(b'1')
+        now[0] += 6
+        self.assertRaises(authme.exc.SignatureTimeout, h.verify, sig, b'1')
+
+
+class StreamTests(unittest.TestCase):
+    """
+    """
+    def test_hmac_stream(self):
+        h = authme.hmac.Hmac(b'12345')
+        stream = h.stream()
+        stream.update(b'pay')
+        stream.update(b'load')
+        sig = stream.finalize(b'nonce')
+        self.assertEqual(sig, h.sign(b'payload', b'nonce'))
+
+        verifier = h.verify_stream(sig)
+        verifier.update(b'payload')
+        self.assertTrue(verifier.finalize(b'nonce'))
+
+        verifier = h.verify_stream(sig)
+        verifier.update(b'payloat')
+        self.assertRaises(authme.exc.SignatureBad, verifier.finalize, b'nonce')
+
+    def test_timed_stream(self):
+        h = authme.hmac.TimedHmac(b'12345', time_provider=lambda: 1400000000)
+        stream = h.stream()
+        stream.update(b'pay')
+        stream.update(b'load')
+        sig = stream.finalize(b'nonce')
+        self.assertEqual(sig, h.sign(b'payload', b'nonce'))
+
+        verifier = h.verify_stream(sig)
+        verifier.update(b'payload')
+        self.assertTrue(verifier.finalize(b'nonce'))
+
+    def test_passes(self):
+        self.assertRaises(ValueError, authme.hmac.Hmac(b'12345', passes=2).stream)
+
+
+class KeyIdTests(unittest.TestCase):
+    """
+    """
+    secrets = {b'a': b'12345', b'b': b'67890'}
+
+    def test_hmac_rotation(self):
+        old = authme.hmac.Hmac({b'a': b'12345'}, key_id=b'a')
+        new = authme.hmac.Hmac(self.secrets, key_id=b'b')
+        sig = old.sign(b'1', b'2')
+        self.assertEqual(sig[:2], b'\x01a')
+        self.assertTrue(new.verify(sig, b'1', b'2'))
+        self.assertTrue(new.verify(new.sign(b'1', b'2'), b'1', b'2'))
+        self.assertRaises(authme.exc.SignatureBad, old.verify,
+                          new.sign(b'1'), b'1')
+        # The key id is signed.
+        self.assertFalse(new.challenge(b'\x01b' + sig[2:], b'1', b'2'))
+        self.assertFalse(new.challenge(b'', b'1'))
+        self.assertRaises(ValueError, authme.hmac.Hmac, self.secrets,
+                          key_id=b'c')
+
+    def test_timed_rotation(self):
+        old = authme.hmac.TimedHmac({'a': b'12345'}, key_id='a')
+        new = authme.hmac.TimedHmac(self.secrets, key_id=b'b')
+        sig = old.sign(b'1')
+        self.assertEqual(sig[:3], authme.hmac.TIMED_KEYED_VERSION + b'\x01a')
+        self.assertEqual(len(sig), 3 + 32 + authme.hmac.TIMED_TS_SIZE)
+        self.assertTrue(new.verify(sig, b'1'))
+        self.assertRaises(authme.exc.SignatureBad, new.verify, sig, b'2')
+        self.assertRaises(authme.exc.SignatureBad, new.verify,
+                          authme.hmac.TimedHmac(b'12345').sign(b'1'), b'1')
+        # Nor the unkeyed legacy format.
+        ts = str(old._time_provider()).encode()
+        legacy = authme.hmac.hmac.new(b'67890', ts + b'1',
+                            authme.hmac.hashlib.sha256).digest() + ts
+        self.assertRaises(authme.exc.SignatureBad, new.verify, legacy, b'1')
+        self.assertTrue(authme.hmac.TimedHmac(b'67890').verify(legacy, b'1'))
+
+        stream = new.verify_stream(sig)
+        stream.update(b'1')
+        self.assertTrue(stream.finalize())
+        stream = old.stream()
+        stream.update(b'1')
+        self.assertTrue(new.verify(stream.finalize(), b'1'))
+
+    def test_one_digest_per_verify(self):
+        secrets = {str(i): str(i).encode() * 8 for i in range(50)}
+        signer = authme.hmac.TimedHmac(secrets, key_id='7')
+        sig = signer.sign(b'1')
+        digest = authme.hmac.Hmac._digest
+        calls = []
+        def counted(*args):
+            calls.append(args)
+            return digest(signer, *args)
+        signer._digest = counted
+        self.assertTrue(signer.verify(sig, b'1'))
+        self.assertEqual(len(calls), 1)
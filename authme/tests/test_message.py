@@ -1,11 +1,63 @@
 """ """
+import io
+import threading
 import unittest
 
 import cryptu.aes
+import authme.codecs
+import authme.exc
 import authme.hmac
 import authme.message
 
 
+class TestRemotes(unittest.TestCase):
+    """ """
+
+    def test_remotes(self):
+        remotes = authme.message.Remotes({b'guest': {'secret': b'12345'}})
+        self.assertEqual(remotes.get(b'guest'),
+                         {'secret': b'12345', 'key': None, 'tight': False})
+        id_, remote = remotes.add(vals={'tight': True})
+        self.assertIn(id_, remotes)
+        remotes.remove(id_)
+        self.assertNotIn(id_, remotes)
+        self.assertRaises(authme.exc.MessageClientBad, remotes.get, id_)
+
+    def test_ttl(self):
+        now = [0]
+        evicted = []
+        remotes = authme.message.Remotes({b'guest': {}}, ttl=10,
+                        time_provider=lambda: now[0],
+                        on_evict=lambda *args: evicted.append(args))
+        remotes.update(b'a', {})
+        remotes.update(b'b', {})
+        now[0] = 8
+        remotes.get(b'a')
+        now[0] = 12
+        # `a` slid forward on use, `b` expired.
+        self.assertIn(b'a', remotes)
+        self.assertNotIn(b'b', remotes)
+        self.assertEqual(evicted, [(b'b', {'secret': None, 'key': None,
+                                           'tight': False}, 'expired')])
+        now[0] = 100
+        self.assertNotIn(b'a', remotes)
+        self.assertIn(b'guest', remotes)
+        self.assertEqual(remotes.stats['expired'], 2)
+
+    def test_maxsize(self):
+        remotes = authme.message.Remotes({b'guest': {}}, maxsize=2)
+        remotes.update(b'a', {})
+        remotes.update(b'b', {})
+        remotes.get(b'a')
+        remotes.update(b'c', {})
+        self.assertNotIn(b'b', remotes)
+        self.assertIn(b'a', remotes)
+        self.assertIn(b'c', remotes)
+        self.assertIn(b'guest', remotes)
+        self.assertEqual(len(remotes), 3)
+        self.assertEqual(remotes.stats['evicted'], 1)
+
+
 class TestMessage(unittest.TestCase):
     """ """
 
@@ -110,6 +162,49 @@ class TestMessage(unittest.TestCase):
                          b'payload')
 
 
+class TestMessageStream(unittest.TestCase):
+    """ """
+
+    def test_send_stream(self):
+        message = authme.message.Message(signer=authme.hmac.Hmac(b'12345'),
+                                    signing_params=(b'signature_namespace',))
+        stream = message.send_stream(iter((b'pay', b'load')))
+        self.assertIsNone(stream.signature)
+        self.assertEqual(b''.join(stream), b'payload')
+        self.assertEqual(stream.nonce, None)
+        self.assertEqual(stream.signature,
+                         authme.message.Message(payload=b'payload',
+                                    signer=authme.hmac.Hmac(b'12345'),
+                                    signing_params=(b'signature_namespace',)
+                                    ).send()[2])
+
+    def test_receive_stream(self):
+        signature = b"""K\xaa=\xcd\xde6\xd7\x07?1\xdd\x8a\xcb~\xf7"\x8c\xfe\x03R\xd7$\xf4b\x81Y\xb8\xfd\xcdD\xd6s"""
+        message = authme.message.Message(signer=authme.hmac.Hmac(b'12345'),
+                                    signing_params=(b'signature_namespace',))
+        chunks = message.receive_stream(io.BytesIO(b'payload'), None,
+                                        signature, spool_size=2)
+        self.assertEqual(b''.join(chunks), b'payload')
+
+        self.assertRaises(authme.exc.SignatureBad, message.receive_stream,
+                          [b'pay', b'loat'], None, signature)
+
+    def test_buffered_cipher(self):
+        class Upper:
+            iv = b'iv'
+            encrypt = staticmethod(bytes.upper)
+            decrypt = staticmethod(bytes.lower)
+
+        message = authme.message.Message(signer=authme.hmac.Hmac(b'12345'),
+                                         cipher=Upper)
+        stream = message.send_stream([b'pay', b'load'])
+        body = b''.join(stream)
+        self.assertEqual(body, b'PAYLOAD')
+        self.assertEqual(b''.join(message.receive_stream([body], b'iv',
+                                                    stream.signature)),
+                         b'payload')
+
+
 class TestJsonMessage(unittest.TestCase):
     """ """
     def test_default_message(self):
@@ -333,4 +428,258 @@ class TestJsonMessage(unittest.TestCase):
                             cipher_cls=cryptu.aes.Aes)
         package = a.send(b'client1', {'this':'123456'})
 
-        assert  b.receive(package) == {'this':'123456'}'''
\ No newline at end of file
+        assert  b.receive(package) == {'this':'123456'}'''
+
+
+class TestMessagePipeline(unittest.TestCase):
+    """ """
+
+    def test_no_class_mutation(self):
+        payload = authme.message.Message.__dict__['payload']
+        authme.message.Message(payload=b'payload')
+        authme.message.JsonMessage(payload=b'payload')
+        self.assertIs(authme.message.Message.__dict__['payload'], payload)
+        self.assertNotIn('payload', authme.message.JsonMessage.__dict__)
+
+    def test_pipeline_matches_message(self):
+        signer = authme.hmac.Hmac(b'12345')
+        params = (b'signature_namespace',)
+        pipeline = authme.message.MessagePipeline(signer=signer)
+        sent = pipeline.send(b'payload', params)
+        self.assertEqual(sent, authme.message.Message(payload=b'payload',
+                            signer=signer, signing_params=params).send())
+        self.assertEqual(pipeline.receive(*sent, params=params), b'payload')
+        self.assertRaises(authme.exc.SignatureBad, pipeline.receive, *sent)
+
+    def test_json_pipeline_matches_json_message(self):
+        signer = authme.hmac.Hmac(b'12345')
+        params = (b'signature_namespace',)
+        pipeline = authme.message.MessagePipeline(signer=signer,
+                                    codec=authme.codecs.JsonArgCodec)
+        for payload in (1, b'foobers', {b'foo': b'bar'}):
+            sent = pipeline.send(payload, params)
+            self.assertEqual(sent, authme.message.JsonMessage(
+                                    payload=payload, signer=signer,
+                                    signing_params=params).send())
+            self.assertEqual(pipeline.receive(*sent, params=params), payload)
+
+    def test_slots(self):
+        pipeline = authme.message.MessagePipeline()
+        self.assertRaises(AttributeError, setattr, pipeline, 'payload', b'')
+
+    def test_failures_raise(self):
+        class Refuse(authme.message.PassSigner):
+            @classmethod
+            def verify(cls, val, *args):
+                return False
+
+            @classmethod
+            def verify_stream(cls, val):
+                return authme.message.PassStream(False)
+
+        class Empty(authme.message.PassCipher):
+            @classmethod
+            def decrypt(cls, val):
+                return b''
+
+        pipeline = authme.message.MessagePipeline(signer=Refuse)
+        self.assertRaises(authme.exc.SignatureBad, pipeline.receive,
+                          b'body', None, None)
+        message = authme.message.Message(signer=Refuse)
+        self.assertRaises(authme.exc.SignatureBad, message.receive_stream,
+                          [b'body'], None, None)
+        pipeline = authme.message.MessagePipeline(cipher=Empty)
+        self.assertRaises(authme.exc.CipherBad, pipeline.receive,
+                          b'body', None, None)
+
+
+
+class XorContext(object):
+    """Toy cipher context counting its key schedules."""
+    built = 0
+
+    def __init__(self, key):
+        XorContext.built += 1
+        self.key = key
+
+    def _xor(self, val, nonce):
+        pad = (self.key + nonce) * (len(val) // len(self.key + nonce) + 1)
+        return bytes(a ^ b for a, b in zip(val, pad))
+
+    def encrypt(self, val, nonce):
+        return self._xor(val, nonce)
+
+    def decrypt(self, val, nonce):
+        return self._xor(val, nonce)
+
+
+class TestCipherPool(unittest.TestCase):
+    """ """
+    def setUp(self):
+        XorContext.built = 0
+        self.remotes = authme.message.Remotes({b'a': {'key': b'k1'},
+                                               b'b': {'key': b'k2'}})
+        self.pool = authme.message.CipherPool(XorContext, self.remotes,
+                                              nonce_size=8)
+
+    def test_reuse_context(self):
+        for _ in range(5):
+            self.pool.encrypting(b'a')
+            self.pool.encrypting(b'b')
+        self.assertEqual(XorContext.built, 2)
+        self.assertEqual(self.pool.stats['misses'], 2)
+        self.assertEqual(self.pool.stats['hits'], 8)
+
+    def test_fresh_nonce(self):
+        first = self.pool.encrypting(b'a')
+        second = self.pool.encrypting(b'a')
+        self.assertEqual(len(first.iv), 8)
+        self.assertNotEqual(first.iv, second.iv)
+        self.assertIs(first.context, second.context)
+        self.assertNotEqual(first.encrypt(b'payload'),
+                            second.encrypt(b'payload'))
+
+    def test_key_change(self):
+        self.pool.encrypting(b'a')
+        self.remotes.update(b'a', {'key': b'k3'})
+        self.assertEqual(self.pool.encrypting(b'a').context.key, b'k3')
+        self.assertEqual(XorContext.built, 2)
+
+    def test_maxsize(self):
+        self.pool.maxsize = 1
+        self.pool.encrypting(b'a')
+        self.pool.encrypting(b'b')
+        self.assertEqual(len(self.pool), 1)
+        self.pool.discard(b'b')
+        self.assertEqual(len(self.pool), 0)
+
+    def test_unknown_remote(self):
+        self.assertRaises(authme.exc.MessageClientBad,
+                          self.pool.encrypting, b'c')
+
+    def test_build_outside_lock(self):
+        self.pool.encrypting(b'a')
+        building, release = threading.Event(), threading.Event()
+
+        def slow_context(key):
+            building.set()
+            release.wait(5)
+            return XorContext(key)
+        self.pool.context_factory = slow_context
+        thread = threading.Thread(target=self.pool.encrypting, args=(b'b',))
+        thread.start()
+        building.wait(5)
+        # Another remote's cached context is served meanwhile.
+        self.assertEqual(self.pool.encrypting(b'a').context.key, b'k1')
+        release.set()
+        thread.join()
+        self.assertEqual(self.pool.encrypting(b'b').context.key, b'k2')
+        self.assertEqual(XorContext.built, 2)
+
+    def test_message(self):
+        signer = authme.hmac.Hmac(b'12345')
+        sent = authme.message.Message(payload=b'payload', signer=signer,
+                            cipher=self.pool.encrypting(b'a')).send()
+        self.assertNotEqual(sent[0], b'payload')
+        message = authme.message.Message(signer=signer,
+                            cipher=self.pool.decrypting(b'a', sent[1]))
+        self.assertEqual(message.receive(*sent), b'payload')
+
+    def test_pipeline(self):
+        pipeline = authme.message.MessagePipeline(
+                            signer=authme.hmac.Hmac(b'12345'),
+                            codec=authme.codecs.JsonArgCodec)
+        sent = pipeline.send({b'this': b'123456'}, (b'ns',),
+                             cipher=self.pool.encrypting(b'b'))
+        self.assertEqual(pipeline.receive(*sent, params=(b'ns',),
+                            cipher=self.pool.decrypting(b'b', sent[1])),
+                         {b'this': b'123456'})
+        self.assertRaises(authme.exc.SignatureBad, pipeline.receive,
+                          sent[0], b'x' * 8, sent[2], (b'ns',))
+
+    def test_stream(self):
+        message = authme.message.Message(signer=authme.hmac.Hmac(b'12345'),
+                            cipher=self.pool.encrypting(b'a'))
+        stream = message.send_stream([b'pay', b'load'])
+        body = b''.join(stream)
+        message = authme.message.Message(signer=authme.hmac.Hmac(b'12345'),
+                            cipher=self.pool.decrypting(b'a', stream.nonce))
+        self.assertEqual(b''.join(message.receive_stream([body],
+                                        stream.nonce, stream.signature)),
+                         b'payload')
+
+
+@unittest.skipIf(authme.message.aead is None, "needs `cryptography`")
+class TestAesGcmContext(unittest.TestCase):
+    """ """
+    def setUp(self):
+        self.remotes = authme.message.Remotes({b'a': {'key': b'k' * 16}})
+        self.pool = authme.message.CipherPool(authme.message.AesGcmContext,
+                                              self.remotes)
+
+    def test_round_trip(self):
+        cipher = self.pool.encrypting(b'a')
+        self.assertEqual(len(cipher.iv), 12)
+        sealed = cipher.encrypt(b'payload')
+        self.assertNotIn(b'payload', sealed)
+        self.assertEqual(self.pool.decrypting(b'a', cipher.iv)
+                                .decrypt(sealed), b'payload')
+        self.assertRaises(authme.exc.CipherBad,
+                          self.pool.decrypting(b'a', cipher.iv).decrypt,
+                          sealed[:-1] + bytes([sealed[-1] ^ 1]))
+        self.assertRaises(authme.exc.CipherBad,
+                          self.pool.decrypting(b'a', b'').decrypt, sealed)
+
+
+class TestAuthApi(unittest.TestCase):
+    """ """
+    def setUp(self):
+        self.server = authme.message.JsonAuthApi(b'server',
+                                        {b'client': {'secret': b'12345'}})
+        self.client = authme.message.JsonAuthApi('client',
+                                        {b'server': {'secret': b'12345'}})
+
+    def test_send_receive(self):
+        packet = self.server.send(b'client', {'this': '123456'})
+        self.assertEqual(packet['sender_id'], b'server')
+        packet['sender_id'] = 'client'
+        self.assertEqual(self.server.receive(packet), {'this': '123456'})
+
+        packet['payload'] = {'this': '654321'}
+        self.assertRaises(authme.exc.SignatureBad, self.server.receive,
+                          packet)
+
+    def test_params(self):
+        packet = self.server.send(b'client', [1, 2], b'127.0.0.1')
+        packet['sender_id'] = b'client'
+        self.assertEqual(self.server.receive(packet, b'127.0.0.1'), [1, 2])
+        self.assertRaises(authme.exc.SignatureBad, self.server.receive,
+                          packet, b'10.0.0.1')
+
+    def test_malformed(self):
+        packet = self.server.send(b'client', {})
+        packet['sender_id'] = b'client'
+        for field in ('signature', 'nonce'):
+            bad = dict(packet)
+            bad[field] = '%%%'
+            self.assertRaises(authme.exc.SignatureBad, self.server.receive,
+                              bad)
+
+    def test_unknown_remote(self):
+        self.assertRaises(authme.exc.MessageClientBad, self.server.send,
+                          b'nobody', {})
+        self.server.add_remote('other', {'secret': b'1'})
+        self.assertIn(b'other', self.server.remotes)
+        self.server.remove_remote('other')
+        self.assertNotIn(b'other', self.server.remotes)
+
+    def test_key_rotation(self):
+        remotes = {b'client': {'secrets': {b'1': b'old', b'2': b'new'},
+                               'key_id': b'1'}}
+        old = authme.message.AuthApi(b'server', remotes)
+        packet = old.send(b'client', b'payload')
+        packet['sender_id'] = b'client'
+        new = authme.message.AuthApi(b'server', {b'client': {
+                        'secrets': {b'1': b'old', b'2': b'new'},
+                        'key_id': b'2'}})
+        self.assertEqual(new.receive(packet), b'payload')
@@ -0,0 +1,45 @@
+""" """
+import unittest
+
+import authme.metrics
+
+
+class TestRegistry(unittest.TestCase):
+    """ """
+
+    def test_histogram(self):
+        registry = authme.metrics.Registry(buckets=(0.1, 1.0))
+        registry.observe('verify', 0.05)
+        registry.observe('verify', 0.5)
+        registry.observe('verify', 5)
+        with registry.timer('parse'):
+            pass
+        self.assertEqual(registry.histogram('verify'), (3, 5.55))
+        self.assertEqual(registry.histogram('parse')[0], 1)
+        self.assertEqual(registry.histogram('sign'), (0, 0.0))
+
+        text = registry.render()
+        self.assertIn('# TYPE authme_stage_seconds histogram\n', text)
+        self.assertIn('authme_stage_seconds_bucket{stage="verify",le="0.1"} 1\n',
+                      text)
+        self.assertIn('authme_stage_seconds_bucket{stage="verify",le="1.0"} 2\n',
+                      text)
+        self.assertIn('authme_stage_seconds_bucket{stage="verify",le="+Inf"} 3\n',
+                      text)
+        self.assertIn('authme_stage_seconds_count{stage="verify"} 3\n', text)
+
+    def test_counters(self):
+        registry = authme.metrics.Registry()
+        registry.incr('auth_success')
+        registry.incr('auth_success', 2)
+        self.assertEqual(registry.count('auth_success'), 3)
+        self.assertEqual(registry.count('auth_timeout'), 0)
+        self.assertIn('# TYPE authme_auth_success_total counter\n'
+                      'authme_auth_success_total 3\n', registry.render())
+
+    def test_null_sink(self):
+        sink = authme.metrics.null_sink
+        self.assertIs(sink.timer('verify'), sink.timer('sign'))
+        with sink.timer('verify'):
+            sink.observe('verify', 1)
+            sink.incr('auth_success')
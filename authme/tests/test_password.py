@@ -0,0 +1,71 @@
+""" """
+import threading
+import unittest
+import concurrent.futures
+
+import authme.exc
+import authme.password
+
+
+class TestPasswordHasher(unittest.TestCase):
+    """ """
+    def setUp(self):
+        self.hasher = authme.password.PasswordHasher(cost=1000)
+
+    def tearDown(self):
+        self.hasher.close()
+
+    def test_hash_verify(self):
+        encoded = self.hasher.hash('secret')
+        self.assertTrue(encoded.startswith('$pbkdf2-sha256$1000$'))
+        self.assertNotEqual(encoded, self.hasher.hash('secret'))
+        self.assertTrue(self.hasher.verify('secret', encoded))
+        self.assertTrue(self.hasher.verify(b'secret', encoded))
+        self.assertFalse(self.hasher.verify('wrong', encoded))
+        self.assertFalse(self.hasher.verify('secret'))
+        self.assertRaises(ValueError, self.hasher.verify, 'secret', '$x$1')
+
+    def test_scrypt(self):
+        hasher = authme.password.PasswordHasher(authme.password.SCRYPT,
+                                                cost=10)
+        encoded = hasher.hash('secret')
+        self.assertTrue(encoded.startswith('$scrypt$ln=10,r=8,p=1$'))
+        self.assertTrue(hasher.verify('secret', encoded))
+        # Any hasher verifies any algorithm.
+        self.assertTrue(self.hasher.verify('secret', encoded))
+        hasher.close()
+
+    def test_needs_rehash(self):
+        encoded = self.hasher.hash('secret')
+        self.assertFalse(self.hasher.needs_rehash(encoded))
+        stronger = authme.password.PasswordHasher(cost=2000)
+        self.assertTrue(stronger.needs_rehash(encoded))
+        stronger.close()
+
+    def test_calibrate(self):
+        self.assertGreaterEqual(authme.password.calibrate(target=0.001),
+                                authme.password.MIN_ITERATIONS)
+        self.assertGreaterEqual(authme.password.calibrate(
+                                    authme.password.SCRYPT, target=0.001),
+                                authme.password.MIN_SCRYPT_LOG_N)
+
+    def test_bounded(self):
+        started, release = threading.Event(), threading.Event()
+
+        class Blocked(object):
+            def submit(self, func, *args):
+                started.set()
+                release.wait()
+                future = concurrent.futures.Future()
+                future.set_result(func(*args))
+                return future
+
+        hasher = authme.password.PasswordHasher(cost=1000, max_workers=1,
+                                    max_queue=0, executor=Blocked())
+        thread = threading.Thread(target=hasher.hash, args=('a',))
+        thread.start()
+        started.wait()
+        self.assertRaises(authme.exc.PasswordHasherBusy, hasher.hash, 'b')
+        release.set()
+        thread.join()
+        self.assertTrue(hasher.verify('b', hasher.hash('b')))
@@ -0,0 +1,36 @@
+""" """
+import unittest
+
+import pyramid.testing
+
+import authme.pyramid.policy
+
+
+class Principals(object):
+    def get(self, userid):
+        if userid == 1:
+            return frozenset(['u:1', 'g:staff'])
+
+
+class TestTktAuthnPolicy(unittest.TestCase):
+    """ """
+    def request(self, policy, userid):
+        headers = policy.remember(pyramid.testing.DummyRequest(), userid)
+        name, value = headers[0][1].split(';')[0].split('=', 1)
+        request = pyramid.testing.DummyRequest()
+        request.cookies[name] = value.strip('"')
+        return request
+
+    def test_principals(self):
+        policy = authme.pyramid.policy.TktAuthnPolicy('secret',
+                                                principals=Principals())
+        self.assertEqual(policy.effective_principals(self.request(policy, 1)),
+                         ['system.Everyone', 'system.Authenticated', 1,
+                          'g:staff', 'u:1'])
+        self.assertEqual(policy.effective_principals(self.request(policy, 2)),
+                         ['system.Everyone'])
+
+    def test_no_principals(self):
+        policy = authme.pyramid.policy.TktAuthnPolicy('secret')
+        self.assertEqual(policy.authenticated_userid(
+                            self.request(policy, 2)), 2)
@@ -0,0 +1,53 @@
+""" """
+import unittest
+
+import authme.ratelimit
+
+
+class TestRateLimiter(unittest.TestCase):
+    """ """
+    def setUp(self):
+        self.now = [0]
+        self.limiter = authme.ratelimit.RateLimiter(rate=1, burst=3,
+                                    maxsize=2,
+                                    time_provider=lambda: self.now[0])
+
+    def test_bucket(self):
+        for _ in range(3):
+            self.assertTrue(self.limiter.allow('a'))
+        self.assertFalse(self.limiter.allow('a'))
+        self.assertTrue(self.limiter.allow('b'))
+        self.now[0] = 1.5
+        self.assertTrue(self.limiter.allow('a'))
+        self.assertFalse(self.limiter.allow('a'))
+        # Refill is capped at the burst size.
+        self.now[0] = 100
+        self.assertTrue(self.limiter.allow('a', 3))
+        self.assertFalse(self.limiter.allow('a'))
+
+    def test_penalize(self):
+        self.limiter.penalize('a', 5)
+        self.assertFalse(self.limiter.allow('a'))
+        self.now[0] = 2
+        self.assertFalse(self.limiter.allow('a'))
+        self.now[0] = 3
+        self.assertTrue(self.limiter.allow('a'))
+
+    def test_bounded(self):
+        for key in 'abc':
+            self.limiter.allow(key, 3)
+        self.assertEqual(len(self.limiter), 2)
+        # 'a' was dropped and starts over.
+        self.assertTrue(self.limiter.allow('a'))
+        self.assertFalse(self.limiter.allow('c'))
+
+    def test_debt_kept(self):
+        self.limiter.penalize('a', 8)
+        self.limiter.allow('b')
+        self.limiter.allow('c')
+        self.assertEqual(len(self.limiter), 2)
+        # Pushed out owing 5 tokens, 1 repaid per second.
+        self.now[0] = 4
+        self.assertFalse(self.limiter.allow('a'))
+        self.now[0] = 6
+        self.assertTrue(self.limiter.allow('a'))
@@ -0,0 +1,39 @@
+import unittest
+
+import authme.exc
+import authme.hmac
+import authme.replay
+
+
+class ReplayCacheTests(unittest.TestCase):
+    """
+    """
+    def test_seen(self):
+        cache = authme.replay.ReplayCache(expiry=10)
+        self.assertFalse(cache.seen(b'sig', 100))
+        self.assertTrue(cache.seen(b'sig', 100))
+        self.assertFalse(cache.seen(b'other', 100))
+        self.assertEqual(len(cache), 2)
+
+    def test_expired_bucket_is_reused(self):
+        cache = authme.replay.ReplayCache(expiry=10, shards=1)
+        cache.seen(b'sig', 100)
+        # Same slot, one full wheel revolution later.
+        later = 100 + cache._nslots
+        self.assertFalse(cache.seen(b'sig', later))
+        self.assertEqual(len(cache), 1)
+
+    def test_window_has_distinct_slots(self):
+        cache = authme.replay.ReplayCache(expiry=10, shards=1)
+        for ts in range(90, 111):
+            self.assertFalse(cache.seen(b'sig', ts))
+        for ts in range(90, 111):
+            self.assertTrue(cache.seen(b'sig', ts))
+
+    def test_timed_hmac(self):
+        h = authme.hmac.TimedHmac(b'12345', expiry=10,
+                    replay_cache=authme.replay.ReplayCache(expiry=10))
+        sig = h.sign(b'1')
+        self.assertRaises(authme.exc.SignatureBad, h.verify, sig, b'2')
+        self.assertTrue(h.verify(sig, b'1'))
+        self.assertRaises(authme.exc.SignatureReplayed, h.verify, sig, b'1')
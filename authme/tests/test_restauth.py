@@ -0,0 +1,346 @@
+""" """
+import os
+import base64
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import pyramid.testing
+import pyramid.security
+import pyramid.httpexceptions
+
+import authme.exc
+import authme.hmac
+import authme.message
+import authme.metrics
+import authme.pyramid.restauth
+import authme.ratelimit
+import authme.shared
+
+
+class TestRestAuthnPolicy(unittest.TestCase):
+    """ """
+
+    def setUp(self):
+        self.policy = authme.pyramid.restauth.RestAuthnPolicy(b'server',
+                                    {b'guest': {'secret': b'12345'}})
+
+    def request(self, body=b'{}', sender_id='guest'):
+        request = pyramid.testing.DummyRequest(body=body,
+                                               client_addr='127.0.0.1')
+        request.headers['X-Restauth-Sender-Id'] = sender_id
+        request.headers['X-Restauth-Signature'] = base64.b64encode(
+                authme.hmac.TimedHmac(b'12345').sign(body)).decode()
+        request.headers['X-Restauth-Signature-Nonce'] = ''
+        return request
+
+    def test_effective_principals_memoized(self):
+        request = self.request()
+        digest = authme.hmac.Hmac._digest
+        with unittest.mock.patch.object(authme.hmac.Hmac, '_digest',
+                                        autospec=True,
+                                        side_effect=digest) as counted:
+            principals = self.policy.effective_principals(request)
+            for _ in range(5):
+                self.assertEqual(self.policy.effective_principals(request),
+                                 principals)
+        self.assertEqual(counted.call_count, 1)
+        self.assertEqual(len(request.response_callbacks), 1)
+        self.assertIn(authme.pyramid.restauth.TightGuest, principals)
+
+    def test_effective_principals_per_request(self):
+        first = self.request()
+        second = self.request(body=b'[]')
+        self.policy.effective_principals(first)
+        self.policy.effective_principals(second)
+        self.assertEqual(len(first.response_callbacks), 1)
+        self.assertEqual(len(second.response_callbacks), 1)
+
+    def test_missing_signature(self):
+        for signature in (None, ''):
+            request = self.request()
+            if signature is None:
+                del request.headers['X-Restauth-Signature']
+            else:
+                request.headers['X-Restauth-Signature'] = signature
+            self.assertRaises(authme.exc.SignatureBad,
+                              self.policy.receive_json, request)
+            self.assertEqual(self.policy.effective_principals(request),
+                             [pyramid.security.Everyone])
+
+    def test_json_round_trip(self):
+        request = pyramid.testing.DummyRequest(client_addr='127.0.0.1')
+        request.auth_api = self.policy
+        remote_id = self.policy.remember(request, 7)['remotes']['server'][
+                                                                'senderId']
+        remote = self.policy.lookup(remote_id)
+        client = authme.message.JsonAuthApi(b'client', {b'server': remote})
+        packet = client.send(b'server', {'b': 1, 'a': [2]},
+                             b'127.0.0.1')
+        request = pyramid.testing.DummyRequest(body=b'{"b":1,"a":[2]}',
+                                               client_addr='127.0.0.1')
+        request.headers['X-Restauth-Sender-Id'] = '*' + remote_id
+        request.headers['X-Restauth-Signature'] = packet['signature'].decode()
+        request.headers['X-Restauth-Signature-Nonce'] = ''
+        principals = self.policy.effective_principals(request)
+        self.assertIn(pyramid.security.Authenticated, principals)
+        self.assertIn('u:%s' % remote_id, principals)
+
+        # Signed for another address.
+        request.client_addr = '10.0.0.1'
+        del request.restauth_principals
+        self.assertNotIn(pyramid.security.Authenticated,
+                         self.policy.effective_principals(request))
+
+        response = request.response
+        response.body = b'{"ok":true}'
+        self.policy.send(request, response)
+        self.assertTrue(authme.hmac.TimedHmac(remote['secret']).verify(
+                base64.b64decode(response.headers['X-Restauth-Signature']),
+                response.body))
+
+
+class TestUserPrincipals(unittest.TestCase):
+    """ """
+
+    def test_served_from_principals(self):
+        principals = unittest.mock.Mock()
+        principals.get.return_value = frozenset(['u:7', 'g:staff'])
+        policy = authme.pyramid.restauth.RestAuthnPolicy(b'server',
+                                    principals=principals)
+        policy.authenticated['remote'] = 7
+        policy.authenticated['anonymous'] = None
+        self.assertEqual(policy.user_principals('remote'), ['g:staff', 'u:7'])
+        self.assertEqual(policy.user_principals('anonymous'), [])
+        self.assertEqual(policy.user_principals('missing'), [])
+        principals.get.assert_called_once_with(7)
+
+
+class TestSharedRemotes(unittest.TestCase):
+    """ """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'remotes')
+        # Two workers' policies.
+        self.policies = [authme.pyramid.restauth.RestAuthnPolicy(b'server',
+                            authme.shared.SharedRemotes(path,
+                                    {b'guest': {'secret': b'12345'}}))
+                         for _ in range(2)]
+
+    def tearDown(self):
+        for policy in self.policies:
+            policy.remotes.close()
+        shutil.rmtree(self.dir)
+
+    def test_remembered_everywhere(self):
+        request = pyramid.testing.DummyRequest(client_addr='127.0.0.1')
+        request.auth_api = self.policies[0]
+        remembered = self.policies[0].remember(request, 7)
+        remote_id = remembered['remotes']['server']['senderId']
+        request.headers['X-Restauth-Sender-Id'] = remote_id
+        for policy in self.policies:
+            self.assertEqual(policy.authenticated_userid(request), remote_id)
+            self.assertEqual(policy.authenticated.get(remote_id), 7)
+        request.headers['X-Restauth-Sender-Id'] = 'guest'
+        self.assertIsNone(self.policies[1].authenticated_userid(request))
+
+        request.headers['X-Restauth-Sender-Id'] = remote_id
+        self.policies[1].forget(request)
+        self.assertIsNone(self.policies[0].authenticated_userid(request))
+
+    def test_remember_full(self):
+        request = pyramid.testing.DummyRequest(client_addr='127.0.0.1')
+        request.auth_api = self.policies[0]
+        with unittest.mock.patch.object(self.policies[0].remotes, 'update',
+                        side_effect=authme.exc.RemotesFull('full')):
+            self.assertRaises(
+                        pyramid.httpexceptions.HTTPServiceUnavailable,
+                        self.policies[0].remember, request, 7)
+
+
+class TestRateLimit(unittest.TestCase):
+    """ """
+
+    def setUp(self):
+        self.registry = authme.metrics.Registry()
+        self.policy = self.make_policy()
+
+    def make_policy(self, **kwa):
+        return authme.pyramid.restauth.RestAuthnPolicy(b'server',
+                                    {b'guest': {'secret': b'12345'}},
+                                    raw_body=True, metrics=self.registry,
+                                    rate_limiter=authme.ratelimit.RateLimiter(
+                                        rate=0.001, burst=6),
+                                    failure_cost=2, **kwa)
+
+    def request(self, signed=b'{}', client_addr='127.0.0.1'):
+        request = pyramid.testing.DummyRequest(body=b'{}',
+                                               client_addr=client_addr)
+        request.headers['X-Restauth-Sender-Id'] = 'guest'
+        request.headers['X-Restauth-Signature'] = base64.b64encode(
+                authme.hmac.TimedHmac(b'12345').sign(signed)).decode()
+        return request
+
+    def test_failures_are_penalized(self):
+        self.policy.effective_principals(self.request(b'forged'))
+        self.policy.effective_principals(self.request(b'forged'))
+        request = self.request()
+        digest = authme.hmac.Hmac._digest
+        with unittest.mock.patch.object(authme.hmac.Hmac, '_digest',
+                                        autospec=True,
+                                        side_effect=digest) as counted:
+            self.assertRaises(pyramid.httpexceptions.HTTPTooManyRequests,
+                              self.policy.effective_principals, request)
+        # Rejected before any crypto.
+        self.assertEqual(counted.call_count, 0)
+        self.assertEqual(self.registry.count('auth_rate_limited'), 1)
+        # Other addresses are limited separately.
+        self.assertIn(authme.pyramid.restauth.TightGuest,
+                      self.policy.effective_principals(
+                            self.request(client_addr='10.0.0.1')))
+
+    def test_no_address_limit(self):
+        for i in range(4):
+            request = self.request(b'forged')
+            request.headers['X-Restauth-Sender-Id'] = 'forged%d' % i
+            self.policy.effective_principals(request)
+        self.assertEqual(self.registry.count('auth_rate_limited'), 0)
+
+    def test_rotating_sender_ids(self):
+        self.policy = self.make_policy(
+                            address_limiter=authme.ratelimit.RateLimiter(
+                                rate=0.001, burst=6))
+        for i in range(2):
+            request = self.request(b'forged')
+            request.headers['X-Restauth-Sender-Id'] = 'forged%d' % i
+            self.policy.effective_principals(request)
+        request = self.request()
+        request.headers['X-Restauth-Sender-Id'] = 'forged2'
+        self.assertRaises(pyramid.httpexceptions.HTTPTooManyRequests,
+                          self.policy.effective_principals, request)
+
+
+class TestRawBody(unittest.TestCase):
+    """ """
+
+    def setUp(self):
+        self.policy = authme.pyramid.restauth.RestAuthnPolicy(b'server',
+                                    {b'guest': {'secret': b'12345'}},
+                                    raw_body=True)
+
+    def request(self, body, sender_id='guest', signed=None):
+        request = pyramid.testing.DummyRequest(body=body,
+                                               client_addr='127.0.0.1')
+        request.headers['X-Restauth-Sender-Id'] = sender_id
+        request.headers['X-Restauth-Signature'] = base64.b64encode(
+                authme.hmac.TimedHmac(b'12345').sign(
+                    body if signed is None else signed)).decode()
+        return request
+
+    def test_receive(self):
+        body = b'{"b": 1,  "a": [2]}'
+        loads = unittest.mock.Mock()
+        with unittest.mock.patch.dict(authme.pyramid.restauth.json,
+                                      {'loads': loads}):
+            principals = self.policy.effective_principals(
+                                                    self.request(body))
+        self.assertFalse(loads.called)
+        self.assertIn(authme.pyramid.restauth.TightGuest, principals)
+
+        principals = self.policy.effective_principals(
+                            self.request(body, signed=b'{"b":1,"a":[2]}'))
+        self.assertIn(authme.pyramid.restauth.Guest, principals)
+
+    def test_missing_signature(self):
+        for signature in (None, ''):
+            request = self.request(b'{}')
+            if signature is None:
+                del request.headers['X-Restauth-Signature']
+            else:
+                request.headers['X-Restauth-Signature'] = signature
+            self.assertRaises(authme.exc.SignatureBad,
+                              self.policy.receive_raw, request)
+            self.assertEqual(self.policy.effective_principals(request),
+                             [pyramid.security.Everyone])
+
+    def test_malformed_headers(self):
+        for header in ('X-Restauth-Signature', 'X-Restauth-Signature-Nonce'):
+            request = self.request(b'{}')
+            request.headers[header] = '%not base64%'
+            self.assertRaises(authme.exc.SignatureBad,
+                              self.policy.receive_raw, request)
+            self.assertIn(authme.pyramid.restauth.Guest,
+                          self.policy.effective_principals(request))
+
+    def test_key_rotation(self):
+        self.policy.add_remote(b'client', {'secrets': {b'1': b'old',
+                                                       b'2': b'new'},
+                                           'key_id': b'2'})
+        for key_id in (b'1', b'2'):
+            request = pyramid.testing.DummyRequest(body=b'{}',
+                                                   client_addr='127.0.0.1')
+            request.headers['X-Restauth-Sender-Id'] = 'client'
+            request.headers['X-Restauth-Signature'] = base64.b64encode(
+                    authme.hmac.TimedHmac({b'1': b'old', b'2': b'new'},
+                        key_id=key_id).sign(b'{}')).decode()
+            self.policy.receive_raw(request)
+
+    def test_send(self):
+        request = self.request(b'')
+        response = pyramid.testing.DummyRequest().response
+        response.body = b'{"b": 1,  "a": [2]}'
+        self.policy.send(request, response)
+        signature = base64.b64decode(
+                            response.headers['X-Restauth-Signature'])
+        self.assertTrue(authme.hmac.TimedHmac(b'12345').verify(signature,
+                                                            response.body))
+        self.assertEqual(response.headers['X-Restauth-Sender-Id'], 'server')
+
+
+class TestMetrics(unittest.TestCase):
+    """ """
+
+    def test_counters(self):
+        registry = authme.metrics.Registry()
+        policy = authme.pyramid.restauth.RestAuthnPolicy(b'server',
+                                    {b'guest': {'secret': b'12345'}},
+                                    raw_body=True, metrics=registry)
+        request = pyramid.testing.DummyRequest(body=b'{}',
+                                               client_addr='127.0.0.1')
+        request.headers['X-Restauth-Sender-Id'] = 'guest'
+        request.headers['X-Restauth-Signature'] = base64.b64encode(
+                authme.hmac.TimedHmac(b'12345').sign(b'{}')).decode()
+        policy.receive(request)
+        request.headers['X-Restauth-Signature'] = base64.b64encode(
+                authme.hmac.TimedHmac(b'12345').sign(b'[]')).decode()
+        self.assertRaises(authme.exc.SignatureBad, policy.receive, request)
+        request.headers['X-Restauth-Sender-Id'] = 'nobody'
+        self.assertRaises(authme.exc.AuthMessageException, policy.receive,
+                          request)
+
+        self.assertEqual(registry.count('auth_success'), 1)
+        self.assertEqual(registry.count('auth_bad_signature'), 1)
+        self.assertEqual(registry.count('auth_unknown_client'), 1)
+        self.assertEqual(registry.histogram('verify')[0], 2)
+        self.assertEqual(registry.histogram('lookup')[0], 3)
+
+    def test_json_stages(self):
+        registry = authme.metrics.Registry()
+        policy = authme.pyramid.restauth.RestAuthnPolicy(b'server',
+                                    {b'guest': {'secret': b'12345'}},
+                                    metrics=registry)
+        request = pyramid.testing.DummyRequest(body=b'{"a":1}',
+                                               client_addr='127.0.0.1')
+        request.headers['X-Restauth-Sender-Id'] = 'guest'
+        request.headers['X-Restauth-Signature'] = base64.b64encode(
+                authme.hmac.TimedHmac(b'12345').sign(b'{"a":1}')).decode()
+        request.headers['X-Restauth-Signature-Nonce'] = ''
+        policy.receive(request)
+        request.response.body = b'{}'
+        policy.send(request, request.response)
+
+        for stage, count in (('parse', 2), ('lookup', 2), ('verify', 1),
+                             ('sign', 1)):
+            self.assertEqual(registry.histogram(stage)[0], count, stage)
@@ -0,0 +1,131 @@
+""" """
+import os
+import shutil
+import tempfile
+import unittest
+
+import authme.exc
+import authme.shared
+
+
+class TestSharedRemotes(unittest.TestCase):
+    """ """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'remotes')
+        self.remotes = authme.shared.SharedRemotes(self.path,
+                                    {b'guest': {'secret': b'12345'}},
+                                    slots=64)
+
+    def tearDown(self):
+        self.remotes.close()
+        shutil.rmtree(self.dir)
+
+    def test_get_update_remove(self):
+        self.assertEqual(self.remotes.get(b'guest'),
+                         {'secret': b'12345', 'key': None, 'tight': False})
+        self.assertNotIn('guest', self.remotes)
+        self.remotes.update('client', {'secret': b'1', 'key': b'2',
+                                       'tight': True, 'userid': 7})
+        self.assertEqual(self.remotes.get('client'),
+                         {'secret': b'1', 'key': b'2', 'tight': True,
+                          'userid': 7})
+        self.remotes.update('client', {'secret': b'3', 'userid': 'bob'})
+        self.assertEqual(self.remotes.get('client')['userid'], 'bob')
+        self.assertEqual(len(self.remotes), 2)
+
+        self.remotes.remove('client')
+        self.assertNotIn('client', self.remotes)
+        self.assertEqual(len(self.remotes), 1)
+        self.assertRaises(authme.exc.MessageClientBad, self.remotes.get,
+                          'client')
+        self.assertRaises(authme.exc.MessageClientBad, self.remotes.remove,
+                          'client')
+
+        id_, _ = self.remotes.add(vals={'secret': b'4'})
+        self.assertEqual(self.remotes.get(id_)['secret'], b'4')
+
+    def test_limits(self):
+        self.assertRaises(ValueError, self.remotes.update, 'client',
+                          {'secret': b'x' * 129})
+        self.assertRaises(ValueError, self.remotes.update, 'x' * 65, {})
+        self.assertRaises(TypeError, self.remotes.update, 'client',
+                          {'other': 1})
+        for i in range(63):
+            self.remotes.update(i.to_bytes(2, 'big'), {})
+        self.assertRaises(authme.exc.RemotesFull, self.remotes.update,
+                          b'full', {})
+        # Tombstones are reused.
+        self.remotes.remove(b'\x00\x05')
+        self.remotes.update(b'full', {})
+        self.assertIn(b'full', self.remotes)
+
+    def test_tombstones_reclaimed(self):
+        # Churn far past the table size never fills it with tombstones.
+        for i in range(1000):
+            self.remotes.update(b'%d' % i, {'secret': b'1'})
+            if i >= 40:
+                self.remotes.remove(b'%d' % (i - 40))
+        tombstones = authme.shared._header.unpack_from(self.remotes._mmap)[4]
+        self.assertLessEqual(tombstones, 16)
+        self.assertEqual(len(self.remotes), 41)
+        for i in range(960, 1000):
+            self.assertEqual(self.remotes.get(b'%d' % i)['secret'], b'1')
+        self.assertNotIn(b'959', self.remotes)
+        self.assertEqual(self.remotes.compact(), 41)
+        self.assertEqual(self.remotes.get(b'guest')['secret'], b'12345')
+        self.assertIn(b'999', self.remotes)
+
+    def test_ttl(self):
+        now = [1000.0]
+        remotes = authme.shared.SharedRemotes(self.path, ttl=60,
+                                              time_provider=lambda: now[0])
+        self.addCleanup(remotes.close)
+        for i in range(63):
+            remotes.update(i.to_bytes(2, 'big'), {})
+        now[0] += 40
+        # Used past half its ttl: the deadline moves.
+        remotes.get(b'\x00\x01')
+        now[0] += 40
+        self.assertIn(b'\x00\x01', remotes)
+        self.assertNotIn(b'\x00\x02', remotes)
+        self.assertRaises(authme.exc.MessageClientBad, remotes.get,
+                          b'\x00\x02')
+        self.assertEqual(remotes.get(b'guest')['secret'], b'12345')
+        # Expired slots are reused instead of raising RemotesFull.
+        remotes.update(b'new', {})
+        self.assertIn(b'new', remotes)
+        self.assertEqual(remotes.compact(), 3)
+
+    def test_shared_between_processes(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                remotes = authme.shared.SharedRemotes(self.path)
+                remotes.update('client', {'secret': b'1', 'userid': 7})
+                remotes.remove(b'guest')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.remotes.get('client')['secret'], b'1')
+        self.assertNotIn(b'guest', self.remotes)
+        # Reopened with the size it was created with.
+        reopened = authme.shared.SharedRemotes(self.path, slots=1024)
+        self.assertEqual(reopened._slots, 64)
+        self.assertEqual(len(reopened), 1)
+        reopened.close()
+
+    def test_consistent_reads(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for i in range(2000):
+                    value = b'%d' % i * 10
+                    self.remotes.update('client', {'secret': value,
+                                                   'key': value})
+            finally:
+                os._exit(0)
+        while os.waitpid(pid, os.WNOHANG) == (0, 0):
+            if 'client' in self.remotes:
+                remote = self.remotes.get('client')
+                self.assertEqual(remote['secret'], remote['key'])
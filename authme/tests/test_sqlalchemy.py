@@ -0,0 +1,628 @@
+""" """
+import time
+import unittest
+
+import sqlalchemy as sa
+import sqlalchemy.event
+import sqlalchemy.orm
+import sqlalchemy.pool
+import sqlalchemy.ext.declarative
+
+import authme.exc
+import authme.password
+import authme.sqlalchemy
+
+
+Base = sqlalchemy.ext.declarative.declarative_base()
+
+
+# Mirrors authme.sqlalchemy.model.RemoteMix, which needs `apothecary`.
+class Remote(Base):
+    __tablename__ = 'remotes'
+    remote_id = sa.Column(sa.String(255), primary_key=True)
+    secret = sa.Column(sa.LargeBinary, nullable=True)
+    key = sa.Column(sa.LargeBinary, nullable=True)
+    tight = sa.Column(sa.Boolean, nullable=False, default=False)
+
+
+class UserRemote(Base):
+    __tablename__ = 'user_remotes'
+    remote_id = sa.Column(sa.String(255), primary_key=True)
+    secret = sa.Column(sa.LargeBinary, nullable=True)
+    key = sa.Column(sa.LargeBinary, nullable=True)
+    tight = sa.Column(sa.Boolean, nullable=False, default=False)
+    userid = sa.Column(sa.Integer, nullable=True)
+
+
+# Minimal stand-ins for authme.sqlalchemy.model.UserMix/GroupMix/
+# PermissionMix.
+user_groups = sa.Table('user_groups', Base.metadata,
+                    sa.Column('user_id', sa.ForeignKey('users.id')),
+                    sa.Column('group_id', sa.ForeignKey('groups.id')))
+group_permissions = sa.Table('group_permissions', Base.metadata,
+                    sa.Column('group_id', sa.ForeignKey('groups.id')),
+                    sa.Column('permission_id', sa.ForeignKey('permissions.id')))
+
+
+class User(Base):
+    __tablename__ = 'users'
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(255), unique=True)
+    active = sa.Column(sa.Boolean, nullable=False, default=True)
+    password = sa.Column(sa.String(255))
+    groups = sqlalchemy.orm.relationship('Group', secondary=user_groups)
+
+
+class Group(Base):
+    __tablename__ = 'groups'
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(255), unique=True)
+    active = sa.Column(sa.Boolean, nullable=False, default=True)
+    permissions = sqlalchemy.orm.relationship('Permission',
+                                              secondary=group_permissions)
+
+
+class Permission(Base):
+    __tablename__ = 'permissions'
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(255), unique=True)
+
+
+class ImmediateExecutor(object):
+    def submit(self, func, *args):
+        func(*args)
+
+
+class DbTestCase(unittest.TestCase):
+    """ """
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://',
+                                    poolclass=sqlalchemy.pool.StaticPool,
+                                    connect_args={'check_same_thread': False})
+        Base.metadata.create_all(self.engine)
+        self.Session = sqlalchemy.orm.scoped_session(
+                            sqlalchemy.orm.sessionmaker(bind=self.engine))
+        self.queries = []
+        sqlalchemy.event.listen(self.engine, 'before_cursor_execute',
+                                self._count)
+
+    def tearDown(self):
+        self.Session.remove()
+        self.engine.dispose()
+
+    def _count(self, conn, cursor, statement, *args):
+        self.queries.append(statement)
+
+
+class TestRemotesAdapter(DbTestCase):
+    """ """
+    def remotes(self, **kwa):
+        kwa.setdefault('flush_interval', 3600)
+        return authme.sqlalchemy.RemotesAdapter(self.Session, Remote, **kwa)
+
+    def wait_for(self, count):
+        for _ in range(200):
+            if self.Session.query(Remote).count() == count:
+                return
+            self.Session.remove()
+            time.sleep(0.01)
+        self.assertEqual(self.Session.query(Remote).count(), count)
+
+    def test_read_through(self):
+        remotes = self.remotes()
+        remotes.update(b'client', {'secret': b'12345'})
+        remotes.flush()
+
+        remotes = self.remotes()
+        del self.queries[:]
+        self.assertEqual(remotes.get(b'client'),
+                         {'secret': b'12345', 'key': None, 'tight': False})
+        self.assertEqual(len(self.queries), 1)
+        remotes.get('client')
+        self.assertIn(b'client', remotes)
+        self.assertEqual(len(self.queries), 1)
+
+        self.assertNotIn(b'missing', remotes)
+        self.assertRaises(authme.exc.MessageClientBad, remotes.get,
+                          b'missing')
+
+    def test_write_behind(self):
+        remotes = self.remotes(batch_size=3)
+        del self.queries[:]
+        remotes.update(b'a', {'secret': b'1'})
+        remotes.update(b'a', {'secret': b'2'})
+        self.assertEqual(self.queries, [])
+        self.assertEqual(remotes.get(b'a')['secret'], b'2')
+
+        remotes.update(b'b', {'secret': b'3'})
+        remotes.update(b'c', {'secret': b'4'})
+        # Coalesced: three remotes written in one batch, off this thread.
+        self.wait_for(3)
+        self.assertEqual(self.Session.query(Remote).get('a').secret, b'2')
+
+    def test_remove(self):
+        remotes = self.remotes()
+        remotes.update(b'a', {'secret': b'1'})
+        remotes.flush()
+        remotes.remove(b'a')
+        self.assertNotIn(b'a', remotes)
+        self.assertEqual(self.Session.query(Remote).count(), 1)
+        self.assertEqual(remotes.flush(), 1)
+        self.assertEqual(self.Session.query(Remote).count(), 0)
+        self.assertRaises(authme.exc.MessageClientBad, remotes.remove, b'a')
+
+    def test_flush_interval(self):
+        now = [0]
+        remotes = self.remotes(flush_interval=5, time_provider=lambda: now[0])
+        remotes.update(b'a', {'secret': b'1'})
+        self.assertEqual(self.Session.query(Remote).count(), 0)
+        now[0] = 5
+        remotes.update(b'b', {'secret': b'2'})
+        self.wait_for(2)
+
+    def test_flush_timer(self):
+        remotes = self.remotes(flush_interval=0.01)
+        remotes.update(b'a', {'secret': b'1'})
+        # Another worker's adapter, with nothing cached.
+        other = self.remotes()
+        for _ in range(200):
+            if b'a' in other:
+                break
+            time.sleep(0.01)
+        self.assertEqual(other.get(b'a')['secret'], b'1')
+        remotes.close()
+
+    def test_pending_upsert_lookup(self):
+        remotes = self.remotes()
+        remotes.update(b'a', {'secret': b'1'})
+        remotes.invalidate(b'a')
+        self.assertEqual(remotes.get(b'a')['secret'], b'1')
+        remotes.remove(b'a')
+        remotes.invalidate()
+        self.assertNotIn(b'a', remotes)
+
+    def test_own_session(self):
+        remotes = self.remotes()
+        self.Session.add(User(id=1, name='pending'))
+        remotes.update(b'a', {'secret': b'1'})
+        remotes.flush()
+        self.Session.rollback()
+        self.assertEqual(self.Session.query(User).count(), 0)
+        self.assertEqual(self.Session.query(Remote).count(), 1)
+
+    def test_cache_limits(self):
+        now = [0]
+        remotes = self.remotes(ttl=60, maxsize=1,
+                               time_provider=lambda: now[0])
+        remotes.update(b'a', {'secret': b'1'})
+        remotes.update(b'b', {'secret': b'2'})
+        remotes.flush()
+        del self.queries[:]
+        remotes.get(b'b')
+        self.assertEqual(len(self.queries), 0)
+        # Evicted by `maxsize`, read again.
+        remotes.get(b'a')
+        self.assertEqual(len(self.queries), 1)
+
+        # Another worker removes `a`; seen once the cached copy expires.
+        other = self.remotes()
+        other.remove(b'a')
+        other.flush()
+        self.assertIn(b'a', remotes)
+        now[0] = 60
+        self.assertNotIn(b'a', remotes)
+
+    def test_permanent(self):
+        remotes = self.remotes(remotes={b'a': {'secret': b'1'}}, maxsize=1)
+        remotes.update(b'b', {'secret': b'2'})
+        remotes.update(b'c', {'secret': b'3'})
+        remotes.flush()
+        del self.queries[:]
+        remotes.get(b'a')
+        self.assertEqual(len(self.queries), 0)
+        self.assertTrue(remotes.is_permanent('a'))
+
+    def test_stale_read(self):
+        remotes = self.remotes()
+        remotes.update(b'a', {'secret': b'1'})
+        remotes.flush()
+        remotes.invalidate()
+        load = remotes._load
+
+        def racing_load(key):
+            remote = load(key)
+            # Written while the old row was being read.
+            remotes.update(b'a', {'secret': b'2'})
+            remotes.flush()
+            return remote
+        remotes._load = racing_load
+        self.assertEqual(remotes.get(b'a')['secret'], b'1')
+        del remotes._load
+        self.assertEqual(remotes.get(b'a')['secret'], b'2')
+
+    def test_unknown_fields(self):
+        remotes = self.remotes()
+        self.assertRaises(TypeError, remotes.update, b'a',
+                          {'secret': b'1', 'userid': 5})
+        self.assertNotIn(b'a', remotes)
+
+    def test_optional_fields(self):
+        remotes = authme.sqlalchemy.RemotesAdapter(self.Session, UserRemote,
+                                                   flush_interval=None)
+        remotes.update(b'a', {'secret': b'1', 'userid': 5})
+        remotes.update(b'b', {'secret': b'2'})
+        remotes.close()
+        other = authme.sqlalchemy.RemotesAdapter(self.Session, UserRemote)
+        self.assertEqual(other.get(b'a')['userid'], 5)
+        self.assertNotIn('userid', other.get(b'b'))
+        self.assertRaises(TypeError, other.update, b'c',
+                          {'secret': b'3', 'key_id': 'k1'})
+
+    def test_add(self):
+        remotes = self.remotes()
+        id_, remote = remotes.add(vals={'secret': b'1', 'tight': True})
+        remotes.close()
+        self.assertEqual(self.Session.query(Remote).get(str(id_)).tight, True)
+
+
+class TestUserAdapterCache(DbTestCase):
+    """ """
+    def setUp(self):
+        DbTestCase.setUp(self)
+        self.Session.add_all([User(id=1, name='alice'),
+                              User(id=2, name='bob')])
+        self.Session.commit()
+        self.Session.remove()
+        self.now = [0]
+
+    def users(self, **kwa):
+        kwa.setdefault('cache_ttl', 60)
+        kwa.setdefault('time_provider', lambda: self.now[0])
+        users = authme.sqlalchemy.UserAdapter(self.Session, User, Group, **kwa)
+        self.addCleanup(users.close)
+        return users
+
+    def test_uncached(self):
+        users = self.users(cache_ttl=None)
+        del self.queries[:]
+        users.get_user_by_id(1)
+        self.Session.remove()
+        users.get_user_by_id(1)
+        self.assertEqual(len(self.queries), 2)
+
+    def test_cached(self):
+        users = self.users()
+        del self.queries[:]
+        self.assertEqual(users.get_user_by_id(1).name, 'alice')
+        self.assertEqual(users.get_user_by_name('bob').id, 2)
+        self.Session.remove()
+        user = users.get_user_by_id(1)
+        self.assertEqual(users.get_user_by_name('bob').id, 2)
+        self.assertEqual(len(self.queries), 2)
+        # Attached to the current session.
+        self.assertIs(user, self.Session.query(User).get(1))
+        self.assertIsNone(users.get_user_by_id(3))
+
+    def test_expiry_and_maxsize(self):
+        users = self.users(cache_maxsize=1)
+        users.get_user_by_id(1)
+        users.get_user_by_id(2)
+        self.Session.remove()
+        del self.queries[:]
+        users.get_user_by_id(2)
+        self.assertEqual(len(self.queries), 0)
+        users.get_user_by_id(1)
+        self.assertEqual(len(self.queries), 1)
+        self.now[0] = 60
+        self.Session.remove()
+        users.get_user_by_id(1)
+        self.assertEqual(len(self.queries), 2)
+
+    def test_invalidate_on_change(self):
+        users = self.users()
+        users.get_user_by_id(1)
+        users.get_user_by_name('alice')
+        user = self.Session.query(User).get(1)
+        user.active = False
+        user.name = 'carol'
+        self.Session.commit()
+        self.Session.remove()
+        self.assertNotIn(1, users._by_id)
+        self.assertNotIn('alice', users._by_name)
+        self.assertIsNone(users.get_user_by_name('alice'))
+        self.assertFalse(users.get_user_by_id(1).active)
+
+        users.get_user_by_name('bob')
+        users.invalidate(2)
+        self.assertNotIn('bob', users._by_name)
+
+    def test_invalidate_on_commit(self):
+        users = self.users()
+        users.get_user_by_id(1)
+        user = self.Session.query(User).get(1)
+        user.name = 'carol'
+        self.Session.flush()
+        self.assertNotIn(1, users._by_id)
+        # Reloaded from the committed row before this session commits.
+        users._by_id.put(1, user)
+        users._by_name.put('alice', user)
+        self.Session.commit()
+        self.assertNotIn(1, users._by_id)
+        self.assertNotIn('alice', users._by_name)
+
+        users.close()
+        users._by_id.put(1, user)
+        user.name = 'dave'
+        self.Session.commit()
+        self.assertIn(1, users._by_id)
+
+    def test_stale_while_revalidate(self):
+        users = self.users(stale_ttl=30, executor=ImmediateExecutor())
+        users.get_user_by_id(1)
+        # Changed behind the ORM's back.
+        self.Session.execute(sa.text("UPDATE users SET name='dave' WHERE id=1"))
+        self.Session.commit()
+        self.Session.remove()
+        self.now[0] = 70
+        # Served stale, refreshed in the background.
+        self.assertEqual(users.get_user_by_id(1).name, 'alice')
+        self.Session.remove()
+        self.assertEqual(users.get_user_by_id(1).name, 'dave')
+        self.assertEqual(users._by_id.stats['stale'], 1)
+        self.now[0] = 200
+        self.Session.remove()
+        del self.queries[:]
+        users.get_user_by_id(1)
+        self.assertEqual(len(self.queries), 1)
+
+    def test_refresh_keeps_session(self):
+        users = self.users(stale_ttl=30, executor=ImmediateExecutor())
+        users.get_user_by_id(1)
+        session = self.Session()
+        self.Session.add(User(id=3, name='carol'))
+        self.now[0] = 70
+        users.get_user_by_id(1)
+        self.assertIs(self.Session(), session)
+        self.assertEqual(len(session.new), 1)
+        self.Session.rollback()
+
+    def test_default_executor(self):
+        users = self.users(stale_ttl=30)
+        users.get_user_by_id(1)
+        self.Session.execute(sa.text("UPDATE users SET name='dave' WHERE id=1"))
+        self.Session.commit()
+        self.Session.remove()
+        self.now[0] = 70
+        self.assertEqual(users.get_user_by_id(1).name, 'alice')
+        for _ in range(200):
+            if not users._by_id._refreshing:
+                break
+            time.sleep(0.01)
+        self.Session.remove()
+        self.assertEqual(users.get_user_by_id(1).name, 'dave')
+        self.assertIs(users._by_id.executor, None)
+        self.assertLessEqual(
+                    authme.sqlalchemy.refresh_executor()._max_workers, 2)
+
+    def test_close(self):
+        users = self.users()
+        users.get_user_by_id(1)
+        users.close()
+        self.assertFalse(sqlalchemy.event.contains(User, 'after_update',
+                                                   users._on_change))
+        self.Session.query(User).get(1).name = 'carol'
+        self.Session.commit()
+        self.assertIn(1, users._by_id)
+        users.close()
+
+
+class PrincipalsTestCase(DbTestCase):
+    """ """
+    def setUp(self):
+        DbTestCase.setUp(self)
+        read, write = Permission(name='read'), Permission(name='write')
+        staff = Group(name='staff', permissions=[read])
+        admin = Group(name='admin', permissions=[read, write])
+        self.Session.add_all([User(id=i, name='user%d' % i, groups=[staff])
+                              for i in range(1, 21)])
+        self.Session.add(User(id=21, name='root', groups=[staff, admin]))
+        self.Session.add(User(id=22, name='nobody'))
+        self.Session.commit()
+        self.Session.remove()
+        self.users = authme.sqlalchemy.UserAdapter(self.Session, User, Group)
+
+
+class TestUserAdapterBulk(PrincipalsTestCase):
+    """ """
+    def test_get_users_by_ids(self):
+        del self.queries[:]
+        users = self.users.get_users_by_ids(list(range(1, 21)) + [99])
+        self.assertEqual(len(self.queries), 1)
+        self.assertEqual(sorted(users), list(range(1, 21)))
+        self.assertEqual(users[3].name, 'user3')
+        self.assertEqual(self.users.get_users_by_ids([]), {})
+
+    def test_get_users_by_names(self):
+        del self.queries[:]
+        users = self.users.get_users_by_names(['root', 'user1', 'missing'])
+        self.assertEqual(len(self.queries), 1)
+        self.assertEqual(sorted(users), ['root', 'user1'])
+        self.assertEqual(users['root'].id, 21)
+
+    def test_warms_cache(self):
+        users = authme.sqlalchemy.UserAdapter(self.Session, User, Group,
+                                              cache_ttl=60)
+        self.addCleanup(users.close)
+        users.get_users_by_ids([1, 2])
+        self.Session.remove()
+        del self.queries[:]
+        self.assertEqual(users.get_user_by_name('user2').id, 2)
+        self.assertEqual(users.get_user_by_id(1).name, 'user1')
+        self.assertEqual(self.queries, [])
+
+    def test_get_principals(self):
+        del self.queries[:]
+        principals = self.users.get_principals(21)
+        self.assertEqual(principals[0], 'u:21')
+        self.assertEqual(set(principals), {'u:21', 'g:staff', 'g:admin',
+                                           'p:read', 'p:write'})
+        self.assertEqual(len(self.queries), 1)
+        self.assertEqual(self.users.get_principals(22), ['u:22'])
+        self.assertIsNone(self.users.get_principals(99))
+        self.assertEqual(len(self.queries), 3)
+
+    def test_inactive(self):
+        self.Session.query(User).get(1).active = False
+        self.Session.query(Group).filter_by(name='admin').one().active = False
+        self.Session.commit()
+        self.assertIsNone(self.users.get_principals(1))
+        self.assertEqual(set(self.users.get_principals(21)),
+                         {'u:21', 'g:staff', 'p:read'})
+
+
+class TestPrincipalIndex(PrincipalsTestCase):
+    """ """
+    def setUp(self):
+        PrincipalsTestCase.setUp(self)
+        self.index = authme.sqlalchemy.PrincipalIndex(self.users)
+        self.addCleanup(self.index.close)
+
+    def test_get(self):
+        del self.queries[:]
+        principals = self.index.get(21)
+        self.assertEqual(principals, frozenset(['u:21', 'g:staff', 'g:admin',
+                                                'p:read', 'p:write']))
+        self.assertIs(self.index.get(21), principals)
+        self.assertIsNone(self.index.get(99))
+        self.assertIsNone(self.index.get(99))
+        self.assertEqual(len(self.queries), 2)
+        # Unknown userids are cached until such a user is inserted.
+        self.Session.add(User(id=99, name='new'))
+        self.Session.commit()
+        self.assertEqual(self.index.get(99), frozenset(['u:99']))
+
+    def test_maxsize(self):
+        index = authme.sqlalchemy.PrincipalIndex(self.users, maxsize=5)
+        self.addCleanup(index.close)
+        self.assertEqual(index.build(), 22)
+        self.assertEqual(len(index), 5)
+        self.assertIn(22, index)
+        self.assertNotIn(1, index)
+        index.get(1)
+        self.assertNotIn(18, index)
+        self.assertLessEqual(sum(map(len, index._members.values())), 5)
+
+    def test_user_deactivated(self):
+        self.index.build()
+        self.Session.query(User).get(1).active = False
+        self.Session.commit()
+        self.assertNotIn(1, self.index)
+        self.assertIsNone(self.index.get(1))
+        admin = self.Session.query(Group).filter_by(name='admin').one()
+        admin.active = False
+        self.Session.commit()
+        self.assertEqual(self.index.get(21),
+                         frozenset(['u:21', 'g:staff', 'p:read']))
+
+    def test_per_session_changes(self):
+        self.index.build()
+        other = sqlalchemy.orm.Session(bind=self.engine)
+        user = other.query(User).get(22)
+        user.groups.append(other.query(Group).filter_by(name='admin').one())
+        self.index.build([22])
+        # Committing another session doesn't settle `other`'s changes.
+        self.Session.query(User).get(1).name = 'renamed'
+        self.Session.commit()
+        self.assertIn(22, self.index)
+        other.commit()
+        other.close()
+        self.assertNotIn(22, self.index)
+        self.assertIn('g:admin', self.index.get(22))
+
+    def test_close(self):
+        self.index.build()
+        self.index.close()
+        self.assertFalse(sqlalchemy.event.contains(User, 'after_update',
+                                                   self.index._user_flushed))
+        self.Session.query(User).get(1).active = False
+        self.Session.commit()
+        self.assertIn(1, self.index)
+
+    def test_build(self):
+        del self.queries[:]
+        self.assertEqual(self.index.build(), 22)
+        for userid in range(1, 23):
+            self.index.get(userid)
+        self.assertEqual(len(self.queries), 1)
+        self.assertEqual(self.index.get(22), frozenset(['u:22']))
+        self.index.invalidate()
+        self.assertEqual(self.index.build([1, 2]), 2)
+        self.assertEqual(len(self.index), 2)
+
+    def test_membership_change(self):
+        self.index.build()
+        user = self.Session.query(User).get(22)
+        user.groups.append(self.Session.query(Group).filter_by(
+                                                    name='admin').one())
+        self.assertNotIn(22, self.index)
+        self.assertIn(21, self.index)
+        self.Session.commit()
+        self.assertIn('g:admin', self.index.get(22))
+
+    def test_permission_change(self):
+        self.index.build()
+        staff = self.Session.query(Group).filter_by(name='staff').one()
+        staff.permissions.append(Permission(name='audit'))
+        self.Session.commit()
+        self.assertNotIn(1, self.index)
+        self.assertNotIn(21, self.index)
+        self.assertIn(22, self.index)
+        self.assertIn('p:audit', self.index.get(1))
+
+    def test_invalidate_group(self):
+        self.index.build()
+        admin = self.Session.query(Group).filter_by(name='admin').one()
+        self.index.invalidate_group(admin.id)
+        self.assertNotIn(21, self.index)
+        self.assertIn(1, self.index)
+
+
+class TestUserAdapterCredentials(DbTestCase):
+    """ """
+    def setUp(self):
+        DbTestCase.setUp(self)
+        self.hasher = authme.password.PasswordHasher(cost=1000)
+        self.users = authme.sqlalchemy.UserAdapter(self.Session, User, Group,
+                                            password_hasher=self.hasher)
+        alice, bob = User(id=1, name='alice'), User(id=2, name='bob',
+                                                    active=False)
+        self.users.set_password(alice, 'secret')
+        self.users.set_password(bob, 'secret')
+        self.Session.add_all([alice, bob])
+        self.Session.commit()
+
+    def tearDown(self):
+        self.hasher.close()
+        DbTestCase.tearDown(self)
+
+    def test_verify_credentials(self):
+        self.assertEqual(self.users.verify_credentials('alice', 'secret').id,
+                         1)
+        self.assertIsNone(self.users.verify_credentials('alice', 'wrong'))
+        self.assertIsNone(self.users.verify_credentials('bob', 'secret'))
+        self.assertIsNone(self.users.verify_credentials('carol', 'secret'))
+
+    def test_active_attr(self):
+        users = authme.sqlalchemy.UserAdapter(self.Session, User, Group,
+                                              password_hasher=self.hasher,
+                                              active_attr=None)
+        self.assertEqual(users.verify_credentials('bob', 'secret').id, 2)
+
+    def test_rehash(self):
+        old = self.Session.query(User).get(1).password
+        self.users.password_hasher = authme.password.PasswordHasher(
+                                                                cost=2000)
+        user = self.users.verify_credentials('alice', 'secret')
+        self.assertNotEqual(user.password, old)
+        self.assertTrue(user.password.startswith('$pbkdf2-sha256$2000$'))
+        self.users.password_hasher.close()
@@ -0,0 +1,94 @@
+""" """
+import mmap
+import unittest
+import tracemalloc
+
+import authme.codecs
+import authme.hmac
+import authme.message
+
+
+SIZE = 4 * 1024 * 1024
+
+
+def peak_allocated(func, *args):
+    """Run `func` and return (result, peak bytes allocated during the call).
+    """
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        result = func(*args)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class TestZeroCopy(unittest.TestCase):
+    """Buffer protocol objects pass through without being copied to bytes.
+    """
+    def setUp(self):
+        self.data = bytes(range(256)) * (SIZE // 256)
+        self.mmap = mmap.mmap(-1, SIZE)
+        self.mmap.write(self.data)
+        self.buffers = (bytearray(self.data), memoryview(self.data),
+                        self.mmap)
+
+    def tearDown(self):
+        self.buffers = None
+        self.mmap.close()
+
+    def test_hmac_sign(self):
+        h = authme.hmac.Hmac(b'12345')
+        expected = h.sign(self.data, b'nonce')
+        for buf in self.buffers:
+            sig, peak = peak_allocated(h.sign, buf, b'nonce')
+            self.assertEqual(sig, expected)
+            self.assertLess(peak, SIZE // 16)
+
+    def test_hmac_verify(self):
+        h = authme.hmac.TimedHmac(b'12345')
+        sig = h.sign(self.data)
+        for buf in self.buffers:
+            result, peak = peak_allocated(h.verify, memoryview(sig), buf)
+            self.assertTrue(result)
+            self.assertLess(peak, SIZE // 16)
+
+    def test_message(self):
+        expected = authme.message.Message(payload=self.data,
+                                signer=authme.hmac.Hmac(b'12345')).send()
+        for buf in self.buffers:
+            message = authme.message.Message(payload=buf,
+                                    signer=authme.hmac.Hmac(b'12345'))
+            (body, nonce, sig), peak = peak_allocated(message.send)
+            self.assertIs(body, buf)
+            self.assertEqual(sig, expected[2])
+            self.assertLess(peak, SIZE // 16)
+
+            message = authme.message.Message(
+                                    signer=authme.hmac.Hmac(b'12345'))
+            payload, peak = peak_allocated(message.receive, buf, None, sig)
+            self.assertIs(payload, buf)
+            self.assertLess(peak, SIZE // 16)
+
+    def test_pass_cipher(self):
+        for buf in self.buffers:
+            self.assertIs(authme.message.PassCipher.encrypt(buf), buf)
+            self.assertIs(authme.message.PassCipher.decrypt(buf), buf)
+
+    def test_codecs(self):
+        expected, bytes_peak = peak_allocated(
+                                authme.codecs.B64ArgCodec.encode, self.data)
+        for buf in self.buffers:
+            encoded, peak = peak_allocated(authme.codecs.B64ArgCodec.encode,
+                                           buf)
+            self.assertEqual(encoded, expected)
+            # No more than encoding `bytes` costs.
+            self.assertLess(peak, bytes_peak + SIZE // 16)
+
+        self.assertEqual(authme.codecs.JsonArgCodec.encode(memoryview(b'foo')),
+                         ('"Zm9v"',))
+        self.assertEqual(authme.codecs.JsonArgCodec.decode(
+                            memoryview(b'{"Zm9v":"YmFy"}')),
+                         ({b'foo': b'bar'},))
+        self.assertEqual(authme.codecs.decode_all(bytearray(b'foo')), 'foo')
+        self.assertIs(authme.codecs.encode_all(self.mmap), self.mmap)
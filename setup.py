@@ -28,5 +28,8 @@ setup(name='authme',
       zip_safe=False,
       test_suite='authme',
       install_requires=requires,
-      test_requires=test_requires
+      test_requires=test_requires,
+      entry_points={
+        'console_scripts': ['authme-bench = authme.bench:main'],
+        }
       )